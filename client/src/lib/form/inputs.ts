@@ -33,11 +33,33 @@ type Result = {
 type Form = {
 	title: string,
 	inputs: InputField[]
-	users: string[]
-	results: Result[]
+	// Legacy: patients are enrolled through the server's /enroll endpoint now.
+	users?: string[]
+	version?: number
 }
 
-export type { InputField, InputData, InputChoice, Form, Result, InputType }
+// Summary statistics over all of a form's results, as served by /aggregates.
+type FieldSummary = {
+	type: InputType,
+	answered: number,
+	refused: number,
+	counts?: { [choice: string]: number },
+	count?: number,
+	mean?: number | null,
+	std?: number | null,
+	min?: number | null,
+	max?: number | null
+}
+
+type Aggregates = {
+	completed: number,
+	fully_answered: number,
+	with_refusals: number,
+	fields: { [label: string]: FieldSummary },
+	daily: { date: string, completed: number, with_refusals: number, means: { [label: string]: number | null } }[]
+}
+
+export type { InputField, InputData, InputChoice, Form, Result, InputType, FieldSummary, Aggregates }
 
 const inputIssues = (input: InputField, id: string): string[] => {
 	let issues = [];
@@ -1,8 +1,7 @@
 import {firestore} from '$lib/firebase';
-import {deleteDoc, doc, getDoc, updateDoc, } from 'firebase/firestore';
+import {deleteDoc, doc, getDoc, } from 'firebase/firestore';
 import type {PageServerLoad} from './$types';
 import { error, redirect } from '@sveltejs/kit';
-import type { Result } from '$lib/form/inputs';
 
 export const load: PageServerLoad = async ({params}) => {
   const {admin_id, form_id, session_id} = params;
@@ -12,9 +11,7 @@ export const load: PageServerLoad = async ({params}) => {
   if (!formDoc.exists()) {
     error(404)
   }
-  let results = formDoc.data().results;
-  results=results.filter((result: Result)=>result.session_id!==session_id);
-  updateDoc(form_ref, {results})
+  await deleteDoc(doc(firestore, `admin/${admin_id}/forms/${form_id}/results/${session_id}`));
   await deleteDoc(ref);
   redirect(308, `/admin/view/${form_id}`);
 };
@@ -0,0 +1,581 @@
+"""
+In-memory stand-ins for the services the API talks to, with configurable latency:
+
+- FakeFirestore: the subset of the firestore_async client used by server/api.py
+  (documents, subcollections, simple queries, batches, field transforms).
+- FakeAuth: firebase_admin.auth.get_user for generated patients.
+- StubProvider: an in-process LLMProvider answering like langchain/stub_server.py.
+
+Every fake counts what it was asked to do, so a benchmark can report e.g. Firestore
+reads and writes per session. Each also takes a `connect_latency`, paid once by its
+first call, like the TLS handshakes and token fetches of a new process.
+"""
+import re
+import copy
+import math
+import time
+import random
+import string
+import asyncio
+import datetime
+import threading
+from types import SimpleNamespace
+from typing import AsyncIterator, Dict, List, Union
+
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud.firestore_v1 import transforms
+
+from langchain.context import count_message_tokens, count_tokens
+from langchain.llm import LLMError, LLMProvider
+from langchain.stub_server import stub_reply
+
+
+class Latency:
+    """
+    A latency distribution, parsed from a spec in milliseconds:
+
+        "0" or "const:5"        always that long
+        "uniform:5:15"          uniformly between the two bounds
+        "normal:300:100"        mean and standard deviation (clipped at 0)
+        "lognormal:8:40"        median and p99 (long right tail, like real RPCs)
+    """
+
+    def __init__(self, spec: str = "0"):
+        self.spec = spec
+        kind, *args = spec.split(":")
+        if not args:
+            kind, args = "const", [kind]
+        values = [float(arg) / 1000 for arg in args]
+        if kind == "const" and len(values) == 1:
+            self._sample = lambda: values[0]
+        elif kind == "uniform" and len(values) == 2:
+            self._sample = lambda: random.uniform(values[0], values[1])
+        elif kind == "normal" and len(values) == 2:
+            self._sample = lambda: max(0.0, random.gauss(values[0], values[1]))
+        elif kind == "lognormal" and len(values) == 2:
+            median, p99 = values
+            # 2.326 is the z-score of the 99th percentile.
+            sigma = math.log(p99 / median) / 2.326 if p99 > median > 0 else 0.0
+            self._sample = lambda: random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        else:
+            raise ValueError(f"Invalid latency spec: {spec!r}")
+
+    def sample(self) -> float:
+        return self._sample()
+
+    async def wait(self):
+        delay = self.sample()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def __repr__(self):
+        return f"Latency({self.spec!r})"
+
+
+# ----------------------------
+# Firestore
+# ----------------------------
+
+def _auto_id() -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=20))
+
+
+def _apply(data: Dict, path: str, value):
+    """
+    Set a (dotted) field path in a document, resolving Firestore sentinels.
+    """
+    *parents, name = path.split(".")
+    for parent in parents:
+        data = data.setdefault(parent, {})
+    current = data.get(name)
+    if value is transforms.DELETE_FIELD:
+        data.pop(name, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        data[name] = datetime.datetime.now(datetime.timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        data[name] = (current if isinstance(current, (int, float)) else 0) + value.value
+    elif isinstance(value, transforms.Maximum):
+        data[name] = value.value if not isinstance(current, (int, float)) else max(current, value.value)
+    elif isinstance(value, transforms.Minimum):
+        data[name] = value.value if not isinstance(current, (int, float)) else min(current, value.value)
+    elif isinstance(value, transforms.ArrayUnion):
+        items = list(current) if isinstance(current, list) else []
+        data[name] = items + [v for v in value.values if v not in items]
+    elif isinstance(value, transforms.ArrayRemove):
+        items = list(current) if isinstance(current, list) else []
+        data[name] = [v for v in items if v not in value.values]
+    elif isinstance(value, dict):
+        # Nested maps may contain sentinels too.
+        data[name] = {}
+        for key, item in value.items():
+            _apply_key(data[name], key, item)
+    else:
+        data[name] = copy.deepcopy(value)
+
+
+def _lookup(data: Dict, path: str):
+    for name in path.split("."):
+        if not isinstance(data, dict) or name not in data:
+            return None
+        data = data[name]
+    return data
+
+
+class FakeSnapshot:
+
+    def __init__(self, reference: "FakeDocument", data: Union[Dict, None], update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+        self.create_time = update_time
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Union[Dict, None]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path: str):
+        return copy.deepcopy(_lookup(self._data or {}, field_path))
+
+
+class FakeDocument:
+
+    def __init__(self, db: "FakeFirestore", parent: str, doc_id: str):
+        self._db = db
+        self.parent_path = parent
+        self.id = doc_id
+        self.path = f"{parent}/{doc_id}"
+
+    def collection(self, name: str) -> "FakeCollection":
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    async def get(self, field_paths: Union[List[str], None] = None, transaction=None) -> FakeSnapshot:
+        await self._db.round_trip()
+        self._db.count_reads(1)
+        return self._db.read(self, field_paths)
+
+    async def set(self, data: Dict, merge: bool = False):
+        await self._db.round_trip()
+        self._db.write(self, data, merge=merge)
+
+    async def update(self, data: Dict):
+        await self._db.round_trip()
+        self._db.write(self, data, update=True)
+
+    async def delete(self):
+        await self._db.round_trip()
+        self._db.delete(self)
+
+    def on_snapshot(self, callback) -> "FakeWatch":
+        # Like the synchronous client's listener: called with the current snapshot
+        # right away, then after every write to the document.
+        return self._db.watch(self, callback)
+
+
+class FakeWatch:
+
+    def __init__(self, db: "FakeFirestore", path: str, callback):
+        self._db = db
+        self.path = path
+        self.callback = callback
+
+    def unsubscribe(self):
+        self._db.unwatch(self)
+
+
+class FakeQuery:
+
+    def __init__(self, db: "FakeFirestore", path: str, orders=(), filters=(), limit=None,
+                 last=False, after=None, group=False):
+        self._db = db
+        # With `group`, `path` is a collection name and the query spans every
+        # collection of that name (a collection group).
+        self._path = path
+        self._group = group
+        self._orders = list(orders)
+        self._filters = list(filters)
+        self._limit = limit
+        self._last = last
+        self._after = after
+
+    def _copy(self, **changes) -> "FakeQuery":
+        state = {"orders": self._orders, "filters": self._filters, "limit": self._limit,
+                 "last": self._last, "after": self._after, "group": self._group}
+        state.update(changes)
+        return FakeQuery(self._db, self._path, **state)
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "FakeQuery":
+        return self._copy(orders=self._orders + [(field_path, direction == "DESCENDING")])
+
+    def where(self, field_path: str = None, op_string: str = None, value=None, filter=None) -> "FakeQuery":
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit=count, last=False)
+
+    def limit_to_last(self, count: int) -> "FakeQuery":
+        return self._copy(limit=count, last=True)
+
+    def start_after(self, document) -> "FakeQuery":
+        values = document.to_dict() if isinstance(document, FakeSnapshot) else document
+        return self._copy(after=values)
+
+    def _matches(self, data: Dict) -> bool:
+        for field_path, op, value in self._filters:
+            current = _lookup(data, field_path)
+            if op == "==" and current != value:
+                return False
+            if op == "!=" and current == value:
+                return False
+            if op in ("<", "<=", ">", ">=") and (current is None or not {
+                "<": current < value, "<=": current <= value,
+                ">": current > value, ">=": current >= value}[op]):
+                return False
+            if op == "in" and current not in value:
+                return False
+            if op == "array_contains" and value not in (current or []):
+                return False
+        return True
+
+    def _documents(self):
+        paths = self._db.collection_paths(self._path) if self._group else [self._path]
+        return [(path, doc_id, data) for path in paths for doc_id, data in self._db.children(path)]
+
+    def _run(self) -> List[FakeSnapshot]:
+        docs = [(parent, doc_id, data) for parent, doc_id, data in self._documents() if self._matches(data)]
+        for field_path, descending in reversed(self._orders):
+            docs = [d for d in docs if _lookup(d[2], field_path) is not None]
+            docs.sort(key=lambda d: _lookup(d[2], field_path), reverse=descending)
+        if self._after is not None and self._orders:
+            key = tuple(_lookup(self._after, f) for f, _ in self._orders)
+            docs = [d for d in docs if tuple(_lookup(d[2], f) for f, _ in self._orders) > key]
+        if self._limit is not None:
+            docs = docs[-self._limit:] if self._last else docs[:self._limit]
+        return [FakeSnapshot(FakeDocument(self._db, parent, doc_id), copy.deepcopy(data))
+                for parent, doc_id, data in docs]
+
+    async def get(self, transaction=None) -> List[FakeSnapshot]:
+        await self._db.round_trip()
+        docs = self._run()
+        # Firestore bills a query that matches nothing as one read.
+        self._db.count_reads(max(1, len(docs)))
+        return docs
+
+    async def stream(self, transaction=None) -> AsyncIterator[FakeSnapshot]:
+        for doc in await self.get():
+            yield doc
+
+
+class FakeCollection(FakeQuery):
+
+    def __init__(self, db: "FakeFirestore", path: str):
+        super().__init__(db, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: Union[str, None] = None) -> FakeDocument:
+        return FakeDocument(self._db, self._path, document_id or _auto_id())
+
+
+class FakeBatch:
+
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._ops = []
+
+    # Values are copied when the batch is committed (sentinels must keep their identity).
+    def set(self, reference: FakeDocument, data: Dict, merge: bool = False):
+        self._ops.append(("set", reference, dict(data), merge))
+
+    def update(self, reference: FakeDocument, data: Dict, option: "FakeWriteOption" = None):
+        self._ops.append(("update", reference, dict(data), option))
+
+    def delete(self, reference: FakeDocument):
+        self._ops.append(("delete", reference, None, False))
+
+    async def commit(self):
+        await self._db.round_trip()
+        # All or nothing, like a real batch.
+        with self._db.lock:
+            for op, reference, _, option in self._ops:
+                if op != "update":
+                    continue
+                snapshot = self._db.read(reference, count=False)
+                if snapshot._data is None:
+                    raise NotFound(f"No document to update: {reference.path}")
+                if option is not None and option.last_update_time != snapshot.update_time:
+                    raise FailedPrecondition(f"Document changed since it was read: {reference.path}")
+            for op, reference, data, option in self._ops:
+                if op == "delete":
+                    self._db.delete(reference)
+                else:
+                    self._db.write(reference, data, merge=(op == "set" and option), update=(op == "update"))
+        self._ops = []
+
+
+class FakeWriteOption:
+    """
+    What client.write_option(last_update_time=...) returns: a precondition on update().
+    """
+
+    def __init__(self, last_update_time: datetime.datetime):
+        self.last_update_time = last_update_time
+
+
+class FakeFirestore:
+    """
+    An in-memory firestore_async client. Every RPC (get, set, update, delete, query,
+    batch commit) waits for one sample of `latency`.
+    """
+
+    def __init__(self, latency: Latency = None, connect_latency: Latency = None):
+        self.latency = latency or Latency("0")
+        self.connect_latency = connect_latency or Latency("0")
+        self._connected = False
+        self.lock = threading.RLock()
+        self._collections: Dict[str, Dict[str, Dict]] = {}
+        self._update_times: Dict[str, datetime.datetime] = {}
+        self._watches: Dict[str, List[FakeWatch]] = {}
+        self.reads = 0
+        self.writes = 0
+        self.round_trips = 0
+
+    # client API
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def collection_group(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name, group=True)
+
+    def document(self, path: str) -> FakeDocument:
+        parent, doc_id = path.rsplit("/", 1)
+        return FakeDocument(self, parent, doc_id)
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+    @staticmethod
+    def write_option(last_update_time: datetime.datetime) -> FakeWriteOption:
+        return FakeWriteOption(last_update_time)
+
+    # bookkeeping
+
+    async def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+            connect, self._connected = not self._connected, True
+        if connect:
+            await self.connect_latency.wait()
+        await self.latency.wait()
+
+    def count_reads(self, n: int):
+        with self.lock:
+            self.reads += n
+
+    def watch(self, reference: FakeDocument, callback) -> FakeWatch:
+        watch = FakeWatch(self, reference.path, callback)
+        with self.lock:
+            self._watches.setdefault(reference.path, []).append(watch)
+        self._notify(reference)
+        return watch
+
+    def unwatch(self, watch: FakeWatch):
+        with self.lock:
+            watches = self._watches.get(watch.path, [])
+            if watch in watches:
+                watches.remove(watch)
+
+    def _notify(self, reference: FakeDocument):
+        with self.lock:
+            watches = list(self._watches.get(reference.path, []))
+            if not watches:
+                return
+            self.reads += 1
+            snapshot = self.read(reference)
+        for watch in watches:
+            watch.callback([snapshot], [], datetime.datetime.now(datetime.timezone.utc))
+
+    def counters(self) -> Dict[str, int]:
+        with self.lock:
+            return {"reads": self.reads, "writes": self.writes, "round_trips": self.round_trips}
+
+    def collection_paths(self, name: str) -> List[str]:
+        with self.lock:
+            return [path for path in self._collections if path.rsplit("/", 1)[-1] == name]
+
+    def children(self, collection_path: str):
+        with self.lock:
+            return list(self._collections.get(collection_path, {}).items())
+
+    def read(self, reference: FakeDocument, field_paths: Union[List[str], None] = None,
+             count: bool = True) -> FakeSnapshot:
+        with self.lock:
+            data = self._collections.get(reference.parent_path, {}).get(reference.id)
+            data = copy.deepcopy(data)
+            update_time = self._update_times.get(reference.path)
+        if data is not None and field_paths is not None:
+            projected: Dict = {}
+            for field_path in field_paths:
+                value = _lookup(data, field_path)
+                if value is not None:
+                    _apply(projected, field_path, value)
+            data = projected
+        return FakeSnapshot(reference, data, update_time)
+
+    def write(self, reference: FakeDocument, data: Dict, merge: bool = False, update: bool = False):
+        with self.lock:
+            docs = self._collections.setdefault(reference.parent_path, {})
+            current = docs.get(reference.id)
+            if update and current is None:
+                raise NotFound(f"No document to update: {reference.path}")
+            target = copy.deepcopy(current) if (merge or update) and current is not None else {}
+            for key, value in data.items():
+                # update() takes dotted field paths; set() takes plain keys.
+                if update:
+                    _apply(target, key, value)
+                elif merge:
+                    _merge_key(target, key, value)
+                else:
+                    _apply_key(target, key, value)
+            docs[reference.id] = target
+            self._update_times[reference.path] = datetime.datetime.now(datetime.timezone.utc)
+            self.writes += 1
+        self._notify(reference)
+
+    def delete(self, reference: FakeDocument):
+        with self.lock:
+            self._collections.get(reference.parent_path, {}).pop(reference.id, None)
+            self._update_times.pop(reference.path, None)
+            self.writes += 1
+        self._notify(reference)
+
+
+def _apply_key(data: Dict, key: str, value):
+    # Like _apply, but for a literal key that may contain dots.
+    holder = {"k": data[key]} if key in data else {}
+    _apply(holder, "k", value)
+    if "k" in holder:
+        data[key] = holder["k"]
+    else:
+        data.pop(key, None)
+
+
+def _merge_key(data: Dict, key: str, value):
+    # set(merge=True) merges nested maps field by field instead of replacing them.
+    if isinstance(value, dict) and isinstance(data.get(key), dict):
+        for name, item in value.items():
+            _merge_key(data[key], name, item)
+    else:
+        _apply_key(data, key, value)
+
+
+# ----------------------------
+# Firebase Auth
+# ----------------------------
+
+class UserNotFoundError(ValueError):
+    pass
+
+
+class FakeAuth:
+    """
+    Replaces the firebase_admin.auth module: get_user() knows the patients added
+    with add_user(). It is called from a worker thread, so it sleeps synchronously.
+    """
+
+    UserNotFoundError = UserNotFoundError
+
+    def __init__(self, latency: Latency = None, connect_latency: Latency = None):
+        self.latency = latency or Latency("0")
+        self.connect_latency = connect_latency or Latency("0")
+        self._connected = False
+        self._users: Dict[str, SimpleNamespace] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def add_user(self, uid: str, display_name: str, email: str):
+        self._users[uid] = SimpleNamespace(uid=uid, display_name=display_name, email=email)
+
+    def get_user(self, uid: str, app=None) -> SimpleNamespace:
+        with self._lock:
+            self.calls += 1
+            connect, self._connected = not self._connected, True
+        time.sleep(self.latency.sample() + (self.connect_latency.sample() if connect else 0.0))
+        if uid not in self._users:
+            raise UserNotFoundError(f"No user record found for the provided user ID: {uid}")
+        return self._users[uid]
+
+
+# ----------------------------
+# Chat completions
+# ----------------------------
+
+class StubProvider(LLMProvider):
+    """
+    Answers like langchain/stub_server.py without the HTTP hop: `latency` is the time
+    to the first token, `token_latency` the delay between streamed chunks, and
+    `error_rate` the fraction of calls that fail with LLMError.
+    """
+
+    def __init__(self, latency: Latency = None, token_latency: Latency = None, error_rate: float = 0.0,
+                 connect_latency: Latency = None):
+        self.latency = latency or Latency("0")
+        self.token_latency = token_latency or Latency("0")
+        self.error_rate = error_rate
+        self.connect_latency = connect_latency or Latency("0")
+        self._connected = False
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.models: Dict[str, int] = {}  # model -> calls
+
+    async def _connect(self):
+        if not self._connected:
+            self._connected = True
+            await self.connect_latency.wait()
+
+    async def warmup(self):
+        await self._connect()
+
+    def _start(self, messages: List[Dict[str, str]], model: str) -> str:
+        self.calls += 1
+        self.models[model] = self.models.get(model, 0) + 1
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise LLMError("stub overloaded", 503)
+        content = stub_reply(messages)
+        self.prompt_tokens += count_message_tokens(messages, model)
+        self.completion_tokens += count_tokens(content, model)
+        return content
+
+    async def complete(self, messages: List[Dict[str, str]], model: str, temperature: float,
+                       max_tokens: int, deadline: Union[float, None] = None) -> Dict:
+        await self._connect()
+        await self.latency.wait()
+        content = self._start(messages, model)
+        return {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": count_message_tokens(messages, model),
+                      "completion_tokens": count_tokens(content, model)},
+        }
+
+    async def stream(self, messages: List[Dict[str, str]], model: str, temperature: float,
+                     max_tokens: int, deadline: Union[float, None] = None) -> AsyncIterator[str]:
+        await self._connect()
+        await self.latency.wait()
+        content = self._start(messages, model)
+        for word in re.findall(r"\S+\s*", content):
+            yield word
+            await self.token_latency.wait()
+
+    def counters(self) -> Dict[str, int]:
+        return {"calls": self.calls, "errors": self.errors,
+                "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens,
+                "models": dict(self.models)}
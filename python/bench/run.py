@@ -0,0 +1,348 @@
+"""
+Offline benchmark of the session endpoints.
+
+Runs server/api.py in-process against the fakes in bench/fakes.py (Firestore,
+Firebase Auth and the chat completion API, each with its own latency distribution)
+and drives concurrent patient sessions from recorded conversation fixtures:
+start_session -> send_message for each recorded message -> background finalization.
+
+It reports latency percentiles per step, requests/sec, and Firestore reads/writes,
+Auth calls, LLM calls and prompt tokens per session. Runs can be saved and compared:
+
+    cd python
+    python -m bench.run --sessions 500 --concurrency 50 --out before.json
+    # ... change something ...
+    python -m bench.run --sessions 500 --concurrency 50 --compare before.json
+
+--compare exits with status 1 if a metric got worse by more than --threshold percent.
+Latency specs are in milliseconds, see bench.fakes.Latency ("lognormal:8:40" is a
+median of 8ms with a p99 of 40ms).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from typing import Dict, List, Union
+
+import httpx
+
+from bench.fakes import FakeAuth, FakeFirestore, Latency, StubProvider
+from langchain.llm import set_provider
+
+ADMIN_ID = "bench-admin"
+FORM_ID = "bench-form"
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "daily_diary.json")
+
+# Metrics where a higher value is better; everything else is compared as "lower is better".
+_HIGHER_IS_BETTER = {"requests_per_second", "sessions_per_second"}
+
+
+def load_api(db: FakeFirestore, fake_auth: FakeAuth):
+    """
+    Import server/api.py wired to the fakes instead of Firebase.
+    """
+    os.environ.setdefault("JOB_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-"), "jobs.sqlite3"))
+    import firebase_admin
+    from firebase_admin import credentials, firestore, firestore_async
+
+    # The API connects to Firebase on first use; hand it the fakes instead.
+    credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore_async.client = lambda *args, **kwargs: db
+    firestore.client = lambda *args, **kwargs: db  # snapshot listeners
+
+    from server import api
+    api.auth = fake_auth
+    return api
+
+
+def seed(db: FakeFirestore, fake_auth: FakeAuth, form: Dict, patients: int) -> List[str]:
+    """
+    Create the benchmark form and its patients; returns the patient uids.
+    """
+    uids = []
+    emails = []
+    for i in range(patients):
+        uid = f"patient-{i}"
+        email = f"patient-{i}@example.com"
+        fake_auth.add_user(uid, f"Patient{i} Bench", email)
+        uids.append(uid)
+        emails.append(email)
+    form_ref = db.collection("admin").document(ADMIN_ID).collection("forms").document(FORM_ID)
+    db.write(form_ref, {"title": form.get("title", "Benchmark"), "inputs": form["inputs"],
+                        "users": emails, "version": 1})
+    return uids
+
+
+class Recorder:
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.requests = 0
+        self.sessions_started = 0
+        self.sessions_completed = 0
+        self.sessions_finalized = 0
+
+    def record(self, step: str, seconds: float):
+        self.latencies.setdefault(step, []).append(seconds * 1000)
+
+    def error(self, step: str, reason: str):
+        key = f"{step}: {reason}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+async def _post(client: httpx.AsyncClient, recorder: Recorder, step: str, url: str, body: Dict,
+                stream: bool) -> Union[Dict, None]:
+    started = time.perf_counter()
+    recorder.requests += 1
+    if stream:
+        # The in-process transport delivers the body in one piece, so only the total
+        # time of a streamed response is meaningful here.
+        result = None
+        async with client.stream("POST", "/stream" + url, json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                recorder.error(step, str(response.status_code))
+                return None
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    if event in ("session", "done"):
+                        result = {**(result or {}), **json.loads(line[len("data:"):])}
+                    elif event == "error":
+                        recorder.error(step, "stream error")
+                        return None
+                    event = None
+    else:
+        response = await client.post(url, json=body)
+        if response.status_code != 200:
+            recorder.error(step, str(response.status_code))
+            return None
+        result = response.json()
+    recorder.record(step, time.perf_counter() - started)
+    return result
+
+
+async def _wait_finalized(api, recorder: Recorder, session_id: str, timeout: float = 60.0):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        job = api._job_queue().get(session_id)
+        if job is not None and job["status"] in ("done", "dead"):
+            if job["status"] == "done":
+                recorder.record("finalization", time.perf_counter() - started)
+                recorder.sessions_finalized += 1
+            else:
+                recorder.error("finalization", "dead-lettered")
+            return
+        await asyncio.sleep(0.01)
+    recorder.error("finalization", "timeout")
+
+
+async def run_session(client: httpx.AsyncClient, api, recorder: Recorder, conversation: Dict,
+                      patient_id: str, think_time: Latency, stream: bool):
+    recorder.sessions_started += 1
+    started = await _post(client, recorder, "start_session", f"/start_session/{ADMIN_ID}/{FORM_ID}",
+                          {"patient_id": patient_id}, stream)
+    if started is None:
+        return
+    session_id = started["session_id"]
+    for message in conversation["messages"]:
+        await think_time.wait()
+        reply = await _post(client, recorder, "send_message", f"/send_message/{ADMIN_ID}/{FORM_ID}",
+                            {"session_id": session_id, "patient_id": patient_id, "message": message}, stream)
+        if reply is None:
+            return
+        if reply.get("message") == "Session complete":
+            recorder.sessions_completed += 1
+            await _wait_finalized(api, recorder, session_id)
+            return
+    recorder.error("session", "not complete after the recorded messages")
+
+
+async def run(args) -> Dict:
+    with open(args.fixture) as f:
+        fixture = json.load(f)
+
+    db = FakeFirestore(Latency(args.firestore_latency))
+    fake_auth = FakeAuth(Latency(args.auth_latency))
+    provider = StubProvider(Latency(args.llm_latency), Latency(args.llm_token_latency), args.llm_error_rate)
+    api = load_api(db, fake_auth)
+    set_provider(provider)
+    patients = seed(db, fake_auth, fixture["form"], args.patients)
+
+    recorder = Recorder()
+    think_time = Latency(args.think_time)
+    conversations = fixture["conversations"]
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(args.sessions):
+        queue.put_nowait((random.choice(conversations), patients[i % len(patients)]))
+
+    async def worker(client):
+        while not queue.empty():
+            conversation, patient_id = queue.get_nowait()
+            await run_session(client, api, recorder, conversation, patient_id, think_time, args.stream)
+
+    transport = httpx.ASGITransport(app=api.app)
+    async with api.app.router.lifespan_context(api.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*[worker(client) for _ in range(args.concurrency)])
+            duration = time.perf_counter() - started
+
+    sessions = max(1, recorder.sessions_started)
+    firestore = db.counters()
+    llm = provider.counters()
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("out", "compare")},
+        "duration_seconds": round(duration, 3),
+        "requests": recorder.requests,
+        "requests_per_second": round(recorder.requests / duration, 2),
+        "sessions": {
+            "started": recorder.sessions_started,
+            "completed": recorder.sessions_completed,
+            "finalized": recorder.sessions_finalized,
+        },
+        "sessions_per_second": round(recorder.sessions_finalized / duration, 2),
+        "errors": recorder.errors,
+        "latency_ms": {
+            step: {
+                "count": len(values),
+                "mean": round(sum(values) / len(values), 2),
+                "p50": round(percentile(values, 50), 2),
+                "p95": round(percentile(values, 95), 2),
+                "p99": round(percentile(values, 99), 2),
+                "max": round(max(values), 2),
+            }
+            for step, values in recorder.latencies.items()
+        },
+        "per_session": {
+            "firestore_reads": round(firestore["reads"] / sessions, 2),
+            "firestore_writes": round(firestore["writes"] / sessions, 2),
+            "firestore_round_trips": round(firestore["round_trips"] / sessions, 2),
+            "auth_calls": round(fake_auth.calls / sessions, 2),
+            "llm_calls": round(llm["calls"] / sessions, 2),
+            "prompt_tokens": round(llm["prompt_tokens"] / sessions, 2),
+            "completion_tokens": round(llm["completion_tokens"] / sessions, 2),
+        },
+        "llm_calls_by_model": llm["models"],
+    }
+
+
+def flatten(report: Dict) -> Dict[str, float]:
+    """
+    The comparable metrics of a report, keyed by a dotted name.
+    """
+    metrics = {
+        "requests_per_second": report["requests_per_second"],
+        "sessions_per_second": report["sessions_per_second"],
+    }
+    for step, stats in report["latency_ms"].items():
+        for name in ("p50", "p95", "p99"):
+            metrics[f"latency_ms.{step}.{name}"] = stats[name]
+    for name, value in report["per_session"].items():
+        metrics[f"per_session.{name}"] = value
+    return metrics
+
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> List[str]:
+    """
+    Print the change of every metric against a baseline report and return the names
+    of those that got worse by more than `threshold` percent.
+    """
+    before, after = flatten(baseline), flatten(current)
+    regressions = []
+    print(f"\n{'metric':<42} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(before) | set(after)):
+        if name not in before or name not in after:
+            print(f"{name:<42} {before.get(name, '-'):>12} {after.get(name, '-'):>12} {'':>9}")
+            continue
+        old, new = before[name], after[name]
+        change = (new - old) / old * 100 if old else (0.0 if new == old else float("inf"))
+        worse = -change if name in _HIGHER_IS_BETTER else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif worse < -threshold:
+            flag = "  improved"
+        print(f"{name:<42} {old:>12} {new:>12} {change:>+8.1f}%{flag}")
+    return regressions
+
+
+def print_report(report: Dict):
+    sessions = report["sessions"]
+    print(f"\n{sessions['started']} sessions ({sessions['completed']} completed, {sessions['finalized']} finalized) "
+          f"in {report['duration_seconds']}s: {report['requests_per_second']} requests/s, "
+          f"{report['sessions_per_second']} sessions/s")
+    print(f"\n{'step':<16} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    for step, stats in report["latency_ms"].items():
+        print(f"{step:<16} {stats['count']:>7} {stats['p50']:>9} {stats['p95']:>9} {stats['p99']:>9} {stats['max']:>9}")
+    print("\nper session:")
+    for name, value in report["per_session"].items():
+        print(f"  {name:<22} {value}")
+    if report.get("llm_calls_by_model"):
+        print("\nLLM calls by model:")
+        for model, calls in report["llm_calls_by_model"].items():
+            print(f"  {model:<22} {calls}")
+    if report["errors"]:
+        print("\nerrors:")
+        for name, count in report["errors"].items():
+            print(f"  {name}: {count}")
+
+
+def main(argv: Union[List[str], None] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", default=DEFAULT_FIXTURE, help="form and recorded conversations (JSON)")
+    parser.add_argument("--sessions", type=int, default=200, help="number of sessions to run")
+    parser.add_argument("--concurrency", type=int, default=20, help="patients chatting at the same time")
+    parser.add_argument("--patients", type=int, default=100, help="number of distinct patients")
+    parser.add_argument("--stream", action="store_true", help="use the /stream endpoints")
+    parser.add_argument("--firestore-latency", default="lognormal:8:40")
+    parser.add_argument("--auth-latency", default="lognormal:30:150")
+    parser.add_argument("--llm-latency", default="lognormal:700:2500", help="time to first token")
+    parser.add_argument("--llm-token-latency", default="const:10", help="delay between streamed chunks")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--think-time", default="0", help="patient's pause before each message")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="baseline report to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.threshold}%")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
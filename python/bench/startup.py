@@ -0,0 +1,135 @@
+"""
+Cold start benchmark of server/api.py.
+
+Every run starts a fresh interpreter that imports the API against the fakes in
+bench/fakes.py and serves a patient's first requests. Each fake's first call pays
+--connect-latency, standing in for the TLS handshakes and token fetches of a new
+replica. It runs --runs times with WARMUP=1 and with WARMUP=0, and reports per setting:
+
+  import_ms           importing server.api (its dependencies the fakes share, such
+                      as the Firestore types, are already loaded)
+  startup_ms          the lifespan startup, until the app accepts requests
+  ready_ms            import and startup, then until /ready answers 200
+  first_request_ms    a patient's first start_session
+  second_request_ms   the next patient's, with every connection open
+
+    cd python
+    python -m bench.startup --runs 5
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+from typing import Dict, List, Union
+
+import httpx
+
+from bench.fakes import FakeAuth, FakeFirestore, Latency, StubProvider
+from bench.run import ADMIN_ID, DEFAULT_FIXTURE, FORM_ID, load_api, percentile, seed
+from langchain.llm import set_provider
+
+METRICS = ("import_ms", "startup_ms", "ready_ms", "first_request_ms", "second_request_ms")
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+async def measure(args) -> Dict[str, float]:
+    """
+    One cold start, in this (fresh) process.
+    """
+    with open(args.fixture) as f:
+        fixture = json.load(f)
+    connect = Latency(args.connect_latency)
+    db = FakeFirestore(Latency(args.firestore_latency), connect)
+    fake_auth = FakeAuth(Latency(args.auth_latency), connect)
+    provider = StubProvider(Latency(args.llm_latency), connect_latency=connect)
+
+    started = time.perf_counter()
+    api = load_api(db, fake_auth)
+    imported = time.perf_counter()
+    set_provider(provider)
+    patients = seed(db, fake_auth, fixture["form"], 2)
+
+    async with api.app.router.lifespan_context(api.app):
+        started_up = time.perf_counter()
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            while (await client.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.005)
+            ready = time.perf_counter()
+
+            latencies = []
+            for patient_id in patients:
+                request_started = time.perf_counter()
+                response = await client.post(f"/start_session/{ADMIN_ID}/{FORM_ID}", json={"patient_id": patient_id})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - request_started)
+
+    return {
+        "import_ms": _ms(imported - started),
+        "startup_ms": _ms(started_up - imported),
+        "ready_ms": _ms(ready - started),
+        "first_request_ms": _ms(latencies[0]),
+        "second_request_ms": _ms(latencies[1]),
+    }
+
+
+def _child_argv(args) -> List[str]:
+    return [sys.executable, "-m", "bench.startup", "--child", "--fixture", args.fixture,
+            "--connect-latency", args.connect_latency, "--firestore-latency", args.firestore_latency,
+            "--auth-latency", args.auth_latency, "--llm-latency", args.llm_latency]
+
+
+def run_child(args, warmup: bool) -> Dict[str, float]:
+    env = dict(os.environ, WARMUP="1" if warmup else "0")
+    output = subprocess.run(_child_argv(args), env=env, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    # The API may log to stdout; the measurement is the last line.
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv: Union[List[str], None] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", default=DEFAULT_FIXTURE, help="form and recorded conversations (JSON)")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts per setting")
+    parser.add_argument("--connect-latency", default="const:300", help="first call to each backend")
+    parser.add_argument("--firestore-latency", default="lognormal:8:40")
+    parser.add_argument("--auth-latency", default="lognormal:30:150")
+    parser.add_argument("--llm-latency", default="lognormal:700:2500", help="time to first token")
+    parser.add_argument("--out", help="write the report to this JSON file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(asyncio.run(measure(args))))
+        return 0
+
+    report = {}
+    for warmup in (True, False):
+        runs = [run_child(args, warmup) for _ in range(args.runs)]
+        report["warmup" if warmup else "no_warmup"] = {
+            metric: {"p50": round(percentile([run[metric] for run in runs], 50), 2),
+                     "max": round(max(run[metric] for run in runs), 2)}
+            for metric in METRICS
+        }
+
+    print(f"{args.runs} cold start(s) per setting, connect latency {args.connect_latency}\n")
+    print(f"{'':20}" + "".join(f"{setting:>22}" for setting in report))
+    for metric in METRICS:
+        cells = "".join(f"{report[s][metric]['p50']:>12.1f} (max {report[s][metric]['max']:>6.0f})"
+                        for s in report)
+        print(f"{metric:20}{cells}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Token budgets per admin and per form.
+
+TokenLedger counts the tokens of every LLM call against its tenant ("admin_id/
+form_id"): once for the admin and once for the form. Each count is handed to
+`save` (the API writes them behind to Firestore) and read back with `load` the
+first time a scope is checked and every LLM_BUDGET_REFRESH seconds after, which
+picks up what other instances used. Between refreshes an instance only adds its own
+calls, so several instances together may overshoot a budget by up to a refresh
+interval's worth of usage.
+
+A scope's budget is LLM_ADMIN_TOKEN_BUDGET or LLM_FORM_TOKEN_BUDGET (0: unlimited)
+unless its stored usage has a "budget" of its own. Once a scope used its budget,
+interactive and batch calls of its tenants fail with BudgetExceeded. Finalizations
+still run, so a session the patient finished is never lost.
+
+Usage is a lifetime total: there is no budget period and nothing resets it. To give
+a scope more room, raise its budget (POST /budget).
+"""
+import os
+import time
+import threading
+from typing import Awaitable, Callable, Dict, List, Union
+
+from langchain.llm import LLMError
+from langchain.scheduler import FINALIZATION
+from lib.metrics import registry
+
+LLM_ADMIN_TOKEN_BUDGET = int(os.getenv("LLM_ADMIN_TOKEN_BUDGET", "0"))
+LLM_FORM_TOKEN_BUDGET = int(os.getenv("LLM_FORM_TOKEN_BUDGET", "0"))
+LLM_BUDGET_REFRESH = float(os.getenv("LLM_BUDGET_REFRESH", "60"))
+
+_rejected = registry.counter(
+    "llm_budget_rejected_total", "LLM calls refused because a token budget was used up.", ["scope"])
+
+
+class BudgetExceeded(LLMError):
+
+    def __init__(self, scope: tuple, used: int, budget: int):
+        super().__init__(f"Token budget of {'/'.join(scope)} used up ({used} of {budget})", status_code=429)
+        self.scope = scope
+
+
+def _scope_kind(scope: tuple) -> str:
+    return "admin" if len(scope) == 1 else "form"
+
+
+class _Usage:
+
+    def __init__(self, tokens: int = 0, budget: Union[int, None] = None):
+        self.tokens = tokens
+        self.budget = budget
+        self.loaded_at = time.monotonic()
+
+
+class TokenLedger:
+    """
+    `load(scope)` returns the stored usage of a scope, (admin_id,) or (admin_id,
+    form_id), as {"prompt_tokens", "completion_tokens", "budget"}; `save(scope, model,
+    prompt_tokens, completion_tokens)` adds a call to it. Without them usage is only
+    counted in memory.
+    """
+
+    def __init__(self, admin_budget: int = LLM_ADMIN_TOKEN_BUDGET, form_budget: int = LLM_FORM_TOKEN_BUDGET,
+                 load: Union[Callable[[tuple], Awaitable[Dict]], None] = None,
+                 save: Union[Callable[[tuple, str, int, int], Awaitable[None]], None] = None,
+                 refresh_seconds: float = LLM_BUDGET_REFRESH):
+        self.admin_budget = admin_budget
+        self.form_budget = form_budget
+        self.refresh_seconds = refresh_seconds
+        self._load = load
+        self._save = save
+        self._usage: Dict[tuple, _Usage] = {}
+        # Callers may run on different event loops (the sync wrappers use asyncio.run).
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def scopes(tenant: str) -> List[tuple]:
+        if not tenant:
+            return []
+        admin_id, _, form_id = tenant.partition("/")
+        return [(admin_id,), (admin_id, form_id)] if form_id else [(admin_id,)]
+
+    def budget(self, scope: tuple, stored_budget: Union[int, None] = None) -> int:
+        """
+        The budget of a scope given its stored one, 0 if unlimited.
+        """
+        if stored_budget is not None:
+            return stored_budget
+        return self.admin_budget if len(scope) == 1 else self.form_budget
+
+    async def _get(self, scope: tuple) -> _Usage:
+        with self._lock:
+            usage = self._usage.get(scope)
+        if usage is not None and time.monotonic() - usage.loaded_at < self.refresh_seconds:
+            return usage
+        stored = None
+        if self._load is not None:
+            try:
+                stored = await self._load(scope)
+            except Exception as e:
+                print(f"Loading the token usage of {'/'.join(scope)} failed: {e!r}")
+        with self._lock:
+            usage = self._usage.get(scope)
+            if stored is None:
+                # Keep counting locally and try again after the next interval.
+                usage = usage or _Usage()
+                usage.loaded_at = time.monotonic()
+            else:
+                # The stored total may not include this instance's latest calls yet.
+                tokens = stored.get("prompt_tokens", 0) + stored.get("completion_tokens", 0)
+                usage = _Usage(max(tokens, usage.tokens if usage else 0), stored.get("budget"))
+            self._usage[scope] = usage
+        return usage
+
+    async def check(self, tenant: str, priority: str):
+        """
+        Raise BudgetExceeded if the tenant's admin or form used up its budget and the
+        call may be refused.
+        """
+        for scope in self.scopes(tenant):
+            usage = await self._get(scope)
+            budget = self.budget(scope, usage.budget)
+            if budget and usage.tokens >= budget and priority != FINALIZATION:
+                _rejected.inc(scope=_scope_kind(scope))
+                raise BudgetExceeded(scope, usage.tokens, budget)
+
+    def share(self, tenant: str) -> float:
+        """
+        The largest share of its budget the tenant's admin or form used, as last seen.
+        """
+        share = 0.0
+        with self._lock:
+            for scope in self.scopes(tenant):
+                usage = self._usage.get(scope)
+                budget = self.budget(scope, usage.budget) if usage is not None else 0
+                if budget:
+                    share = max(share, usage.tokens / budget)
+        return share
+
+    async def record(self, tenant: str, model: str, prompt_tokens: int, completion_tokens: int):
+        """
+        Count a finished call against the tenant's admin and form.
+        """
+        for scope in self.scopes(tenant):
+            with self._lock:
+                usage = self._usage.get(scope)
+                if usage is None:
+                    # Not checked yet: load its stored usage and budget on the next check.
+                    usage = self._usage[scope] = _Usage()
+                    usage.loaded_at = float("-inf")
+                usage.tokens += prompt_tokens + completion_tokens
+            if self._save is None:
+                continue
+            try:
+                await self._save(scope, model, prompt_tokens, completion_tokens)
+            except Exception as e:
+                # The call itself succeeded; only its accounting is lost.
+                print(f"Saving the token usage of {'/'.join(scope)} failed: {e!r}")
+
+    def forget(self, scope: tuple):
+        """
+        Drop what is known of a scope, so the next check loads it again (e.g. after
+        its budget was changed).
+        """
+        with self._lock:
+            self._usage.pop(scope, None)
+
+
+_ledger: Union[TokenLedger, None] = None
+
+
+def get_ledger() -> TokenLedger:
+    """
+    The process-wide ledger, with the budgets from the environment and counting in
+    memory until set_ledger() gives it storage.
+    """
+    global _ledger
+    if _ledger is None:
+        _ledger = TokenLedger()
+    return _ledger
+
+
+def set_ledger(ledger: TokenLedger):
+    """
+    Replace the process-wide ledger (the API installs one that persists to Firestore).
+    """
+    global _ledger
+    _ledger = ledger
@@ -0,0 +1,148 @@
+import os
+import json
+import threading
+from typing import Dict, List, Union
+
+# tiktoken gives exact counts for OpenAI models; without it we fall back to the
+# usual ~4 characters per token estimate, which is close enough for budgeting.
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+# Upper bound on the prompt (system prompt + history) sent for a conversation turn.
+LLM_PROMPT_TOKEN_BUDGET = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "3000"))
+
+# Per-message framing overhead used by the chat format (role, separators).
+_TOKENS_PER_MESSAGE = 4
+_TOKENS_PER_REPLY = 3
+
+_encodings: Dict[str, object] = {}
+
+
+def _encoding(model: str):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """
+    Count the tokens of a piece of text locally, without calling the API.
+    """
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text))
+    return (len(text) + 3) // 4
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo") -> int:
+    """
+    Count the prompt tokens of a chat message list, including the chat format overhead.
+    """
+    total = _TOKENS_PER_REPLY
+    for message in messages:
+        total += _TOKENS_PER_MESSAGE + count_tokens(message["content"], model)
+    return total
+
+
+def pending_inputs(inputs: List[Dict], filled_fields: Union[Dict, None]) -> List[Dict]:
+    """
+    The form inputs that still need an answer, given the fields collected so far.
+    """
+    if not filled_fields:
+        return list(inputs)
+    return [field for field in inputs if field["label"] not in filled_fields]
+
+
+def collected_summary(filled_fields: Union[Dict, None]) -> str:
+    """
+    A one-line JSON summary of already collected answers, to stand in for the
+    exchanges that produced them.
+    """
+    if not filled_fields:
+        return ""
+    return json.dumps(filled_fields)
+
+
+class ContextStats:
+    """
+    Process-wide prompt size counters, so the effect of the budget can be measured.
+
+    Only the budget step is measured: the history handed to fit_messages is already
+    capped and the system prompt already carries the reduced requirements, so
+    budgeted_prompt_tokens - prompt_tokens is what dropping messages saved, not what
+    the whole context strategy saved.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.prompt_tokens = 0
+        self.budgeted_prompt_tokens = 0
+        self.trimmed_turns = 0
+        self.dropped_messages = 0
+
+    def record(self, prompt_tokens: int, budgeted_prompt_tokens: int, dropped_messages: int):
+        with self._lock:
+            self.turns += 1
+            self.prompt_tokens += prompt_tokens
+            self.budgeted_prompt_tokens += budgeted_prompt_tokens
+            if dropped_messages:
+                self.trimmed_turns += 1
+                self.dropped_messages += dropped_messages
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "prompt_tokens": self.prompt_tokens,
+                # what the prompts handed to fit_messages would have cost without dropping messages
+                "budgeted_prompt_tokens": self.budgeted_prompt_tokens,
+                "trimmed_turns": self.trimmed_turns,
+                "dropped_messages": self.dropped_messages,
+            }
+
+
+context_stats = ContextStats()
+
+
+def fit_messages(
+    system_prompt: str,
+    conversation_history: List[Dict[str, str]],
+    budget: int = LLM_PROMPT_TOKEN_BUDGET,
+    model: str = "gpt-3.5-turbo",
+) -> tuple[List[Dict[str, str]], Dict[str, int]]:
+    """
+    Build [system prompt] + history, dropping the oldest messages until the prompt fits
+    in `budget` tokens. The latest message is always kept.
+
+    Dropped messages are replaced by a short note; the system prompt is expected to
+    already carry the answers they contained (see collected_summary).
+
+    Returns (messages, usage) where usage has "prompt_tokens", "budgeted_prompt_tokens"
+    and "dropped_messages".
+    """
+    system = {"role": "system", "content": system_prompt}
+    costs = [_TOKENS_PER_MESSAGE + count_tokens(m["content"], model) for m in conversation_history]
+    base = _TOKENS_PER_REPLY + _TOKENS_PER_MESSAGE + count_tokens(system_prompt, model)
+    full = base + sum(costs)
+
+    total = full
+    start = 0
+    while start < len(conversation_history) - 1 and total > budget:
+        total -= costs[start]
+        start += 1
+
+    messages = [system]
+    if start:
+        note = {"role": "system", "content": f"({start} earlier messages omitted to save space.)"}
+        total += _TOKENS_PER_MESSAGE + count_tokens(note["content"], model)
+        messages.append(note)
+    messages.extend(conversation_history[start:])
+
+    usage = {"prompt_tokens": total, "budgeted_prompt_tokens": full, "dropped_messages": start}
+    context_stats.record(total, full, start)
+    return messages, usage
@@ -0,0 +1,197 @@
+import re
+import json
+from typing import Dict, List, Union
+
+# The model ends every conversation turn with this marker followed by a JSON object
+# of the fields answered in the patient's latest message. Everything before the
+# marker is the reply shown to the patient.
+FIELDS_MARKER = "###FIELDS###"
+
+REFUSED = "REFUSED"
+
+FIELDS_INSTRUCTIONS = f"""
+After your message, add a new line with the marker {FIELDS_MARKER} followed by a JSON object
+with the value of every field the user answered in their latest message, keyed by the field's "label".
+For example: {FIELDS_MARKER} {{"Mood": "Good"}}
+Use {FIELDS_MARKER} {{}} if they did not answer any field. The user never sees this part.
+"""
+
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.S)
+_BARE_WORD = re.compile(r"[A-Za-z_][\w ]*")
+_LITERALS = {"None": "null", "null": "null", "True": "true", "true": "true", "False": "false", "false": "false"}
+
+
+def _drop_trailing(out: List[str], tokens: str):
+    while out and (not out[-1].strip() or out[-1] in tokens):
+        out.pop()
+
+
+def _normalize_json(text: str) -> str:
+    """
+    Rewrite the object starting at text[0] as strict JSON where the fix is obvious:
+    single quotes, Python literals, unquoted keys and words, trailing commas, and
+    strings or brackets left open by a cut-off reply. Anything after the object
+    closes is dropped.
+    """
+    out: List[str] = []
+    closers: List[str] = []
+    quote = None
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if quote:
+            if c == "\\" and i + 1 < len(text):
+                out.append(c + text[i + 1])
+                i += 2
+                continue
+            if c == quote:
+                out.append('"')
+                quote = None
+            elif c == '"':
+                out.append('\\"')
+            elif c == "\n":
+                out.append("\\n")
+            else:
+                out.append(c)
+        elif c in "\"'":
+            quote = c
+            out.append('"')
+        elif c in "{[":
+            closers.append("}" if c == "{" else "]")
+            out.append(c)
+        elif c in "}]":
+            _drop_trailing(out, ",")
+            if closers:
+                out.append(closers.pop())
+            if not closers:
+                break
+        elif c.isalpha() or c == "_":
+            word = _BARE_WORD.match(text, i).group(0).rstrip()
+            out.append(_LITERALS.get(word, json.dumps(word)))
+            i += len(word)
+            continue
+        else:
+            out.append(c)
+        i += 1
+    if quote:
+        out.append('"')
+    _drop_trailing(out, ",:")
+    out.extend(reversed(closers))
+    return "".join(out)
+
+
+def repair_json(text: str) -> Union[Dict, None]:
+    """
+    The JSON object in a model reply, fixing what models commonly get wrong: code
+    fences and prose around the object, single quotes, Python literals, trailing
+    commas, unquoted keys, and a reply cut off before the object was closed (the
+    incomplete last entry is dropped). Returns None if no object can be recovered.
+    """
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    if start < 0:
+        return None
+    text = text[start:]
+    end = text.rfind("}")
+    candidates = [text[:end + 1]] if end >= 0 else []
+    normalized = _normalize_json(text)
+    candidates.append(normalized)
+    # A cut-off reply may end inside an entry: retry without it.
+    cut = normalized.rstrip("}]").rfind(",")
+    if cut > 0:
+        candidates.append(_normalize_json(normalized[:cut]))
+    for candidate in candidates:
+        try:
+            parsed = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(parsed, dict):
+            return parsed
+    return None
+
+
+def _parse_fields(text: str) -> Dict:
+    fields = repair_json(text.strip())
+    if fields is None:
+        print("Could not parse extracted fields:", text)
+        return {}
+    return fields
+
+
+def split_reply(content: str) -> tuple[str, Dict]:
+    """
+    Split a model reply into (text for the patient, extracted fields).
+    """
+    index = content.find(FIELDS_MARKER)
+    if index < 0:
+        return content, {}
+    return content[:index].rstrip(), _parse_fields(content[index + len(FIELDS_MARKER):])
+
+
+class ReplySplitter:
+    """
+    Incremental split_reply for streamed replies: feed() returns the text that is
+    safe to forward to the patient, holding back anything that could be the start
+    of the marker; finish() returns the rest and the extracted fields.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._tail = None
+
+    def feed(self, chunk: str) -> str:
+        if self._tail is not None:
+            self._tail += chunk
+            return ""
+        self._buffer += chunk
+        index = self._buffer.find(FIELDS_MARKER)
+        if index >= 0:
+            text = self._buffer[:index]
+            self._tail = self._buffer[index + len(FIELDS_MARKER):]
+            self._buffer = ""
+            return text
+        safe = len(self._buffer) - (len(FIELDS_MARKER) - 1)
+        if safe <= 0:
+            return ""
+        text, self._buffer = self._buffer[:safe], self._buffer[safe:]
+        return text
+
+    def finish(self) -> tuple[str, Dict]:
+        if self._tail is None:
+            return self._buffer, {}
+        return "", _parse_fields(self._tail)
+
+
+def merge_fields(inputs: List[Dict], filled: Union[Dict, None], extracted: Dict) -> Dict:
+    """
+    Return the session's filled fields updated with the ones extracted this turn.
+    Values are checked like the final parse (FormValidator.coerce); unknown labels
+    and values that don't fit the field are ignored.
+    """
+    # Imported here: form_schema builds on this module.
+    from langchain.form_schema import compile_form
+
+    validator = compile_form(inputs).validator
+    merged = dict(filled or {})
+    for label, value in extracted.items():
+        value = validator.coerce(label, value)
+        if value is not None:
+            merged[label] = value
+    return merged
+
+
+def is_complete(inputs: List[Dict], filled: Union[Dict, None]) -> bool:
+    """
+    Whether every input has an answer (or was refused).
+    """
+    return bool(inputs) and all(field["label"] in (filled or {}) for field in inputs)
+
+
+def assemble_result(inputs: List[Dict], filled: Union[Dict, None]) -> Dict:
+    """
+    The final result for a session: one key per input label, "" when unanswered.
+    """
+    return {field["label"]: (filled or {}).get(field["label"], "") for field in inputs}
@@ -0,0 +1,182 @@
+"""
+What the prompts and checks need from a form's `inputs`, built once per schema.
+
+A form's inputs only change when an admin edits the form, yet the parse
+instructions, the pending-inputs JSON of the turn prompt and the value checks used
+to be rebuilt on every call. compile_form() builds them once and caches them under
+inputs_hash(inputs), so any edit yields a new entry.
+
+FormValidator checks the model's final JSON against the schema: choices must be
+one of the values (matched leniently, like the local slot filling), numbers are
+read from strings ("about 7") and must fall in the description's range, and any
+spelling of REFUSED is normalized. A value that can't be fixed is left empty.
+
+answer_tokens is how long the model's JSON of all answers may get, which sizes the
+parse call's max_tokens (see langchain.routing).
+"""
+import os
+import json
+import hashlib
+import threading
+from typing import Dict, List, Union
+
+from langchain.context import count_tokens
+from langchain.extraction import REFUSED
+from langchain.slot_filling import match_choice, parse_number, within_range
+from lib.cache import TTLCache
+
+# Compiled forms kept in memory; entries are small and never go stale.
+COMPILED_FORM_CACHE_SIZE = int(os.getenv("COMPILED_FORM_CACHE_SIZE", "1024"))
+# Room given to the summary of a "string" answer in the parse reply.
+STRING_ANSWER_TOKENS = 80
+
+
+def inputs_hash(inputs: List[Dict]) -> str:
+    """
+    A stable hash of a form's input definitions.
+    """
+    canonical = json.dumps(inputs, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _parse_instructions(fields: List[Dict]) -> str:
+    return f"""
+    You are now a data parser. Please output valid JSON with the following fields, PAYING ATTENTION to the original instructions:
+    {'{'}
+    {
+        ''',
+        '''.join([
+            f'''"{field["label"]}": [value]
+            ''' for field in fields
+        ])
+    }
+    {'}'}
+
+    Where [value] is has the following types:
+
+    {'{'}
+    {
+        ''',
+        '''.join([
+            f'''"{field["label"]}": {f'[{",".join(field["data"]["values"])}]' if field["data"]["type"] == 'choice' else field["data"]["type"]}
+            ''' for field in fields
+        ])
+    }
+    {'}'}
+
+    If the user did not provide them, fill them with blank or 0.
+    "number" type fields must contain a numerical value, not a string.
+    "choice" type fields must contain one of the provided values in the origin request.
+    "string" type fields must contain a summary of the original result.
+
+    REMEMBER!!!! CHOICE FIELDS **MUST** CONTAIN ONE OF THE PROVIDED VALUES IN THE ORIGINAL REQUEST.
+    THERE WILL BE CRITICAL ERRORS IF THIS IS NOT FOLLOWED.
+    YOU MUST FIND THE VALUE PASSED THAT MOST CLOSELY MATCHES THE USER'S RESPONSE.
+
+    Return only valid JSON, no extra commentary.
+    """
+
+
+def _answer_tokens(fields: List[Dict]) -> int:
+    tokens = 2  # the braces
+    for field in fields:
+        data = field.get("data", {})
+        # The quoted label, colon, comma and whitespace.
+        tokens += count_tokens(json.dumps(field["label"], ensure_ascii=False)) + 3
+        if data.get("type") == "choice":
+            tokens += max((count_tokens(json.dumps(value, ensure_ascii=False)) for value in data.get("values", [])),
+                          default=4)
+        elif data.get("type") == "number":
+            tokens += 4
+        else:
+            tokens += STRING_ANSWER_TOKENS
+    return tokens
+
+
+class FormValidator:
+
+    def __init__(self, inputs: List[Dict]):
+        self.labels = [field["label"] for field in inputs]
+        self._fields = {field["label"]: field for field in inputs}
+
+    def coerce(self, label: str, value) -> Union[str, float, int, None]:
+        """
+        The value as the input's type, or None if it isn't a usable answer.
+        """
+        field = self._fields.get(label)
+        if field is None or value is None or isinstance(value, bool):
+            return None
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False)
+        if isinstance(value, str):
+            value = value.strip()
+            if not value:
+                return None
+            if value.strip(".!").upper() == REFUSED:
+                return REFUSED
+
+        data = field.get("data", {})
+        field_type = data.get("type")
+        if field_type == "number":
+            if isinstance(value, (int, float)):
+                return value if within_range(value, field.get("description", "")) else None
+            return parse_number(value, field.get("description", ""))
+        if field_type == "choice":
+            return match_choice(data.get("values", []), str(value))
+        return str(value)
+
+    def validate(self, parsed: Dict) -> tuple[Dict, List[str]]:
+        """
+        The result for a parsed reply: every label, "" where the value is missing or
+        unusable. Also returns the labels whose value had to be changed or dropped.
+        """
+        result = {}
+        fixed = []
+        for label in self.labels:
+            raw = parsed.get(label, "")
+            value = self.coerce(label, raw)
+            if value is None:
+                value = ""
+            if value != raw:
+                fixed.append(label)
+            result[label] = value
+        return result, fixed
+
+
+class CompiledForm:
+
+    def __init__(self, inputs: List[Dict], schema_hash: str):
+        self.inputs = inputs
+        self.schema_hash = schema_hash
+        self.parse_instructions = _parse_instructions(inputs)
+        self.answer_tokens = _answer_tokens(inputs)
+        self.validator = FormValidator(inputs)
+        self._requirements: Dict[frozenset, str] = {}
+        self._lock = threading.Lock()
+
+    def requirements(self, filled_fields: Union[Dict, None]) -> str:
+        """
+        The JSON of the inputs still to be answered, as given to the turn prompt.
+        """
+        answered = frozenset(label for label in (filled_fields or {}) if label in self.validator.labels)
+        with self._lock:
+            requirements = self._requirements.get(answered)
+            if requirements is None:
+                pending = [field for field in self.inputs if field["label"] not in answered]
+                requirements = self._requirements[answered] = json.dumps(pending)
+        return requirements
+
+
+_compiled = TTLCache(maxsize=COMPILED_FORM_CACHE_SIZE, ttl=float("inf"))
+
+
+def compile_form(inputs: List[Dict]) -> CompiledForm:
+    """
+    The compiled form for these inputs, built on first use.
+    """
+    key = inputs_hash(inputs)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = CompiledForm(inputs, key)
+        _compiled.set(key, compiled)
+    return compiled
@@ -1,32 +1,69 @@
-import os
-import openai
+import asyncio
 import json
 import datetime
-from typing import List, Dict
-from dotenv import load_dotenv
+from typing import AsyncIterator, List, Dict, Union
 
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from langchain.budget import get_ledger
+from langchain.context import LLM_PROMPT_TOKEN_BUDGET, count_message_tokens, count_tokens, fit_messages
+from langchain.extraction import FIELDS_INSTRUCTIONS, ReplySplitter, repair_json, split_reply
+from langchain.form_schema import compile_form
+from langchain.llm import LLMError, get_provider
+from langchain.routing import CHAT, EXTRACTION, LLM_MAX_TOKENS, LLM_MODEL, Route, get_router
+from langchain.scheduler import FINALIZATION, INTERACTIVE, get_scheduler
+from lib.metrics import registry
+from lib.tracing import span
 
+FINALIZE_PHRASE = "I have all the information I need. We can finalize now."
+GOODBYE_MESSAGE = "Goodbye! Have a great day!"
 
-def generateLlmResponse(
-    data_requirements: str,
-    userName: str,
-    conversation_history: List[Dict[str, str]]
-) -> tuple[str, bool]:
-    """
-    data_requirements: a JSON string describing the form inputs (e.g. choice, number, string).
-    conversation_history: the messages so far (user/assistant roles).
+_llm_tokens = registry.counter("llm_tokens_total", "Tokens sent to and received from the LLM.", ["type"])
+_parse_replies = registry.counter(
+    "llm_parse_replies_total", "Final parse replies by how their JSON was read.", ["result"])
+_parse_values_fixed = registry.counter(
+    "llm_parse_values_fixed_total", "Parsed values coerced to the input's type or dropped.")
 
-    The AI asks for all missing data until it says:
-    "I have all the information I need. We can finalize now."
+
+def _record_tokens(attrs: Dict, prompt_tokens: int, completion_tokens: int):
+    attrs["prompt_tokens"] = prompt_tokens
+    attrs["completion_tokens"] = completion_tokens
+    _llm_tokens.inc(prompt_tokens, type="prompt")
+    _llm_tokens.inc(completion_tokens, type="completion")
+
+
+async def _route(task: str, tenant: str, priority: str, prompt_tokens: int,
+                 answer_tokens: int = LLM_MAX_TOKENS) -> Route:
+    """
+    Check the tenant's token budgets (raises BudgetExceeded) and pick the call's model.
     """
+    ledger = get_ledger()
+    await ledger.check(tenant, priority)
+    return get_router().route(task, prompt_tokens, answer_tokens, ledger.share(tenant))
+
 
-    system_prompt = f"""
+async def _closing_provider(call):
+    # For the sync wrappers: their event loop ends with asyncio.run(), so the
+    # provider's connections opened on it are closed before it does.
+    try:
+        return await call
+    finally:
+        await get_provider().aclose()
+
+
+def _total_tokens(completion_usage: Dict, estimate: int) -> int:
+    # What a call actually used, or the estimate it was admitted with if not reported.
+    if "prompt_tokens" not in completion_usage:
+        return estimate
+    return completion_usage["prompt_tokens"] + completion_usage.get("completion_tokens", 0)
+
+
+# The turn's system prompt, split around its per-call parts (the pending inputs, the
+# patient's name and the answers collected) so only those are filled in per call.
+_CHAT_PROMPT_HEAD = """
 You are a compassionate clinical-trial AI assistant, speaking directly to the patient.
 Below is the form structure we want to collect data for (in JSON):
 
-{data_requirements}
+"""
+_CHAT_PROMPT_RULES = """
 
 - If the user's answer is incomplete or unclear, politely ask for clarification.
 - If the user is reluctant or cannot provide specifics, give examples or suggestions.
@@ -43,8 +80,12 @@ Be empathetic, but thorough.
 
 Make sure to refer to the user personally, (preferably by their first name) instead of referring to them as a "patient" or "user".
 
-User's name: {userName}
-
+User's name: """
+_COLLECTED_SECTION = """
+Information already collected (do not ask for it again):
+{collected}
+"""
+_CHAT_PROMPT_TAIL = f"""
 #IMPORTANT: DONT IGNORE THIS
 NEVER EVER EVER EVER reference the user as "the patient" or "the user". Always use their name.
 NUMBER FIELDS MUST CONTAIN A NUMERICAL VALUE, NOT A STRING.
@@ -52,116 +93,293 @@ CHOICE FIELDS **MUST** CONTAIN ONE OF THE PROVIDED VALUES IN THE ORIGINAL REQUES
 IF A PATIENT REFUSES CONTINUOUSLY, WRITE "REFUSED" INSTEAD OF A VALUE AS A **LAST RESORT**.
 
 Also: Make sure to only ask one question at a time, as to not overwhelm the user! :)
-"""
+{FIELDS_INSTRUCTIONS}"""
 
-    messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(conversation_history)
 
-    if len(conversation_history) > 0 and "goodbye" in conversation_history[-1]["content"].lower():
-        return "Goodbye! Have a great day!", True
+def _build_chat_messages(
+    data_requirements: str,
+    userName: str,
+    conversation_history: List[Dict[str, str]],
+    collected: str = "",
+    usage: Union[Dict, None] = None
+) -> List[Dict[str, str]]:
+    """
+    Build the message list (system prompt + history) sent for a conversation turn.
 
-    try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0.2,
-            max_tokens=300
-        )
-        done = False
-        for message in completion.choices: #type: ignore
-            if "I have all the information I need. We can finalize now." in message.message.content:
-                done = True
-                break
-        return completion.choices[0].message.content, done #type: ignore
-    except Exception as e:
-        return f"Error calling OpenAI: {str(e)}", False
+    The history is trimmed from the oldest message to keep the prompt under
+    LLM_PROMPT_TOKEN_BUDGET; `collected` (answers gathered so far) stands in for the
+    dropped exchanges. Prompt size figures are written into `usage` if given.
+    """
 
+    collected_section = ""
+    if collected:
+        collected_section = _COLLECTED_SECTION.format(collected=collected)
 
-def parse_final_conversation_to_json(
+    system_prompt = (_CHAT_PROMPT_HEAD + data_requirements + _CHAT_PROMPT_RULES + userName + "\n"
+                     + collected_section + _CHAT_PROMPT_TAIL)
+
+    messages, prompt_usage = fit_messages(system_prompt, conversation_history, LLM_PROMPT_TOKEN_BUDGET)
+    if usage is not None:
+        usage.update(prompt_usage)
+    return messages
+
+
+def _said_goodbye(conversation_history: List[Dict[str, str]]) -> bool:
+    return len(conversation_history) > 0 and "goodbye" in conversation_history[-1]["content"].lower()
+
+
+def _read_chat_completion(completion, usage: Union[Dict, None] = None,
+                          fields: Union[Dict, None] = None) -> tuple[str, bool]:
+    if usage is not None and completion.get("usage"):
+        usage["completion_tokens"] = completion["usage"]["completion_tokens"]
+    done = False
+    for choice in completion["choices"]:
+        if FINALIZE_PHRASE in choice["message"]["content"]:
+            done = True
+            break
+    reply, extracted = split_reply(completion["choices"][0]["message"]["content"])
+    if fields is not None:
+        fields.update(extracted)
+    return reply, done
+
+
+def generateLlmResponse(
+    data_requirements: str,
+    userName: str,
     conversation_history: List[Dict[str, str]],
-    fields: List[Dict[str, object]]
-) -> Dict:
+    collected: str = "",
+    usage: Union[Dict, None] = None,
+    fields: Union[Dict, None] = None
+) -> tuple[str, bool]:
+    """
+    data_requirements: a JSON string describing the form inputs (e.g. choice, number, string).
+    conversation_history: the messages so far (user/assistant roles).
+    collected: optional JSON string of the answers already collected.
+    usage: optional dict that receives prompt/completion token counts for the turn.
+    fields: optional dict that receives the field values extracted from the patient's
+            latest message ({label: value}), reported by the model after FIELDS_MARKER.
+
+    The AI asks for all missing data until it says:
+    "I have all the information I need. We can finalize now."
+
+    Raises LLMError if no completion could be obtained.
     """
-    1) Takes the entire conversation (AI said "I have all the information I need. We can finalize now.").
-    2) parse_instructions: Tells GPT how to produce final JSON with keys = fieldnames.
-    3) fieldnames: The keys we expect in the final JSON.
 
-    Returns a JSON string with those keys, or empty if not provided.
+    call = agenerateLlmResponse(data_requirements, userName, conversation_history, collected, usage, fields)
+    return asyncio.run(_closing_provider(call))
+
+
+async def agenerateLlmResponse(
+    data_requirements: str,
+    userName: str,
+    conversation_history: List[Dict[str, str]],
+    collected: str = "",
+    usage: Union[Dict, None] = None,
+    fields: Union[Dict, None] = None,
+    priority: str = INTERACTIVE,
+    tenant: str = "",
+    deadline: Union[float, None] = None
+) -> tuple[str, bool]:
     """
+    Async version of generateLlmResponse for the API request path.
+
+    Awaits the completion instead of blocking a worker thread. The call is admitted by
+    the process-wide LLM scheduler (langchain.scheduler) as `priority`, queued with
+    the other calls of `tenant` (e.g. "admin_id/form_id"), sent to the model picked by
+    langchain.routing and counted against the tenant's token budgets (langchain.budget).
+    The model is written into `usage`.
 
-    parse_instructions = f"""
-    You are now a data parser. Please output valid JSON with the following fields, PAYING ATTENTION to the original instructions:
-    {'{'}
-    {
-        ''',
-        '''.join([
-            f'''"{field["label"]}": [value]
-            ''' for field in fields
-        ])
-    }
-    {'}'}
+    `deadline` (a time.monotonic() value) bounds the completion, retries included, and
+    is handed to the provider; by default it is LLM_TIMEOUT from when the scheduler
+    admits the call.
+    """
 
-    Where [value] is has the following types:
+    usage = usage if usage is not None else {}
+    messages = _build_chat_messages(data_requirements, userName, conversation_history, collected, usage)
+
+    if _said_goodbye(conversation_history):
+        return GOODBYE_MESSAGE, True
+
+    route = await _route(CHAT, tenant, priority, usage["prompt_tokens"])
+    usage["model"] = route.model
+    estimate = usage["prompt_tokens"] + route.max_tokens
+    async with get_scheduler().slot(priority, tenant, estimate) as admission:
+        with span("llm", "chat") as attrs:
+            attrs["model"] = route.model
+            completion = await get_provider().complete(messages, route.model, temperature=0.2,
+                                                       max_tokens=route.max_tokens, deadline=deadline)
+            completion_usage = completion.get("usage") or {}
+            _record_tokens(attrs, completion_usage.get("prompt_tokens", 0),
+                           completion_usage.get("completion_tokens", 0))
+        admission.settle(_total_tokens(completion_usage, estimate))
+    await get_ledger().record(tenant, route.model, completion_usage.get("prompt_tokens", usage["prompt_tokens"]),
+                              completion_usage.get("completion_tokens", 0))
+    try:
+        return _read_chat_completion(completion, usage, fields)
+    except (KeyError, IndexError, TypeError) as e:
+        raise LLMError(f"Malformed completion: {e!r}")
 
-    {'{'}
-    {
-        ''',
-        '''.join([
-            f'''"{field["label"]}": {f'[{",".join(field["data"]["values"])}]' if field["data"]["type"] == 'choice' else field["data"]["type"]}
-            ''' for field in fields
-        ])
-    }
-    {'}'}
 
-    If the user did not provide them, fill them with blank or 0.
-    "number" type fields must contain a numerical value, not a string.
-    "choice" type fields must contain one of the provided values in the origin request.
-    "string" type fields must contain a summary of the original result.
+async def astreamLlmResponse(
+    data_requirements: str,
+    userName: str,
+    conversation_history: List[Dict[str, str]],
+    collected: str = "",
+    usage: Union[Dict, None] = None,
+    fields: Union[Dict, None] = None,
+    priority: str = INTERACTIVE,
+    tenant: str = "",
+    deadline: Union[float, None] = None
+) -> AsyncIterator[str]:
+    """
+    Streaming version of agenerateLlmResponse.
 
-    REMEMBER!!!! CHOICE FIELDS **MUST** CONTAIN ONE OF THE PROVIDED VALUES IN THE ORIGINAL REQUEST.
-    THERE WILL BE CRITICAL ERRORS IF THIS IS NOT FOLLOWED.
-    YOU MUST FIND THE VALUE PASSED THAT MOST CLOSELY MATCHES THE USER'S RESPONSE.
+    Yields the assistant's reply as text chunks while the completion is generated
+    (stream=True, like prompt_experiments.daily_diary_chat). The caller assembles the
+    chunks and checks the result for FINALIZE_PHRASE. The extracted fields are held
+    back from the stream and written into `fields` once it ends.
 
-    Return only valid JSON, no extra commentary.
+    Raises LLMError if the completion fails, possibly after some chunks were yielded,
+    or if it doesn't end by `deadline`.
     """
 
-    print(parse_instructions)
+    usage = usage if usage is not None else {}
+    messages = _build_chat_messages(data_requirements, userName, conversation_history, collected, usage)
+
+    if _said_goodbye(conversation_history):
+        yield GOODBYE_MESSAGE
+        return
+
+    route = await _route(CHAT, tenant, priority, usage["prompt_tokens"])
+    usage["model"] = route.model
+    estimate = usage["prompt_tokens"] + route.max_tokens
+    async with get_scheduler().slot(priority, tenant, estimate) as admission:
+        with span("llm", "chat_stream") as attrs:
+            attrs["model"] = route.model
+            splitter = ReplySplitter()
+            reply = []
+            async for chunk in get_provider().stream(messages, route.model, temperature=0.2,
+                                                     max_tokens=route.max_tokens, deadline=deadline):
+                reply.append(chunk)
+                chunk_text = splitter.feed(chunk)
+                if chunk_text:
+                    yield chunk_text
+            # Streamed completions carry no usage, so count locally.
+            completion_tokens = count_tokens("".join(reply), route.model)
+            _record_tokens(attrs, usage["prompt_tokens"], completion_tokens)
+            usage["completion_tokens"] = completion_tokens
+        admission.settle(usage["prompt_tokens"] + completion_tokens)
+        await get_ledger().record(tenant, route.model, usage["prompt_tokens"], completion_tokens)
+        chunk_text, extracted = splitter.finish()
+        if chunk_text:
+            yield chunk_text
+        if fields is not None:
+            fields.update(extracted)
+
+
+def _build_parse_messages(
+    conversation_history: List[Dict[str, str]],
+    fields: List[Dict[str, object]]
+) -> List[Dict[str, str]]:
+    """
+    Build the message list asking the model to turn a finished conversation into JSON.
+    """
+
+    parse_instructions = compile_form(fields).parse_instructions
 
     # Combine conversation + system instructions
     parse_messages = conversation_history + [
         {"role": "system", "content": parse_instructions}
     ]
+    return parse_messages
 
-    try:
-        parse_completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=parse_messages,
-            temperature=0.4,
-            max_tokens=300
-        )
-        json_reply = parse_completion.choices[0].message.content.strip()
-    except Exception as e:
-        print("Error calling OpenAI for parsing:", str(e))
-        raise e
 
+def _read_parse_reply(
+    json_reply: str,
+    fields: List[Dict[str, object]]
+) -> Dict:
+    """
+    The result in a parse reply, checked against the form (see FormValidator).
+    Malformed JSON is repaired locally where possible; raises LLMError if it can't be.
+    """
     try:
         parsed_data = json.loads(json_reply)
-    except json.JSONDecodeError as e:
+        result = "valid"
+    except json.JSONDecodeError:
+        parsed_data = None
+    if not isinstance(parsed_data, dict):
+        parsed_data = repair_json(json_reply)
+        result = "repaired"
+    if parsed_data is None:
+        _parse_replies.inc(result="unparseable")
         print("Could not parse JSON. GPT reply:", json_reply)
-        raise e
-
-    # Fill missing fields with ""
-    fieldnames = [field['label'] for field in fields]
-    output = {}
-    for fn in fieldnames:
-        output[fn] = parsed_data.get(fn, "")
+        raise LLMError("The model's parse reply is not a JSON object")
+    _parse_replies.inc(result=result)
 
+    output, fixed = compile_form(fields).validator.validate(parsed_data)
+    if fixed:
+        _parse_values_fixed.inc(len(fixed))
     return output
 
 
+def parse_final_conversation_to_json(
+    conversation_history: List[Dict[str, str]],
+    fields: List[Dict[str, object]]
+) -> Dict:
+    """
+    1) Takes the entire conversation (AI said "I have all the information I need. We can finalize now.").
+    2) fields: the form inputs; the parse instructions are built from them (see compile_form).
+
+    Returns a dict keyed by input label, checked against the form (see FormValidator).
+    Raises LLMError if the model's reply can't be read as JSON.
+    """
+
+    return asyncio.run(_closing_provider(aparse_final_conversation_to_json(conversation_history, fields)))
+
+
+async def aparse_final_conversation_to_json(
+    conversation_history: List[Dict[str, str]],
+    fields: List[Dict[str, object]],
+    priority: str = FINALIZATION,
+    tenant: str = "",
+    deadline: Union[float, None] = None
+) -> Dict:
+    """
+    Async version of parse_final_conversation_to_json; returns the same dict. Admitted
+    by the LLM scheduler, routed and budgeted like agenerateLlmResponse, by default
+    behind the interactive calls. The reply may be as long as the form's answers need.
+    `deadline` works as in agenerateLlmResponse.
+    """
+
+    parse_messages = _build_parse_messages(conversation_history, fields)
+    prompt_tokens = count_message_tokens(parse_messages, LLM_MODEL)
+
+    try:
+        route = await _route(EXTRACTION, tenant, priority, prompt_tokens, compile_form(fields).answer_tokens)
+        estimate = prompt_tokens + route.max_tokens
+        async with get_scheduler().slot(priority, tenant, estimate) as admission:
+            with span("llm", "parse") as attrs:
+                attrs["model"] = route.model
+                parse_completion = await get_provider().complete(parse_messages, route.model,
+                                                                 temperature=0.4, max_tokens=route.max_tokens,
+                                                                 deadline=deadline)
+                parse_usage = parse_completion.get("usage") or {}
+                _record_tokens(attrs, parse_usage.get("prompt_tokens", 0),
+                               parse_usage.get("completion_tokens", 0))
+            admission.settle(_total_tokens(parse_usage, estimate))
+        await get_ledger().record(tenant, route.model, parse_usage.get("prompt_tokens", prompt_tokens),
+                                  parse_usage.get("completion_tokens", 0))
+        json_reply = parse_completion["choices"][0]["message"]["content"].strip()
+    except Exception as e:
+        print("Error calling the LLM for parsing:", str(e))
+        raise e
+
+    return _read_parse_reply(json_reply, fields)
+
+
 if __name__ == "__main__":
-    # 1) form_inputs describing each field. 
-    #    The 'description' will become the final JSON key (no hard-coding).
+    # 1) form_inputs describing each field.
+    #    The 'label' becomes the key in the parsed result (no hard-coding).
     form_inputs = [
         {
             "label": "Mood",
@@ -198,37 +416,17 @@ if __name__ == "__main__":
         conversation.append({"role": "user", "content": user_input})
 
         # Generate next AI message
-        ai_response = generateLlmResponse(data_requirements, conversation)
+        ai_response, done = generateLlmResponse(data_requirements, "Patient", conversation)
         print("AI:", ai_response)
 
         conversation.append({"role": "assistant", "content": ai_response})
 
-        # 3) If the AI says "I have all the information I need. We can finalize now."
-        if "I have all the information I need. We can finalize now." in ai_response:
+        # 3) The AI said "I have all the information I need. We can finalize now."
+        if done:
             print("\nAI indicated it's satisfied. Let's parse final conversation.")
 
-            # 4) Build parse instructions + dynamic keys from form_inputs
-            #    We'll use the 'description' as the final JSON key for each item
-            #    So if we have N items, we produce N keys in our final JSON.
-
-            # Build a minimal JSON object template from each 'description'
-            # e.g. { "Your mood today (pick one):": "", "How many hours did you sleep last night? (0-12+)": "", ... }
-            parse_instructions = "You are now a data parser. Please output valid JSON with these keys:\n{\n"
-            for item in form_inputs:
-                key = item["label"]
-                parse_instructions += f'  "{key}": "",\n'
-            parse_instructions += """}
-If the user did not provide them, fill them with blank or 0. Return only valid JSON, no extra commentary.
-"""
-
-            # Our final 'fieldnames' is just the list of descriptions from form_inputs
-            schema_fields = [item["label"] for item in form_inputs]
-
-            final_data = parse_final_conversation_to_json(
-                conversation_history=conversation,
-                parse_instructions=parse_instructions,
-                fieldnames=schema_fields
-            )
+            # 4) The parse instructions and the result's keys come from form_inputs
+            final_data = parse_final_conversation_to_json(conversation, form_inputs)
 
             print("Parsed as dict:", final_data)
 
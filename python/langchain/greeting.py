@@ -0,0 +1,56 @@
+"""
+Opening questions, generated once per form schema instead of once per session.
+
+The first question of a session only depends on the form's inputs and the patient's
+name. It is generated with a placeholder in place of the name, cached under a hash
+of the inputs (so any edit to the form yields a new key), and the name is filled in
+locally for every session. A reply that doesn't address the patient through the
+placeholder exactly once is replaced by a static question about the first input.
+"""
+import re
+import json
+from typing import Dict, List, Union
+
+from langchain.genericLLMFunction import FINALIZE_PHRASE, agenerateLlmResponse
+from langchain.slot_filling import field_question
+
+# Stands in for the patient's first name while the template is generated.
+NAME_PLACEHOLDER = "{first_name}"
+
+
+async def agenerate_greeting(inputs: List[Dict], usage: Union[Dict, None] = None, tenant: str = "") -> str:
+    """
+    Generate the opening question for a form, addressing the patient as NAME_PLACEHOLDER.
+
+    Raises LLMError if the model is unavailable, and ValueError if the reply can't be
+    reused for other patients.
+    """
+    greeting, _ = await agenerateLlmResponse(json.dumps(inputs), NAME_PLACEHOLDER, [], usage=usage, tenant=tenant)
+    greeting = greeting.strip()
+    if not greeting or FINALIZE_PHRASE in greeting:
+        raise ValueError(f"Unusable opening question: {greeting!r}")
+    # Anything else in braces would be sent to every patient as is.
+    if re.findall(r"\{[^{}]*\}", greeting) != [NAME_PLACEHOLDER]:
+        raise ValueError(f"Opening question doesn't address the patient once by {NAME_PLACEHOLDER}: {greeting!r}")
+    return greeting
+
+
+def static_greeting(inputs: List[Dict]) -> str:
+    """
+    An opening question template asking for the first input, for when the model's
+    reply can't be used.
+    """
+    return f"Hi {NAME_PLACEHOLDER}! 👋 {field_question(inputs[0])}"
+
+
+def render_greeting(template: str, name: Union[str, None]) -> str:
+    """
+    Fill the patient's first name into an opening question template.
+    """
+    first_name = (name or "").split(" ")[0]
+    if first_name:
+        return template.replace(NAME_PLACEHOLDER, first_name)
+    # No name on record: drop the placeholder along with its leading separator.
+    for separator in (", ", " "):
+        template = template.replace(separator + NAME_PLACEHOLDER, "")
+    return template.replace(NAME_PLACEHOLDER, "")
@@ -0,0 +1,287 @@
+"""
+Chat completion backends.
+
+The API talks to the model through an LLMProvider instead of the module-global
+openai client. OpenAICompatibleProvider speaks the OpenAI /chat/completions wire
+format over one pooled httpx client (so connections and TLS sessions are reused),
+with a deadline per call, jittered exponential backoff on 429/5xx and connection
+errors, and optional hedging: if an attempt is still running after `hedge_after`
+seconds a second one is started and the first to answer wins.
+
+Set LLM_BASE_URL to point it at any compatible server, e.g. the local stub in
+langchain/stub_server.py for offline load tests.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Union
+
+import httpx
+
+from lib.metrics import registry
+
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://api.openai.com/v1")
+# Total time budget of one call, retries included, and of a single attempt.
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "20"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+# Start a hedged duplicate request after this many seconds (0 disables hedging).
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "0"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+
+_retries = registry.counter("llm_retries_total", "LLM attempts retried, by status (0 for network errors).", ["status"])
+_hedges = registry.counter("llm_hedged_requests_total", "Hedged duplicate LLM requests started.")
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# Failures worth another attempt (unlike e.g. an invalid request).
+_RETRY_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+class LLMError(Exception):
+    """
+    The model could not produce a completion (after retries, or within the deadline).
+    """
+
+    def __init__(self, message: str, status_code: Union[int, None] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _RetryableError(LLMError):
+    def __init__(self, message: str, status_code: Union[int, None] = None, retry_after: Union[float, None] = None):
+        super().__init__(message, status_code)
+        self.retry_after = retry_after
+
+
+class LLMProvider(ABC):
+    """
+    Interface of a chat completion backend. A backend missing complete() or
+    stream() can't be instantiated.
+    """
+
+    @abstractmethod
+    async def complete(self, messages: List[Dict[str, str]], model: str, temperature: float,
+                       max_tokens: int, deadline: Union[float, None] = None) -> Dict:
+        """
+        Return the completion as an OpenAI-style response dict ("choices", "usage").
+        """
+
+    @abstractmethod
+    def stream(self, messages: List[Dict[str, str]], model: str, temperature: float,
+               max_tokens: int, deadline: Union[float, None] = None) -> AsyncIterator[str]:
+        """
+        Yield the completion's text as it is generated.
+        """
+
+    async def warmup(self):
+        """
+        Open a connection ahead of the first call.
+        """
+
+    async def aclose(self):
+        pass
+
+
+class OpenAICompatibleProvider(LLMProvider):
+
+    def __init__(self, base_url: str = LLM_BASE_URL, api_key: Union[str, None] = None,
+                 timeout: float = LLM_TIMEOUT, attempt_timeout: float = LLM_ATTEMPT_TIMEOUT,
+                 max_retries: int = LLM_MAX_RETRIES, backoff_base: float = LLM_BACKOFF_BASE,
+                 backoff_max: float = LLM_BACKOFF_MAX, hedge_after: float = LLM_HEDGE_AFTER,
+                 max_connections: int = LLM_MAX_CONNECTIONS,
+                 transport: Union[httpx.AsyncBaseTransport, None] = None):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key if api_key is not None else os.getenv("OPENAI_API_KEY", "")
+        self.timeout = timeout
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.max_connections = max_connections
+        # httpx.MockTransport in tests; None for the network.
+        self.transport = transport
+        self._client: Union[httpx.AsyncClient, None] = None
+        self._loop = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on first use, so it binds to the running event loop; sync callers
+        # that go through asyncio.run() get a fresh one per loop.
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._close_stale_client()
+            self._loop = loop
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"} if self.api_key else {},
+                timeout=httpx.Timeout(self.attempt_timeout, connect=5.0),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                transport=self.transport,
+            )
+        return self._client
+
+    def _close_stale_client(self):
+        # The old client's connections belong to the loop it was created on, so it can
+        # only be closed there. A closed loop can't run anything anymore: callers that
+        # end their loop (the sync wrappers) call aclose() before it does.
+        if self._client is not None and not self._loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop)
+        self._client = None
+        self._loop = None
+
+    async def warmup(self):
+        # Any answer will do: the point is the TLS handshake and a pooled connection.
+        await self.client.get("/models")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._loop = None
+
+    def _backoff(self, attempt: int, retry_after: Union[float, None]) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        # Full jitter, but never earlier than the server asked for.
+        return max(retry_after or 0.0, random.uniform(0, delay))
+
+    @staticmethod
+    def _check(response: httpx.Response):
+        if response.status_code in RETRY_STATUS:
+            retry_after = response.headers.get("retry-after")
+            try:
+                retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                retry_after = None
+            raise _RetryableError(f"LLM backend returned {response.status_code}",
+                                  response.status_code, retry_after)
+        if response.status_code >= 400:
+            raise LLMError(f"LLM backend returned {response.status_code}: {response.text[:200]}",
+                           response.status_code)
+
+    async def _attempt(self, body: Dict) -> Dict:
+        try:
+            response = await self.client.post("/chat/completions", json=body)
+        except _RETRY_ERRORS as e:
+            raise _RetryableError(f"LLM request failed: {e!r}")
+        except httpx.HTTPError as e:
+            raise LLMError(f"LLM request failed: {e!r}")
+        self._check(response)
+        return response.json()
+
+    async def _hedged_attempt(self, body: Dict) -> Dict:
+        if not self.hedge_after:
+            return await self._attempt(body)
+        first = asyncio.ensure_future(self._attempt(body))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+        _hedges.inc()
+        second = asyncio.ensure_future(self._attempt(body))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _with_retries(self, make_attempt, deadline: float):
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMError("LLM call exceeded its deadline")
+            try:
+                return await asyncio.wait_for(make_attempt(), remaining)
+            except asyncio.TimeoutError:
+                raise LLMError("LLM call exceeded its deadline")
+            except _RetryableError as e:
+                if attempt >= self.max_retries:
+                    raise LLMError(str(e), e.status_code)
+                delay = self._backoff(attempt, e.retry_after)
+                if time.monotonic() + delay >= deadline:
+                    raise LLMError(str(e), e.status_code)
+                attempt += 1
+                _retries.inc(status=e.status_code or 0)
+                await asyncio.sleep(delay)
+
+    async def complete(self, messages: List[Dict[str, str]], model: str, temperature: float,
+                       max_tokens: int, deadline: Union[float, None] = None) -> Dict:
+        body = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        deadline = deadline or time.monotonic() + self.timeout
+        return await self._with_retries(lambda: self._hedged_attempt(body), deadline)
+
+    async def stream(self, messages: List[Dict[str, str]], model: str, temperature: float,
+                     max_tokens: int, deadline: Union[float, None] = None) -> AsyncIterator[str]:
+        body = {"model": model, "messages": messages, "temperature": temperature,
+                "max_tokens": max_tokens, "stream": True}
+        deadline = deadline or time.monotonic() + self.timeout
+
+        # Retries only happen before the first chunk; once text was forwarded a failure
+        # can't be hidden from the caller anymore.
+        async def open_stream():
+            request = self.client.build_request("POST", "/chat/completions", json=body)
+            try:
+                response = await self.client.send(request, stream=True)
+            except _RETRY_ERRORS as e:
+                raise _RetryableError(f"LLM request failed: {e!r}")
+            except httpx.HTTPError as e:
+                raise LLMError(f"LLM request failed: {e!r}")
+            if response.status_code >= 400:
+                await response.aread()
+                await response.aclose()
+                self._check(response)
+            return response
+
+        response = await self._with_retries(open_stream, deadline)
+        try:
+            async for line in response.aiter_lines():
+                if time.monotonic() > deadline:
+                    raise LLMError("LLM stream exceeded its deadline")
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                text = chunk["choices"][0].get("delta", {}).get("content")
+                if text:
+                    yield text
+        except httpx.HTTPError as e:
+            raise LLMError(f"LLM stream failed: {e!r}")
+        finally:
+            await response.aclose()
+
+
+_provider: Union[LLMProvider, None] = None
+
+
+def get_provider() -> LLMProvider:
+    """
+    The process-wide provider, created from the LLM_* environment on first use.
+    """
+    global _provider
+    if _provider is None:
+        _provider = OpenAICompatibleProvider()
+    return _provider
+
+
+def set_provider(provider: LLMProvider):
+    """
+    Replace the process-wide provider (e.g. with a stub for tests and benchmarks).
+    """
+    global _provider
+    _provider = provider
@@ -0,0 +1,117 @@
+"""
+Which model answers an LLM call, and how long its reply may be.
+
+Every call used to go to one model with max_tokens=300, which is now LLM_MAX_TOKENS
+for chat turns. The prompt of each call is counted locally before it is sent
+(langchain.context.count_tokens), and ModelRouter picks the model from that count:
+
+    chat turn     LLM_SMALL_MODEL while the prompt is at most LLM_SMALL_CHAT_PROMPT_TOKENS
+                  (short clarification turns, the opening question), else LLM_MODEL
+    extraction    LLM_SMALL_MODEL unless the prompt exceeds LLM_SMALL_CONTEXT_TOKENS
+    any call      LLM_SMALL_MODEL once its form or admin used LLM_BUDGET_DOWNGRADE_SHARE
+                  of their token budget (see langchain.budget), if the prompt fits
+
+LLM_SMALL_MODEL defaults to LLM_MODEL, so routing changes nothing until a cheaper
+model is configured. Extraction replies are given room for the form's answers
+(CompiledForm.answer_tokens) up to LLM_PARSE_MAX_TOKENS instead of LLM_MAX_TOKENS.
+
+Decisions are counted in llm_routed_calls_total{task, model, reason}.
+"""
+import os
+import threading
+from typing import Dict, Union
+
+from lib.metrics import registry
+
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-3.5-turbo")
+LLM_SMALL_MODEL = os.getenv("LLM_SMALL_MODEL") or LLM_MODEL
+# Completion length cap of a chat turn; also what admission control reserves for it.
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "300"))
+LLM_PARSE_MAX_TOKENS = int(os.getenv("LLM_PARSE_MAX_TOKENS", "1500"))
+LLM_SMALL_CHAT_PROMPT_TOKENS = int(os.getenv("LLM_SMALL_CHAT_PROMPT_TOKENS", "2000"))
+# Largest prompt (plus reply) the small model is given at all.
+LLM_SMALL_CONTEXT_TOKENS = int(os.getenv("LLM_SMALL_CONTEXT_TOKENS", "12000"))
+LLM_BUDGET_DOWNGRADE_SHARE = float(os.getenv("LLM_BUDGET_DOWNGRADE_SHARE", "0.8"))
+
+CHAT = "chat"
+EXTRACTION = "extraction"
+
+_routed = registry.counter(
+    "llm_routed_calls_total", "LLM calls by task, the model they were sent to and why.", ["task", "model", "reason"])
+
+
+class Route:
+    """
+    The model and completion cap chosen for one call.
+    """
+
+    def __init__(self, model: str, max_tokens: int, reason: str):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.reason = reason
+
+
+class ModelRouter:
+
+    def __init__(self, model: str = LLM_MODEL, small_model: str = LLM_SMALL_MODEL,
+                 small_chat_prompt_tokens: int = LLM_SMALL_CHAT_PROMPT_TOKENS,
+                 small_context_tokens: int = LLM_SMALL_CONTEXT_TOKENS,
+                 downgrade_share: float = LLM_BUDGET_DOWNGRADE_SHARE):
+        self.model = model
+        self.small_model = small_model
+        self.small_chat_prompt_tokens = small_chat_prompt_tokens
+        self.small_context_tokens = small_context_tokens
+        self.downgrade_share = downgrade_share
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Dict[str, int]] = {}  # task -> "model reason" -> calls
+
+    def route(self, task: str, prompt_tokens: int, answer_tokens: int = LLM_MAX_TOKENS,
+              budget_share: float = 0.0) -> Route:
+        """
+        The route of a `task` call with a prompt of `prompt_tokens` and a reply of up
+        to `answer_tokens`, for a tenant that used `budget_share` of its budget.
+        """
+        max_tokens = LLM_MAX_TOKENS if task == CHAT else min(LLM_PARSE_MAX_TOKENS, max(LLM_MAX_TOKENS, answer_tokens))
+        fits_small = prompt_tokens + max_tokens <= self.small_context_tokens
+        if not fits_small:
+            model, reason = self.model, "long_context"
+        elif self.downgrade_share and budget_share >= self.downgrade_share:
+            model, reason = self.small_model, "budget"
+        elif task == EXTRACTION:
+            model, reason = self.small_model, "extraction"
+        elif prompt_tokens <= self.small_chat_prompt_tokens:
+            model, reason = self.small_model, "short_context"
+        else:
+            model, reason = self.model, "long_context"
+
+        _routed.inc(task=task, model=model, reason=reason)
+        with self._lock:
+            task_counts = self._counts.setdefault(task, {})
+            key = f"{model} {reason}"
+            task_counts[key] = task_counts.get(key, 0) + 1
+        return Route(model, max_tokens, reason)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {task: dict(counts) for task, counts in self._counts.items()}
+
+
+_router: Union[ModelRouter, None] = None
+
+
+def get_router() -> ModelRouter:
+    """
+    The process-wide router, created from the LLM_* environment on first use.
+    """
+    global _router
+    if _router is None:
+        _router = ModelRouter()
+    return _router
+
+
+def set_router(router: ModelRouter):
+    """
+    Replace the process-wide router (e.g. with other models for a benchmark).
+    """
+    global _router
+    _router = router
@@ -0,0 +1,286 @@
+"""
+Process-wide scheduling of LLM calls.
+
+Every completion shares the same account rate limits, whether it answers a patient,
+parses a finished session or re-parses results in bulk. LLMScheduler admits calls
+under token buckets for requests/min (LLM_RPM) and tokens/min (LLM_TPM) and a cap on
+calls in flight (LLM_MAX_CONCURRENCY), in priority order:
+
+    interactive > finalization > batch
+
+A waiting call is never overtaken by one of a lower class, and the lower classes
+leave part of each bucket unused (PRIORITY_RESERVE), so a burst of finalizations
+can't use up the limit live patients need. Within a class, callers are queued per
+tenant (admin/form) and served round-robin, so one busy form doesn't hold up the
+others. Each class queues at most LLM_MAX_QUEUED calls; beyond that a call fails
+right away with LLMError(status_code=429) instead of waiting indefinitely.
+
+A call is admitted with its estimated tokens (prompt + max_tokens) and settled with
+the actual count once it finished.
+"""
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Union
+
+from langchain.llm import LLMError
+from lib.metrics import registry
+
+INTERACTIVE = "interactive"
+FINALIZATION = "finalization"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, FINALIZATION, BATCH)
+
+# Share of each bucket a class may not use, kept for the classes above it.
+PRIORITY_RESERVE = {INTERACTIVE: 0.0, FINALIZATION: 0.1, BATCH: 0.3}
+
+# Account limits; 0 means unlimited.
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+# Largest burst the buckets allow, in seconds worth of the limit.
+LLM_BURST_SECONDS = float(os.getenv("LLM_BURST_SECONDS", "10"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "256"))
+LLM_MAX_QUEUED = int(os.getenv("LLM_MAX_QUEUED", "1000"))
+
+_queue_depth = registry.gauge("llm_queue_depth", "LLM calls waiting for admission.", ["priority"])
+_in_flight = registry.gauge("llm_in_flight", "LLM calls admitted and not finished.")
+_queue_wait = registry.histogram(
+    "llm_queue_wait_seconds", "Time LLM calls waited for admission.", ["priority"])
+_rejected = registry.counter(
+    "llm_queue_rejected_total", "LLM calls refused because their queue was full.", ["priority"])
+
+
+class TokenBucket:
+    """
+    Refills at `per_minute` units a minute up to `burst_seconds` worth of them. The
+    level may go negative when a call turns out larger than estimated; later calls
+    then wait for the debt to be repaid.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float = LLM_BURST_SECONDS):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds) if per_minute else 0.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, reserve: float = 0.0) -> float:
+        """
+        Seconds until `amount` can be taken while leaving `reserve` of the capacity.
+        Amounts above the capacity only need a full bucket.
+        """
+        if not self.rate:
+            return 0.0
+        self._refill()
+        needed = min(self.capacity, amount + reserve * self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def take(self, amount: float):
+        if self.rate:
+            self._refill()
+            self.level -= amount
+
+    def give(self, amount: float):
+        if self.rate:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter:
+
+    def __init__(self, priority: str, tenant: str, tokens: int, future: asyncio.Future):
+        self.priority = priority
+        self.tenant = tenant
+        self.tokens = tokens
+        self.future = future
+        self.granted = False
+        self.enqueued = time.monotonic()
+
+
+class Admission:
+    """
+    An admitted call. settle() charges its actual token count instead of the estimate.
+    """
+
+    def __init__(self, scheduler: "LLMScheduler", tokens: int):
+        self._scheduler = scheduler
+        self.tokens = tokens
+
+    def settle(self, actual_tokens: int):
+        self._scheduler._settle(actual_tokens - self.tokens)
+        self.tokens = actual_tokens
+
+
+class LLMScheduler:
+
+    def __init__(self, rpm: float = LLM_RPM, tpm: float = LLM_TPM,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY, max_queued: int = LLM_MAX_QUEUED):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        # priority -> tenant -> waiters; tenants rotate to the back once served.
+        self._queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {p: OrderedDict() for p in PRIORITIES}
+        self._depth = {p: 0 for p in PRIORITIES}
+        self._in_flight = 0
+        self._timer: Union[asyncio.TimerHandle, None] = None
+        self._wake_at = 0.0
+        self._wake_loop: Union[asyncio.AbstractEventLoop, None] = None
+        # Callers may run on different event loops (the sync wrappers use asyncio.run).
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"queued": dict(self._depth), "in_flight": self._in_flight}
+
+    def collect_metrics(self):
+        stats = self.stats()
+        for priority, depth in stats["queued"].items():
+            _queue_depth.set(depth, priority=priority)
+        _in_flight.set(stats["in_flight"])
+
+    @asynccontextmanager
+    async def slot(self, priority: str, tenant: str = "", tokens: int = 0):
+        """
+        Wait for admission of a call expected to use `tokens`, and hold it while the
+        call runs. Raises LLMError(status_code=429) if the priority's queue is full.
+        """
+        await self._acquire(priority, tenant, tokens)
+        try:
+            yield Admission(self, tokens)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._dispatch()
+
+    async def _acquire(self, priority: str, tenant: str, tokens: int):
+        if priority not in self._queues:
+            raise ValueError(f"Unknown LLM priority: {priority}")
+        waiter = _Waiter(priority, tenant, tokens, asyncio.get_running_loop().create_future())
+        with self._lock:
+            if self._depth[priority] >= self.max_queued:
+                _rejected.inc(priority=priority)
+                raise LLMError(f"Too many queued {priority} LLM calls", status_code=429)
+            self._queues[priority].setdefault(tenant, deque()).append(waiter)
+            self._depth[priority] += 1
+            self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._in_flight -= 1
+                else:
+                    self._remove(waiter)
+                self._dispatch()
+            raise
+        _queue_wait.observe(time.monotonic() - waiter.enqueued, priority=priority)
+
+    def _remove(self, waiter: _Waiter):
+        tenants = self._queues[waiter.priority]
+        waiters = tenants.get(waiter.tenant)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self._depth[waiter.priority] -= 1
+            if not waiters:
+                del tenants[waiter.tenant]
+
+    def _head(self) -> Union[_Waiter, None]:
+        for priority in PRIORITIES:
+            tenants = self._queues[priority]
+            if tenants:
+                return next(iter(tenants.values()))[0]
+        return None
+
+    def _dispatch(self):
+        # Called with the lock held: admit waiters in order while limits allow.
+        while self._in_flight < self.max_concurrency:
+            waiter = self._head()
+            if waiter is None:
+                return
+            reserve = PRIORITY_RESERVE[waiter.priority]
+            wait = max(self.requests.wait_time(1, reserve), self.tokens.wait_time(waiter.tokens, reserve))
+            if wait > 0:
+                # Nothing else goes first: lower classes would take what the head waits for.
+                self._wake_after(wait, waiter.future.get_loop())
+                return
+
+            tenants = self._queues[waiter.priority]
+            waiters = tenants[waiter.tenant]
+            waiters.popleft()
+            self._depth[waiter.priority] -= 1
+            if waiters:
+                tenants.move_to_end(waiter.tenant)
+            else:
+                del tenants[waiter.tenant]
+
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            self._in_flight += 1
+            waiter.granted = True
+            waiter.future.get_loop().call_soon_threadsafe(_resolve, waiter.future)
+
+    def _wake_after(self, delay: float, loop: asyncio.AbstractEventLoop):
+        # Called with the lock held, possibly off `loop`'s thread.
+        at = time.monotonic() + delay
+        if self._wake_at and self._wake_at <= at and not self._wake_loop.is_closed():
+            return
+        self._wake_at, self._wake_loop = at, loop
+        loop.call_soon_threadsafe(self._arm, at)
+
+    def _arm(self, at: float):
+        with self._lock:
+            if self._wake_at != at:
+                return  # superseded by an earlier wake-up
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = asyncio.get_running_loop().call_later(max(0.0, at - time.monotonic()), self._wake)
+
+    def _wake(self):
+        with self._lock:
+            self._timer = None
+            self._wake_at = 0.0
+            self._dispatch()
+
+    def _settle(self, extra_tokens: int):
+        with self._lock:
+            if extra_tokens > 0:
+                self.tokens.take(extra_tokens)
+            elif extra_tokens < 0:
+                self.tokens.give(-extra_tokens)
+                self._dispatch()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+_scheduler: Union[LLMScheduler, None] = None
+
+
+def get_scheduler() -> LLMScheduler:
+    """
+    The process-wide scheduler, created from the LLM_* environment on first use.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = LLMScheduler()
+    return _scheduler
+
+
+def set_scheduler(scheduler: LLMScheduler):
+    """
+    Replace the process-wide scheduler (e.g. with other limits for a benchmark).
+    """
+    global _scheduler
+    _scheduler = scheduler
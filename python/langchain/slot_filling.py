@@ -0,0 +1,272 @@
+"""
+Local, deterministic slot filling for the trivial answers of a diary session.
+
+Most answers are a single choice ("Good") or a number ("7 hours"). When the field
+being asked about is known and the answer parses unambiguously against the form's
+`inputs` schema (data.type / data.values), the field is filled here and the next
+question is produced from a template, without an LLM round-trip. Anything unclear
+returns no value, and the turn falls back to the model.
+"""
+import re
+import math
+import threading
+from difflib import SequenceMatcher
+from typing import Dict, List, Union
+
+from langchain.extraction import REFUSED
+
+# Minimum similarity for a fuzzy choice match ("gret" -> "Great"), and how far ahead
+# of the runner-up it has to be. A reply of several words has more chances to look
+# like a value by accident, so it has to be closer.
+FUZZY_THRESHOLD = 0.8
+FUZZY_THRESHOLD_MULTIWORD = 0.9
+FUZZY_MARGIN = 0.1
+
+# Longer messages are likely to carry context the model should see.
+MAX_WORDS = 6
+
+_REFUSAL = re.compile(
+    r"\b(rather not|prefer not|don'?t want to (say|answer|tell)|won'?t (say|answer|tell)|"
+    r"not (telling|answering|saying)|no comment|skip( it| this)?|pass|refuse|none of your business)\b"
+)
+_NEGATION = re.compile(r"\b(not|no|never|isn'?t|wasn'?t|don'?t|didn'?t|hardly)\b|n't\b")
+# Set phrases that contain a choice's word without picking it.
+_IDIOMS = re.compile(r"\b(fair enough|that'?s fair|good question|good point|good grief|poor thing)\b")
+_NUMBER = r"-?\d+(?:[.,]\d+)?"
+_RANGE = re.compile(rf"({_NUMBER})\s*(?:-|–|to|or)\s*({_NUMBER})")
+_HOURS_MINUTES = re.compile(rf"({_NUMBER})\s*(?:h|hr|hrs|hours?)\s*(?:and\s*)?({_NUMBER})\s*(?:m|min|mins|minutes?)\b")
+_DESCRIPTION_RANGE = re.compile(rf"\(\s*({_NUMBER})\s*-\s*({_NUMBER})(\+?)\s*\)")
+
+_WORD_NUMBERS = {
+    "zero": 0, "none": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11,
+    "twelve": 12, "thirteen": 13, "fourteen": 14, "fifteen": 15, "sixteen": 16,
+    "seventeen": 17, "eighteen": 18, "nineteen": 19, "twenty": 20,
+}
+_WORD_NUMBER = re.compile(r"\b(" + "|".join(_WORD_NUMBERS) + r")( and a half)?\b")
+_FILLER_WORDS = {
+    "about", "around", "roughly", "maybe", "approximately", "approx", "like", "i", "im",
+    "i'm", "it", "its", "it's", "was", "is", "slept", "for", "say", "probably", "just",
+    "only", "hours", "hour", "hrs", "hr", "h", "a", "half", "and", "ish", "feel", "feeling",
+    "felt", "pretty", "quite", "very", "really", "today", "+",
+}
+
+
+class SlotStats:
+    """
+    Hit-rate counters for the local fast path.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.hits = 0
+        self.by_type: Dict[str, Dict[str, int]] = {}
+        self.misses: Dict[str, int] = {}
+
+    def record(self, field_type: Union[str, None], hit: bool, reason: str = ""):
+        with self._lock:
+            self.attempts += 1
+            per_type = self.by_type.setdefault(field_type or "unknown", {"attempts": 0, "hits": 0})
+            per_type["attempts"] += 1
+            if hit:
+                self.hits += 1
+                per_type["hits"] += 1
+            else:
+                self.misses[reason] = self.misses.get(reason, 0) + 1
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "attempts": self.attempts,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.attempts if self.attempts else 0.0,
+                "by_type": {k: dict(v) for k, v in self.by_type.items()},
+                "misses": dict(self.misses),
+            }
+
+
+slot_stats = SlotStats()
+
+
+def _normalize(text: str) -> str:
+    text = text.lower().replace("’", "'")
+    text = re.sub(r"[^\w\s'.,/+\-–]", " ", text)
+    return re.sub(r"\s+", " ", text).strip(" .!,")
+
+
+def is_refusal(message: str) -> bool:
+    return bool(_REFUSAL.search(_normalize(message)))
+
+
+def match_choice(values: List[str], message: str) -> Union[str, None]:
+    """
+    The choice value the message unambiguously picks, or None.
+    """
+    text = _normalize(message)
+    lowered = {value.lower(): value for value in values}
+    if text in lowered:
+        return lowered[text]
+    if not text or _NEGATION.search(text) or _IDIOMS.search(text):
+        return None
+
+    # A single choice mentioned as a whole word ("feeling good today").
+    words = set(re.findall(r"[\w']+", text))
+    mentioned = [value for key, value in lowered.items() if key in words or
+                 (" " in key and re.search(rf"\b{re.escape(key)}\b", text))]
+    if len(mentioned) == 1:
+        return mentioned[0]
+    if mentioned:
+        return None
+
+    # Typos: the closest value, if it is clearly closer than the others.
+    scores = sorted(
+        ((max(SequenceMatcher(None, key, word).ratio() for word in words | {text}), value)
+         for key, value in lowered.items()),
+        reverse=True,
+    )
+    best_score, best = scores[0]
+    runner_up = scores[1][0] if len(scores) > 1 else 0.0
+    threshold = FUZZY_THRESHOLD if len(words) == 1 else FUZZY_THRESHOLD_MULTIWORD
+    if best_score >= threshold and best_score - runner_up >= FUZZY_MARGIN:
+        return best
+    return None
+
+
+def _to_number(text: str) -> float:
+    return float(text.replace(",", "."))
+
+
+def _description_range(description: str):
+    match = _DESCRIPTION_RANGE.search(description or "")
+    if not match:
+        return None, None
+    low, high = _to_number(match.group(1)), _to_number(match.group(2))
+    return low, (None if match.group(3) else high)
+
+
+def parse_number(message: str, description: str = "") -> Union[int, float, None]:
+    """
+    The number the message gives, or None if there isn't exactly one.
+
+    Understands digits with their sign and number words ("seven and a half"), hours
+    with minutes ("7h 30m" -> 7.5), and ranges ("6-8" -> 7). The value must fall
+    inside a "(low-high)" range given in the field's description, if there is one.
+    """
+    text = _normalize(message)
+    value = None
+
+    match = _HOURS_MINUTES.search(text)
+    if match:
+        value = _to_number(match.group(1)) + _to_number(match.group(2)) / 60
+        rest = text[:match.start()] + text[match.end():]
+    else:
+        match = _RANGE.search(text)
+        if match:
+            value = (_to_number(match.group(1)) + _to_number(match.group(2))) / 2
+            rest = text[:match.start()] + text[match.end():]
+        else:
+            numbers = re.findall(_NUMBER, text)
+            words = _WORD_NUMBER.findall(text)
+            if len(numbers) + len(words) != 1:
+                return None
+            if numbers:
+                value = _to_number(numbers[0])
+                rest = text.replace(numbers[0], " ", 1)
+            else:
+                word, half = words[0]
+                value = _WORD_NUMBERS[word] + (0.5 if half else 0)
+                rest = _WORD_NUMBER.sub(" ", text, count=1)
+
+    # Anything besides units and hedging words means there's more to the answer.
+    if any(w not in _FILLER_WORDS for w in re.findall(r"[\w'/+]+", rest)):
+        return None
+
+    if not within_range(value, description):
+        return None
+    return int(value) if float(value).is_integer() else round(value, 2)
+
+
+def within_range(value: Union[int, float], description: str = "") -> bool:
+    """
+    Whether a number is finite and inside the "(low-high)" range of the field's
+    description, if it gives one.
+    """
+    if not math.isfinite(value):
+        return False
+    low, high = _description_range(description)
+    if low is not None and value < low:
+        return False
+    if high is not None and value > high:
+        return False
+    return True
+
+
+def asked_field(pending: List[Dict], awaiting: Union[str, None], last_question: str) -> Union[Dict, None]:
+    """
+    The pending input the last assistant message asked about, if it can be told.
+
+    Questions produced by the fast path record their field ("awaiting"); for model
+    questions, the field is known if exactly one pending label is mentioned.
+    """
+    if awaiting:
+        for field in pending:
+            if field["label"] == awaiting:
+                return field
+        return None
+    text = (last_question or "").lower()
+    mentioned = [field for field in pending if field["label"].lower() in text]
+    return mentioned[0] if len(mentioned) == 1 else None
+
+
+def fill_slot(field: Dict, message: str, refusals: int = 0) -> tuple[Union[str, int, float, None], str]:
+    """
+    Try to answer `field` from the message. Returns (value, reason): value is None
+    when the answer isn't clear, and reason says why ("refusal", "not_confident", ...).
+
+    A refusal is only recorded as REFUSED once the patient refused this field before,
+    so the model still gets a chance to encourage them the first time.
+    """
+    if is_refusal(message):
+        return (REFUSED, "") if refusals >= 1 else (None, "refusal")
+    if len(message.split()) > MAX_WORDS:
+        return None, "long_message"
+
+    data = field.get("data", {})
+    field_type = data.get("type")
+    if field_type == "choice":
+        value = match_choice(data.get("values", []), message)
+    elif field_type == "number":
+        value = parse_number(message, field.get("description", ""))
+    else:
+        return None, "free_text"
+    return value, ("" if value is not None else "not_confident")
+
+
+def field_question(field: Dict) -> str:
+    """
+    A templated question for `field`, without greeting.
+    """
+    description = field.get("description", "")
+    # Descriptions are written for the form's author ("the patient"), so only use them
+    # as-is when they read naturally to the patient.
+    if description and not re.search(r"\b(patient|user)\b", description, re.IGNORECASE):
+        question = description
+    else:
+        question = f"Could you tell me about your {field['label'].lower()}?"
+
+    data = field.get("data", {})
+    if data.get("type") == "choice":
+        question += " Options: " + ", ".join(data.get("values", []))
+    elif data.get("type") == "number":
+        question += " (a number is perfect 🔢)"
+    return question
+
+
+def next_question(field: Dict, name: Union[str, None]) -> str:
+    """
+    A templated question for `field`, addressing the patient by first name.
+    """
+    first_name = (name or "").split(" ")[0]
+    greeting = f"Thanks, {first_name}! 😊" if first_name else "Thanks! 😊"
+    return f"{greeting} {field_question(field)}"
@@ -0,0 +1,146 @@
+"""
+An OpenAI-compatible stand-in for /v1/chat/completions, for load-testing the API
+offline (no key, no cost, predictable latency).
+
+It plays a patient-friendly but dumb assistant: every user message answers the
+first pending field of the form found in the system prompt, the next pending field
+is asked about, and the finalize phrase is said once nothing is left. Parse requests
+get a JSON object with every field blank.
+
+Run it from the python/ directory and point the API at it:
+
+    uvicorn langchain.stub_server:app --port 8100
+    LLM_BASE_URL=http://localhost:8100/v1 uvicorn server.api:app
+
+Configuration (environment):
+    STUB_LATENCY_MS         mean time to first token (default 300)
+    STUB_LATENCY_JITTER_MS  standard deviation of that latency (default 100)
+    STUB_TOKEN_MS           delay between streamed chunks (default 20)
+    STUB_ERROR_RATE         fraction of requests answered with a 503 (default 0)
+"""
+import os
+import re
+import json
+import time
+import random
+import asyncio
+from typing import Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from langchain.context import count_message_tokens, count_tokens
+from langchain.extraction import FIELDS_MARKER
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "300"))
+STUB_LATENCY_JITTER_MS = float(os.getenv("STUB_LATENCY_JITTER_MS", "100"))
+STUB_TOKEN_MS = float(os.getenv("STUB_TOKEN_MS", "20"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+
+# Kept in sync with genericLLMFunction.FINALIZE_PHRASE (not imported, so the stub
+# doesn't need the API's configuration to start).
+FINALIZE_PHRASE = "I have all the information I need. We can finalize now."
+
+_FORM_START = "Below is the form structure we want to collect data for (in JSON):"
+_FORM_END = "- If the user's"
+_PARSE_FIELD = re.compile(r'"([^"]+)": \[value\]')
+
+app = FastAPI()
+
+
+def _pending_fields(system_prompt: str) -> List[Dict]:
+    start = system_prompt.find(_FORM_START)
+    end = system_prompt.find(_FORM_END)
+    if start < 0 or end < start:
+        return []
+    try:
+        fields = json.loads(system_prompt[start + len(_FORM_START):end])
+    except json.JSONDecodeError:
+        return []
+    return fields if isinstance(fields, list) else []
+
+
+def _answer(field: Dict, message: str):
+    data = field.get("data", {})
+    if data.get("type") == "number":
+        match = re.search(r"\d+(?:\.\d+)?", message)
+        number = float(match.group()) if match else 0.0
+        return int(number) if number.is_integer() else number
+    if data.get("type") == "choice":
+        values = data.get("values", [])
+        for value in values:
+            if value.lower() in message.lower():
+                return value
+        return values[0] if values else message
+    return message
+
+
+def stub_reply(messages: List[Dict[str, str]]) -> str:
+    """
+    The stub's reply to a chat completion request (also used in-process by the benchmarks).
+    """
+    system_prompt = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    last = messages[-1]
+
+    # Final parse request: the instructions come last, as a system message.
+    if last["role"] == "system" and "data parser" in last["content"]:
+        return json.dumps({label: "" for label in _PARSE_FIELD.findall(last["content"])})
+
+    pending = _pending_fields(system_prompt)
+    extracted = {}
+    if last["role"] == "user" and pending:
+        extracted[pending[0]["label"]] = _answer(pending[0], last["content"])
+        pending = pending[1:]
+
+    if pending:
+        text = f"Thanks! 😊 Could you tell me about your {pending[0]['label'].lower()}?"
+    else:
+        text = f"Thank you! 🙏 {FINALIZE_PHRASE}"
+    return f"{text}\n{FIELDS_MARKER} {json.dumps(extracted)}"
+
+
+async def _delay():
+    latency = random.gauss(STUB_LATENCY_MS, STUB_LATENCY_JITTER_MS)
+    await asyncio.sleep(max(0.0, latency) / 1000)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    model = body.get("model", "stub")
+
+    if random.random() < STUB_ERROR_RATE:
+        await _delay()
+        return JSONResponse({"error": {"message": "stub overloaded"}}, status_code=503)
+
+    content = stub_reply(messages)
+    completion_id = f"chatcmpl-stub-{random.getrandbits(48):x}"
+    created = int(time.time())
+
+    if not body.get("stream"):
+        await _delay()
+        prompt_tokens = count_message_tokens(messages, model)
+        completion_tokens = count_tokens(content, model)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    async def events():
+        await _delay()
+        for word in re.findall(r"\S+\s*", content):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                     "model": model, "choices": [{"index": 0, "delta": {"content": word},
+                                                  "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(STUB_TOKEN_MS / 1000)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
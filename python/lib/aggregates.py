@@ -0,0 +1,179 @@
+"""
+Per-form aggregate statistics, kept up to date as results are appended so the admin
+views don't have to re-read every result. One document per form:
+
+  admin/{admin_id}/forms/{form_id}/aggregates/summary
+
+    completed              number of results
+    fully_answered         results with every input answered
+    with_refusals          results with at least one refused input
+    fields.{label}         answered, refused, and
+        counts.{value}                       for "choice" inputs
+        count, sum, sum_sq, min, max         for "number" inputs
+    daily.{YYYY-MM-DD}     completed, with_refusals, and
+        fields.{label}.count/sum             for "number" inputs
+    updated_at
+
+result_increments() gives one result's contribution as Firestore transforms, merged
+into the document in the same batch that writes the result. rebuild() folds the same
+contributions over all results, and summarize() derives means and variances.
+"""
+import math
+from typing import Dict, Iterable, List, Union
+
+from google.cloud.firestore_v1 import transforms
+
+from lib.export import to_row
+
+AGGREGATES_COLLECTION = "aggregates"
+AGGREGATE_DOC = "summary"
+
+
+def _field_type(field: Dict) -> str:
+    return field.get("data", {}).get("type", "string")
+
+
+def result_increments(result: Dict, inputs: List[Dict]) -> Dict:
+    """
+    One result's contribution to the aggregate document, as a nested dict of
+    Increment/Minimum/Maximum transforms to set() with merge=True.
+    """
+    row = to_row(result, inputs)
+    refused = set(row["refused"])
+    day = str(result.get("date") or "")[:10]
+
+    fields: Dict[str, Dict] = {}
+    daily_fields: Dict[str, Dict] = {}
+    answered_all = True
+    for field in inputs:
+        label = field["label"]
+        value = row[label]
+        if label in refused:
+            fields[label] = {"refused": transforms.Increment(1)}
+            answered_all = False
+            continue
+        if value in (None, ""):
+            answered_all = False
+            continue
+        stats = fields[label] = {"answered": transforms.Increment(1)}
+        if _field_type(field) == "choice":
+            stats["counts"] = {value: transforms.Increment(1)}
+        elif _field_type(field) == "number":
+            stats.update({
+                "count": transforms.Increment(1),
+                "sum": transforms.Increment(value),
+                "sum_sq": transforms.Increment(value * value),
+                "min": transforms.Minimum(value),
+                "max": transforms.Maximum(value),
+            })
+            daily_fields[label] = {"count": transforms.Increment(1), "sum": transforms.Increment(value)}
+
+    increments = {
+        "completed": transforms.Increment(1),
+        "fully_answered": transforms.Increment(1 if answered_all else 0),
+        "with_refusals": transforms.Increment(1 if refused else 0),
+        "updated_at": transforms.SERVER_TIMESTAMP,
+    }
+    # No empty maps: merging one would overwrite the stored map.
+    if fields:
+        increments["fields"] = fields
+    if day:
+        bucket = {
+            "completed": transforms.Increment(1),
+            "with_refusals": transforms.Increment(1 if refused else 0),
+        }
+        if daily_fields:
+            bucket["fields"] = daily_fields
+        increments["daily"] = {day: bucket}
+    return increments
+
+
+def _fold(total: Dict, part: Dict):
+    """
+    Apply a result_increments() dict to plain aggregate values, in place.
+    """
+    for key, value in part.items():
+        current = total.get(key)
+        if isinstance(value, dict):
+            _fold(total.setdefault(key, {}), value)
+        elif isinstance(value, transforms.Increment):
+            total[key] = (current or 0) + value.value
+        elif isinstance(value, transforms.Minimum):
+            total[key] = value.value if current is None else min(current, value.value)
+        elif isinstance(value, transforms.Maximum):
+            total[key] = value.value if current is None else max(current, value.value)
+        else:
+            total[key] = value
+
+
+def rebuild(results: Iterable[Dict], inputs: List[Dict]) -> Dict:
+    """
+    The aggregate document for a whole set of results, computed from scratch.
+    """
+    total = {"completed": 0, "fully_answered": 0, "with_refusals": 0, "fields": {}, "daily": {},
+             "updated_at": transforms.SERVER_TIMESTAMP}
+    for result in results:
+        _fold(total, result_increments(result, inputs))
+    return total
+
+
+def _mean(total: float, count: int) -> Union[float, None]:
+    return total / count if count else None
+
+
+def summarize(doc: Union[Dict, None], inputs: List[Dict]) -> Dict:
+    """
+    The aggregate document as served by the API: per-input counts, and for numbers
+    the mean, (population) variance, standard deviation, min and max.
+    """
+    doc = doc or {}
+    stored_fields = doc.get("fields", {})
+    fields = {}
+    for field in inputs:
+        label, field_type = field["label"], _field_type(field)
+        stats = stored_fields.get(label, {})
+        summary = {
+            "type": field_type,
+            "answered": stats.get("answered", 0),
+            "refused": stats.get("refused", 0),
+        }
+        if field_type == "choice":
+            counts = {choice: 0 for choice in field.get("data", {}).get("values", [])}
+            counts.update(stats.get("counts", {}))
+            summary["counts"] = counts
+        elif field_type == "number":
+            count = stats.get("count", 0)
+            mean = _mean(stats.get("sum", 0), count)
+            variance = None
+            if count:
+                # Clamped: rounding can make it slightly negative when all values are equal.
+                variance = max(0.0, stats.get("sum_sq", 0) / count - mean * mean)
+            summary.update({
+                "count": count,
+                "mean": mean,
+                "variance": variance,
+                "std": None if variance is None else math.sqrt(variance),
+                "min": stats.get("min"),
+                "max": stats.get("max"),
+            })
+        fields[label] = summary
+
+    daily = []
+    for day, bucket in sorted(doc.get("daily", {}).items()):
+        day_fields = bucket.get("fields", {})
+        daily.append({
+            "date": day,
+            "completed": bucket.get("completed", 0),
+            "with_refusals": bucket.get("with_refusals", 0),
+            "means": {label: _mean(stats.get("sum", 0), stats.get("count", 0))
+                      for label, stats in day_fields.items()},
+        })
+
+    return {
+        "completed": doc.get("completed", 0),
+        "fully_answered": doc.get("fully_answered", 0),
+        "with_refusals": doc.get("with_refusals", 0),
+        "updated_at": doc.get("updated_at"),
+        "fields": fields,
+        "daily": daily,
+    }
@@ -0,0 +1,185 @@
+"""
+Encoders for bulk result exports.
+
+Rows are typed from the form's `inputs` schema: "number" inputs become numbers (or
+null when unanswered or refused), everything else strings. Each encoder turns pages
+of rows into bytes as they come, so an export never holds more than one page.
+
+Parquet needs the optional pyarrow package.
+"""
+import io
+import csv
+import json
+from typing import Dict, Iterable, List, Tuple, Union
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover - optional dependency
+    pyarrow = None
+
+from langchain.extraction import REFUSED
+
+FORMATS = ("ndjson", "csv", "parquet")
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Columns present on every result besides the form's inputs.
+META_COLUMNS = [("session_id", "string"), ("email", "string"), ("date", "string")]
+
+
+def parquet_available() -> bool:
+    return pyarrow is not None
+
+
+def export_columns(inputs: List[Dict]) -> List[Tuple[str, str]]:
+    """
+    (name, type) of every exported column; type is "number", "string" or "list".
+    """
+    columns = list(META_COLUMNS)
+    for field in inputs:
+        field_type = "number" if field.get("data", {}).get("type") == "number" else "string"
+        columns.append((field["label"], field_type))
+    columns.append(("refused", "list"))
+    return columns
+
+
+def _number(value) -> Union[float, None]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip())
+    except ValueError:
+        return None
+
+
+def to_row(result: Dict, inputs: List[Dict]) -> Dict:
+    """
+    Type a stored result for export. Refused answers are empty, with the refused
+    labels listed in "refused".
+    """
+    row = {name: (None if result.get(name) is None else str(result[name])) for name, _ in META_COLUMNS}
+    refused = []
+    for field in inputs:
+        label = field["label"]
+        value = result.get(label)
+        if isinstance(value, str) and value.upper() == REFUSED:
+            refused.append(label)
+            value = None
+        if field.get("data", {}).get("type") == "number":
+            row[label] = None if value in (None, "") else _number(value)
+        else:
+            row[label] = None if value is None else str(value)
+    row["refused"] = refused
+    return row
+
+
+class NdjsonEncoder:
+
+    def __init__(self, columns: List[Tuple[str, str]]):
+        self.columns = columns
+
+    def header(self) -> bytes:
+        return b""
+
+    def encode(self, rows: Iterable[Dict]) -> bytes:
+        return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode("utf-8")
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class CsvEncoder:
+
+    def __init__(self, columns: List[Tuple[str, str]]):
+        self.columns = columns
+
+    def _lines(self, rows: Iterable[List]) -> bytes:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+
+    def header(self) -> bytes:
+        return self._lines([[name for name, _ in self.columns]])
+
+    def encode(self, rows: Iterable[Dict]) -> bytes:
+        def cell(value):
+            if value is None:
+                return ""
+            if isinstance(value, list):
+                return ";".join(value)
+            if isinstance(value, float) and value.is_integer():
+                return str(int(value))
+            return value
+        return self._lines([[cell(row[name]) for name, _ in self.columns] for row in rows])
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class _Drain(io.RawIOBase):
+    """
+    A write-only file whose contents are taken out after every write, so the
+    Parquet writer can stream into the response.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+class ParquetEncoder:
+    """
+    Writes one Parquet row group per page of rows.
+    """
+
+    _TYPES = {"number": lambda: pyarrow.float64(), "string": lambda: pyarrow.string(),
+              "list": lambda: pyarrow.list_(pyarrow.string())}
+
+    def __init__(self, columns: List[Tuple[str, str]]):
+        if pyarrow is None:
+            raise RuntimeError("Parquet export needs the pyarrow package")
+        self.columns = columns
+        self.schema = pyarrow.schema([(name, self._TYPES[kind]()) for name, kind in columns])
+        self._sink = _Drain()
+        self._writer = pyarrow.parquet.ParquetWriter(self._sink, self.schema)
+
+    def header(self) -> bytes:
+        return self._sink.take()
+
+    def encode(self, rows: Iterable[Dict]) -> bytes:
+        rows = list(rows)
+        if rows:
+            table = pyarrow.Table.from_pylist(rows, schema=self.schema)
+            self._writer.write_table(table)
+        return self._sink.take()
+
+    def finish(self) -> bytes:
+        self._writer.close()
+        return self._sink.take()
+
+
+def encoder(format: str, columns: List[Tuple[str, str]]):
+    return {"ndjson": NdjsonEncoder, "csv": CsvEncoder, "parquet": ParquetEncoder}[format](columns)
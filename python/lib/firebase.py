@@ -0,0 +1,57 @@
+"""
+Firebase Admin app and clients, created on first use instead of at import.
+
+Loading the service account key, initializing the app and building the Firestore
+client used to happen when server/api.py was imported, so every new replica paid
+for it before it could even bind its port. Now nothing is read or connected until
+a client is first needed: by the lifespan's warmup, or else by the first request.
+"""
+import os
+import threading
+from typing import Callable
+
+import firebase_admin
+from firebase_admin import credentials
+
+FIREBASE_KEY_PATH = os.getenv("FIREBASE_KEY_PATH", "firestore_key.json")
+
+_lock = threading.Lock()
+_app = None
+_initialized = False
+
+
+def firebase_app():
+    """
+    The default Firebase app, initialized from FIREBASE_KEY_PATH on first use.
+    """
+    global _app, _initialized
+    with _lock:
+        if not _initialized:
+            try:
+                _app = firebase_admin.get_app()
+            except ValueError:
+                _app = firebase_admin.initialize_app(credentials.Certificate(FIREBASE_KEY_PATH))
+            _initialized = True
+    return _app
+
+
+class LazyClient:
+    """
+    Stands in for a client built by `factory` on first attribute access, so it can
+    be a module-level name without being created at import.
+    """
+
+    def __init__(self, factory: Callable[[], object]):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
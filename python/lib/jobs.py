@@ -0,0 +1,232 @@
+"""
+A small durable job queue backed by SQLite, with an asyncio worker pool.
+
+Jobs survive restarts: a job is only removed from the queue once its handler
+succeeded. Failed jobs are retried with jittered exponential backoff, and after
+`max_attempts` they are moved to the dead-letter state ("dead") for inspection.
+"""
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, List, Union
+
+from lib.metrics import registry
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"
+
+_job_seconds = registry.histogram("job_duration_seconds", "Time to run a job attempt.", ["kind", "outcome"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, next_run_at);
+"""
+
+
+class JobQueue:
+    """
+    Persistent queue of jobs identified by a caller-chosen id (enqueueing the
+    same id twice is a no-op while the first one exists).
+    """
+
+    def __init__(self, path: str, max_attempts: int = 5, backoff_base: float = 2.0, backoff_max: float = 300.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # Jobs that were running when the process died get picked up again.
+        self._conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+
+    def enqueue(self, job_id: str, kind: str, payload: Dict, rerun: bool = False) -> bool:
+        """
+        Add a job. Returns False if a job with this id already exists, unless `rerun`
+        is set and that job is done or dead: it is then queued again with `payload`.
+        """
+        now = time.time()
+        sql = ("INSERT INTO jobs (id, kind, payload, status, next_run_at, created_at, updated_at) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?) ")
+        if rerun:
+            sql += ("ON CONFLICT (id) DO UPDATE SET payload = excluded.payload, status = excluded.status, "
+                    "attempts = 0, next_run_at = excluded.next_run_at, last_error = NULL, "
+                    "updated_at = excluded.updated_at WHERE jobs.status IN (?, ?)")
+            params = (job_id, kind, json.dumps(payload), QUEUED, now, now, now, DONE, DEAD)
+        else:
+            sql += "ON CONFLICT (id) DO NOTHING"
+            params = (job_id, kind, json.dumps(payload), QUEUED, now, now, now)
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            return cursor.rowcount == 1
+
+    def claim(self) -> Union[Dict, None]:
+        """
+        Take the next job that is due and mark it running, or return None.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND next_run_at <= ? ORDER BY next_run_at LIMIT 1",
+                (QUEUED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (RUNNING, now, row["id"]),
+            )
+        job = self._to_dict(row)
+        job["attempts"] += 1
+        job["status"] = RUNNING
+        return job
+
+    def complete(self, job_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                               (DONE, time.time(), job_id))
+
+    def fail(self, job_id: str, error: str) -> str:
+        """
+        Record a failed attempt: schedule a retry, or dead-letter the job once it ran
+        out of attempts. Returns the job's new status.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return DEAD
+            attempts = row["attempts"]
+            if attempts >= self.max_attempts:
+                status, next_run_at = DEAD, now
+            else:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+                status, next_run_at = QUEUED, now + random.uniform(delay / 2, delay)
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, next_run_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                (status, next_run_at, error, now, job_id),
+            )
+        return status
+
+    def retry(self, job_id: str) -> bool:
+        """
+        Put a dead-lettered job back in the queue with fresh attempts.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, attempts = 0, next_run_at = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (QUEUED, now, now, job_id, DEAD),
+            )
+            return cursor.rowcount == 1
+
+    def get(self, job_id: str) -> Union[Dict, None]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def dead_letters(self, limit: int = 100) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY updated_at DESC LIMIT ?", (DEAD, limit)
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _to_dict(row) -> Dict:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+
+class WorkerPool:
+    """
+    Runs queued jobs with `concurrency` asyncio workers. `handlers` maps a job kind
+    to an async function taking the job's payload; raising marks the attempt failed.
+    """
+
+    def __init__(self, queue: JobQueue, handlers: Dict[str, Callable[[Dict], Awaitable[None]]],
+                 concurrency: int = 4, poll_interval: float = 1.0):
+        self.queue = queue
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        # Before Python 3.12, wait_for() loses a cancellation that races a wakeup, so
+        # idle workers also check this flag.
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """
+        Wake idle workers, e.g. right after enqueueing a job.
+        """
+        self._wakeup.set()
+
+    async def _worker(self):
+        while not self._stopping:
+            job = self.queue.claim()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Dict):
+        handler = self.handlers.get(job["kind"])
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise ValueError(f"No handler for job kind {job['kind']!r}")
+            await handler(job["payload"])
+        except asyncio.CancelledError:
+            # Shutting down: leave the job to be picked up again on restart.
+            raise
+        except Exception as e:
+            _job_seconds.observe(time.perf_counter() - started, kind=job["kind"], outcome="failed")
+            status = self.queue.fail(job["id"], repr(e))
+            print(f"Job {job['id']} ({job['kind']}) failed on attempt {job['attempts']}: {e!r} -> {status}")
+        else:
+            _job_seconds.observe(time.perf_counter() - started, kind=job["kind"], outcome="done")
+            self.queue.complete(job["id"])
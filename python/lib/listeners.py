@@ -0,0 +1,122 @@
+"""
+Shared Firestore snapshot listeners for long-polling clients.
+
+Every client waiting on a document used to poll it with its own reads. ListenerHub
+keeps one snapshot listener per watched document instead, however many clients wait
+on it: a change costs one read in total, and waiting clients are answered from the
+listener's latest copy of the document. A listener is kept `linger_seconds` after
+its last waiter left, so clients polling in a loop don't restart it every time.
+
+Listeners are those of the synchronous Firestore client (the async one has none):
+their callbacks run on the listener's thread and are handed to the event loop.
+"""
+import time
+import asyncio
+from typing import Callable, Dict, Union
+
+from lib.metrics import registry
+
+listener_count = registry.gauge(
+    "firestore_listeners", "Documents watched by a snapshot listener.")
+listener_snapshots = registry.counter(
+    "firestore_listener_snapshots_total", "Snapshots received by the listeners.")
+
+
+class _Watch:
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.ready = False  # set once the first snapshot arrived
+        self.data: Union[Dict, None] = None
+        self.changed = asyncio.Event()
+        self.waiters = 0
+        self.listener = None
+        self.idle_since: Union[float, None] = None
+
+
+class ListenerHub:
+
+    def __init__(self, document: Callable[[str], object], linger_seconds: float = 30.0):
+        """
+        `document(path)` returns a synchronous Firestore document reference (anything
+        with on_snapshot(callback) returning a watch with unsubscribe()).
+        """
+        self._document = document
+        self.linger_seconds = linger_seconds
+        self._watches: Dict[str, _Watch] = {}
+
+    def __len__(self) -> int:
+        return len(self._watches)
+
+    def _on_snapshot(self, watch: _Watch, snapshots):
+        # Runs on the listener's thread.
+        snapshot = snapshots[0] if snapshots else None
+        data = snapshot.to_dict() if snapshot is not None and snapshot.exists else None
+        listener_snapshots.inc()
+        watch.loop.call_soon_threadsafe(self._changed, watch, data)
+
+    def _changed(self, watch: _Watch, data: Union[Dict, None]):
+        watch.ready = True
+        watch.data = data
+        # Wake every waiter; later ones wait on a fresh event.
+        watch.changed.set()
+        watch.changed = asyncio.Event()
+
+    def _acquire(self, path: str) -> _Watch:
+        watch = self._watches.get(path)
+        if watch is None:
+            watch = _Watch(asyncio.get_running_loop())
+            self._watches[path] = watch
+            watch.listener = self._document(path).on_snapshot(
+                lambda snapshots, changes, read_time: self._on_snapshot(watch, snapshots))
+            listener_count.set(len(self._watches))
+        watch.waiters += 1
+        watch.idle_since = None
+        return watch
+
+    def _release(self, path: str, watch: _Watch):
+        watch.waiters -= 1
+        if watch.waiters == 0:
+            watch.idle_since = time.monotonic()
+            watch.loop.call_later(self.linger_seconds, self._close_if_idle, path, watch)
+
+    def _close_if_idle(self, path: str, watch: _Watch):
+        if watch.waiters or watch.idle_since is None:
+            return
+        if time.monotonic() - watch.idle_since < self.linger_seconds:
+            return  # reacquired and released since; a later call will close it
+        if self._watches.get(path) is not watch:
+            return  # the hub was closed
+        del self._watches[path]
+        listener_count.set(len(self._watches))
+        watch.listener.unsubscribe()
+
+    async def wait(self, path: str, until: Callable[[Union[Dict, None]], bool],
+                   timeout: float) -> Union[Dict, None]:
+        """
+        Wait up to `timeout` seconds for the document at `path` to satisfy `until`
+        (called with its data, None if it doesn't exist), and return its latest data.
+        Raises asyncio.TimeoutError if no snapshot arrived at all.
+        """
+        watch = self._acquire(path)
+        try:
+            deadline = time.monotonic() + timeout
+            while not (watch.ready and until(watch.data)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(watch.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if not watch.ready:
+                raise asyncio.TimeoutError(f"No snapshot of {path}")
+            return watch.data
+        finally:
+            self._release(path, watch)
+
+    def close(self):
+        for watch in self._watches.values():
+            watch.listener.unsubscribe()
+        self._watches.clear()
+        listener_count.set(0)
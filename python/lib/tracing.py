@@ -0,0 +1,273 @@
+"""
+Per-request tracing.
+
+TracingMiddleware starts a Trace for every HTTP request; span() times one call to a
+backend (a Firestore read, an Auth lookup, an LLM completion) and records it in the
+current request's trace and in the span_duration_seconds histogram. Requests slower
+than `slow_seconds` are logged with their span breakdown.
+
+TracedFirestore wraps a firestore_async client so every get/set/update/delete,
+query and batch commit gets a span without touching the call sites.
+"""
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Union
+
+from lib.metrics import registry
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route and status.", ["method", "route", "status"])
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "Time to fully answer an HTTP request.", ["method", "route"])
+span_seconds = registry.histogram(
+    "span_duration_seconds", "Duration of calls to backends (Firestore, Auth, LLM).", ["kind", "operation"])
+span_errors = registry.counter(
+    "span_errors_total", "Calls to backends that raised.", ["kind", "operation"])
+firestore_documents = registry.counter(
+    "firestore_documents_total", "Firestore documents read or written.", ["op"])
+
+
+class Trace:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: List[Dict] = []
+
+    def add(self, kind: str, operation: str, started: float, seconds: float, attrs: Dict):
+        self.spans.append({
+            "kind": kind,
+            "operation": operation,
+            "start_ms": round((started - self.started) * 1000, 1),
+            "ms": round(seconds * 1000, 1),
+            **attrs,
+        })
+
+    def breakdown(self) -> Dict[str, float]:
+        """
+        Total milliseconds spent per kind of backend.
+        """
+        totals: Dict[str, float] = {}
+        for s in self.spans:
+            totals[s["kind"]] = round(totals.get(s["kind"], 0.0) + s["ms"], 1)
+        return totals
+
+
+_current: ContextVar[Union[Trace, None]] = ContextVar("trace", default=None)
+
+
+def current_trace() -> Union[Trace, None]:
+    return _current.get()
+
+
+@contextmanager
+def span(kind: str, operation: str, **attrs):
+    """
+    Time the enclosed call. Yields a dict the caller can add attributes to (e.g.
+    token counts once a completion returned); they are kept with the span.
+    """
+    started = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException:
+        attrs["error"] = True
+        span_errors.inc(kind=kind, operation=operation)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        span_seconds.observe(seconds, kind=kind, operation=operation)
+        trace = _current.get()
+        if trace is not None:
+            trace.add(kind, operation, started, seconds, attrs)
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware giving each HTTP request a Trace, recording request metrics per
+    route template (not per raw path, to keep label values bounded), and logging
+    requests slower than `slow_seconds` (0 disables the log).
+    """
+
+    def __init__(self, app, slow_seconds: float = 0.0):
+        self.app = app
+        self.slow_seconds = slow_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        token = _current.set(trace)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            # Returns once the whole body was sent, streamed responses included.
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _current.reset(token)
+            seconds = time.perf_counter() - trace.started
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_requests.inc(method=scope["method"], route=route, status=status)
+            http_request_seconds.observe(seconds, method=scope["method"], route=route)
+            if self.slow_seconds and seconds >= self.slow_seconds:
+                print("Slow request:", json.dumps({
+                    "request": trace.name,
+                    "route": route,
+                    "status": status,
+                    "ms": round(seconds * 1000, 1),
+                    "breakdown_ms": trace.breakdown(),
+                    "spans": trace.spans,
+                }, default=str))
+
+
+# ----------------------------
+# Firestore
+# ----------------------------
+
+def _unwrap(obj):
+    return obj._target if isinstance(obj, _Traced) else obj
+
+
+class _Traced:
+
+    def __init__(self, target, collection: str):
+        self._target = target
+        self._collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+
+class TracedDocument(_Traced):
+
+    def collection(self, name: str) -> "TracedQuery":
+        return TracedQuery(self._target.collection(name), name)
+
+    async def get(self, *args, **kwargs):
+        with span("firestore", f"get {self._collection}"):
+            snapshot = await self._target.get(*args, **kwargs)
+        firestore_documents.inc(op="read")
+        return snapshot
+
+    async def set(self, *args, **kwargs):
+        with span("firestore", f"set {self._collection}"):
+            result = await self._target.set(*args, **kwargs)
+        firestore_documents.inc(op="write")
+        return result
+
+    async def update(self, *args, **kwargs):
+        with span("firestore", f"update {self._collection}"):
+            result = await self._target.update(*args, **kwargs)
+        firestore_documents.inc(op="write")
+        return result
+
+    async def delete(self, *args, **kwargs):
+        with span("firestore", f"delete {self._collection}"):
+            result = await self._target.delete(*args, **kwargs)
+        firestore_documents.inc(op="write")
+        return result
+
+
+class TracedQuery(_Traced):
+
+    def document(self, *args, **kwargs) -> TracedDocument:
+        return TracedDocument(self._target.document(*args, **kwargs), self._collection)
+
+    def _wrap(self, method: str, *args, **kwargs) -> "TracedQuery":
+        return TracedQuery(getattr(self._target, method)(*args, **kwargs), self._collection)
+
+    def order_by(self, *args, **kwargs):
+        return self._wrap("order_by", *args, **kwargs)
+
+    def where(self, *args, **kwargs):
+        return self._wrap("where", *args, **kwargs)
+
+    def limit(self, *args, **kwargs):
+        return self._wrap("limit", *args, **kwargs)
+
+    def limit_to_last(self, *args, **kwargs):
+        return self._wrap("limit_to_last", *args, **kwargs)
+
+    def offset(self, *args, **kwargs):
+        return self._wrap("offset", *args, **kwargs)
+
+    def select(self, *args, **kwargs):
+        return self._wrap("select", *args, **kwargs)
+
+    def start_after(self, *args, **kwargs):
+        return self._wrap("start_after", *args, **kwargs)
+
+    def start_at(self, *args, **kwargs):
+        return self._wrap("start_at", *args, **kwargs)
+
+    def end_before(self, *args, **kwargs):
+        return self._wrap("end_before", *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        with span("firestore", f"query {self._collection}") as attrs:
+            docs = await self._target.get(*args, **kwargs)
+            attrs["documents"] = len(docs)
+        firestore_documents.inc(max(1, len(docs)), op="read")
+        return docs
+
+    async def stream(self, *args, **kwargs):
+        count = 0
+        with span("firestore", f"query {self._collection}") as attrs:
+            async for doc in self._target.stream(*args, **kwargs):
+                count += 1
+                yield doc
+            attrs["documents"] = count
+        firestore_documents.inc(max(1, count), op="read")
+
+
+class TracedBatch(_Traced):
+
+    def __init__(self, target):
+        super().__init__(target, "batch")
+        self._writes = 0
+
+    def set(self, reference, *args, **kwargs):
+        self._writes += 1
+        return self._target.set(_unwrap(reference), *args, **kwargs)
+
+    def update(self, reference, *args, **kwargs):
+        self._writes += 1
+        return self._target.update(_unwrap(reference), *args, **kwargs)
+
+    def delete(self, reference, *args, **kwargs):
+        self._writes += 1
+        return self._target.delete(_unwrap(reference), *args, **kwargs)
+
+    async def commit(self, *args, **kwargs):
+        with span("firestore", "commit batch", writes=self._writes):
+            result = await self._target.commit(*args, **kwargs)
+        firestore_documents.inc(self._writes, op="write")
+        return result
+
+
+class TracedFirestore(_Traced):
+
+    def __init__(self, client):
+        super().__init__(client, "")
+
+    def collection(self, name: str) -> TracedQuery:
+        return TracedQuery(self._target.collection(name), name)
+
+    def collection_group(self, name: str) -> TracedQuery:
+        return TracedQuery(self._target.collection_group(name), name)
+
+    def document(self, path: str) -> TracedDocument:
+        collection = path.rsplit("/", 2)[-2] if "/" in path else path
+        return TracedDocument(self._target.document(path), collection)
+
+    def batch(self) -> TracedBatch:
+        return TracedBatch(self._target.batch())
@@ -0,0 +1,243 @@
+"""
+Batched and coalesced Firestore writes.
+
+UnitOfWork collects the writes of one request (or one page of a job) and commits
+them as a single batch: one round-trip instead of one per document, and no window
+in which only some of them are applied. A write to a document already in the unit
+is merged into the pending one where that gives the same result.
+
+WriteBehind goes further for documents that many requests write and nobody reads
+back right away, like a form's aggregates: merge writes are held for
+`window_seconds`, those to the same document combined (Increment amounts summed,
+Minimum/Maximum folded), and all of them committed together. Writes held when the
+process dies are lost, so it is only for data that can be rebuilt.
+
+write_stats counts the writes asked for, the commits made and the round-trips saved.
+"""
+import asyncio
+import threading
+from typing import Dict, List, Union
+
+from google.cloud.firestore_v1 import transforms
+
+from lib.metrics import registry
+
+# Most writes a Firestore batch may hold.
+MAX_BATCH_WRITES = 500
+
+_round_trips_saved = registry.counter(
+    "firestore_round_trips_saved_total", "Write round-trips saved by batching and coalescing.", ["source"])
+_writes_coalesced = registry.counter(
+    "firestore_writes_coalesced_total", "Writes merged into another write to the same document.", ["source"])
+
+
+class WriteStats:
+    """
+    Process-wide write counters, so the effect of batching can be measured.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.documents = 0
+        self.commits = 0
+
+    def record(self, writes: int, documents: int, commits: int, source: str):
+        with self._lock:
+            self.writes += writes
+            self.documents += documents
+            self.commits += commits
+        _round_trips_saved.inc(writes - commits, source=source)
+        _writes_coalesced.inc(writes - documents, source=source)
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "writes": self.writes,
+                "documents_written": self.documents,
+                "commits": self.commits,
+                "round_trips_saved": self.writes - self.commits,
+            }
+
+
+write_stats = WriteStats()
+
+
+def merge_fields(older: Dict, newer: Dict) -> Dict:
+    """
+    The fields of two set(merge=True) writes to the same document as one write.
+    """
+    merged = dict(older)
+    for key, value in newer.items():
+        current = merged.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            merged[key] = merge_fields(current, value)
+        elif isinstance(value, transforms.Increment) and isinstance(current, transforms.Increment):
+            merged[key] = transforms.Increment(current.value + value.value)
+        elif isinstance(value, transforms.Minimum) and isinstance(current, transforms.Minimum):
+            merged[key] = transforms.Minimum(min(current.value, value.value))
+        elif isinstance(value, transforms.Maximum) and isinstance(current, transforms.Maximum):
+            merged[key] = transforms.Maximum(max(current.value, value.value))
+        else:
+            merged[key] = value
+    return merged
+
+
+def _overlapping(older: Dict, newer: Dict) -> bool:
+    # update() keys are field paths: "a" and "a.b" can't be merged as plain keys.
+    for key in newer:
+        for other in older:
+            if key != other and (key.startswith(other + ".") or other.startswith(key + ".")):
+                return True
+    return False
+
+
+class _Write:
+
+    def __init__(self, kind: str, reference, data: Union[Dict, None] = None, merge: bool = False, option=None):
+        self.kind = kind
+        self.reference = reference
+        self.data = data
+        self.merge = merge
+        self.option = option
+
+
+def _combine(older: _Write, newer: _Write) -> Union[_Write, None]:
+    """
+    One write with the effect of `older` followed by `newer`, or None if there is none.
+    """
+    if older.option is not None or newer.option is not None:
+        return None  # each precondition has to be checked as written
+    if newer.kind == "delete" or (newer.kind == "set" and not newer.merge):
+        return newer
+    if older.kind == "set" and older.merge and newer.kind == "set":
+        return _Write("set", older.reference, merge_fields(older.data, newer.data), merge=True)
+    if older.kind == "update" and newer.kind == "update" and not _overlapping(older.data, newer.data):
+        return _Write("update", older.reference, {**older.data, **newer.data})
+    return None
+
+
+class UnitOfWork:
+    """
+    Writes staged with set/update/delete and committed as one batch by commit().
+    """
+
+    def __init__(self, db, source: str = "unit"):
+        self._db = db
+        self.source = source
+        self._writes: List[_Write] = []
+        self._last: Dict[str, _Write] = {}  # document path -> its latest write
+        self._requested = 0
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def set(self, reference, data: Dict, merge: bool = False):
+        self._add(_Write("set", reference, data, merge=merge))
+
+    def update(self, reference, data: Dict, option=None):
+        self._add(_Write("update", reference, data, option=option))
+
+    def delete(self, reference):
+        self._add(_Write("delete", reference))
+
+    def _add(self, write: _Write):
+        self._requested += 1
+        path = write.reference.path
+        last = self._last.get(path)
+        combined = _combine(last, write) if last is not None else None
+        if combined is not None:
+            self._writes[self._writes.index(last)] = combined
+        else:
+            self._writes.append(write)
+            combined = write
+        self._last[path] = combined
+
+    async def commit(self):
+        """
+        Apply all staged writes atomically. Raises like the batch commit would (e.g.
+        FailedPrecondition), in which case nothing was written.
+        """
+        if not self._writes:
+            return
+        if len(self._writes) > MAX_BATCH_WRITES:
+            raise ValueError(f"A unit of work holds at most {MAX_BATCH_WRITES} writes, not {len(self._writes)}")
+        batch = self._db.batch()
+        for write in self._writes:
+            if write.kind == "set":
+                batch.set(write.reference, write.data, merge=write.merge)
+            elif write.kind == "update":
+                batch.update(write.reference, write.data, option=write.option)
+            else:
+                batch.delete(write.reference)
+        await batch.commit()
+        write_stats.record(self._requested, len(self._writes), 1, self.source)
+        self._writes, self._last, self._requested = [], {}, 0
+
+
+class WriteBehind:
+    """
+    Holds set(merge=True) writes for `window_seconds` and commits them coalesced.
+    With a window of 0 every merge is written right away.
+    """
+
+    def __init__(self, db, window_seconds: float):
+        self._db = db
+        self.window_seconds = window_seconds
+        self._pending: Dict[str, _Write] = {}
+        self._counts: Dict[str, int] = {}  # document path -> writes merged into its pending one
+        self._flush_task: Union[asyncio.Task, None] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def merge(self, reference, data: Dict):
+        if self.window_seconds <= 0:
+            await reference.set(data, merge=True)
+            return
+        self._hold(reference, data, 1)
+
+    def _hold(self, reference, data: Dict, count: int):
+        path = reference.path
+        pending = self._pending.get(path)
+        if pending is not None:
+            data = merge_fields(pending.data, data)
+        self._pending[path] = _Write("set", reference, data, merge=True)
+        self._counts[path] = self._counts.get(path, 0) + count
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window_seconds)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        Commit the held writes now. Writes that fail are held again for the next flush.
+        """
+        pending, counts = list(self._pending.items()), self._counts
+        self._pending, self._counts = {}, {}
+        for start in range(0, len(pending), MAX_BATCH_WRITES):
+            chunk = pending[start:start + MAX_BATCH_WRITES]
+            batch = self._db.batch()
+            for _, write in chunk:
+                batch.set(write.reference, write.data, merge=True)
+            try:
+                await batch.commit()
+            except Exception as e:
+                print(f"Write-behind flush of {len(chunk)} documents failed, keeping them: {e!r}")
+                for path, write in pending[start:]:
+                    self._hold(write.reference, write.data, counts[path])
+                return
+            write_stats.record(sum(counts[path] for path, _ in chunk), len(chunk), 1, "write_behind")
+
+    async def close(self):
+        """
+        Stop the timer and write everything still held.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._pending:
+            await self.flush()
@@ -1,14 +1,23 @@
 import sys
 import os
+import time
+import asyncio
 import datetime
+import hashlib
 import json
+import re
+from contextlib import asynccontextmanager, nullcontext
 from typing import Union, List, Dict
 
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Header, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
-import firebase_admin
-from firebase_admin import credentials, firestore, auth
+from dotenv import load_dotenv
+from firebase_admin import firestore, firestore_async, auth
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1.base_query import FieldFilter
 
 # Adjust sys.path so we can import modules from the parent directory.
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -16,9 +25,58 @@ parent_dir = os.path.abspath(os.path.join(current_dir, ".."))
 if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
-from langchain.genericLLMFunction import generateLlmResponse, parse_final_conversation_to_json
+# Before the imports below: they read their settings from the environment.
+load_dotenv()
 
-app = FastAPI()
+from langchain.genericLLMFunction import (
+    FINALIZE_PHRASE,
+    GOODBYE_MESSAGE,
+    agenerateLlmResponse,
+    aparse_final_conversation_to_json,
+    astreamLlmResponse,
+)
+from langchain.budget import BudgetExceeded, TokenLedger, get_ledger, set_ledger
+from langchain.llm import LLMError, get_provider
+from langchain.routing import get_router
+from langchain.scheduler import BATCH, get_scheduler
+from langchain.context import collected_summary, context_stats, pending_inputs
+from langchain.extraction import assemble_result, is_complete, merge_fields
+from langchain.form_schema import compile_form, inputs_hash
+from langchain.greeting import agenerate_greeting, render_greeting, static_greeting
+from langchain.slot_filling import asked_field, fill_slot, next_question as slot_question, slot_stats
+from lib.aggregates import AGGREGATE_DOC, AGGREGATES_COLLECTION, result_increments, summarize
+from lib.cache import TTLCache
+from lib.firebase import LazyClient, firebase_app
+from lib.export import CONTENT_TYPES, FORMATS, encoder, export_columns, parquet_available, to_row
+from lib.jobs import JobQueue, WorkerPool
+from lib.listeners import ListenerHub
+from lib.metrics import registry
+from lib.tracing import TracedFirestore, TracingMiddleware, span
+from lib.unit_of_work import MAX_BATCH_WRITES, UnitOfWork, WriteBehind, write_stats
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    """
+    Start the finalization workers and their recovery sweep and, unless WARMUP=0, warm
+    up the backend connections in the background (see _warm_up and /ready); close it
+    all on shutdown.
+    """
+    await _start_workers()
+    recovery = asyncio.create_task(_recover_finalizations_periodically())
+    warmup = asyncio.create_task(_warm_up()) if WARMUP else None
+    try:
+        yield
+    finally:
+        if warmup is not None:
+            warmup.cancel()
+        recovery.cancel()
+        await _stop_workers()
+        await _aggregate_writes.close()
+        await _usage_writes.close()
+        await _close_llm_provider()
+        _close_listeners()
+
+app = FastAPI(lifespan=_lifespan)
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -37,12 +95,120 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize Firebase Admin with your service account key.
-cred = credentials.Certificate("firestore_key.json")
-firebase_admin.initialize_app(cred)
+# Times every request and the backend calls it makes; requests slower than
+# SLOW_REQUEST_SECONDS are logged with a per-call breakdown (0 disables the log).
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0"))
+app.add_middleware(TracingMiddleware, slow_seconds=SLOW_REQUEST_SECONDS)
+
+# The async Firestore client, so endpoints await reads/writes instead of blocking
+# a threadpool worker on each round-trip. Every call is traced. It is created (and
+# Firebase Admin initialized with the service account key) on first use, not at import.
+_firestore_client = LazyClient(lambda: firestore_async.client(firebase_app()))
+db = TracedFirestore(_firestore_client)
+
+# ----------------------------
+# Finalization queue
+# ----------------------------
+
+# Completed sessions are finalized in the background by a pool of workers fed from a
+# durable SQLite queue, so a slow or failing LLM parse never fails the patient's
+# last message, and no result is lost if the process restarts.
+#
+# The queue is a file local to each replica: /finalization/status, /dead_letters and
+# /finalization/retry only know the jobs of the replica that answers. A replica that
+# is scaled away (or dies between marking a session "queued" and enqueueing it)
+# takes its queue with it, so every replica also sweeps Firestore for sessions left
+# "queued" for FINALIZATION_RECOVERY_AGE seconds, on startup and every
+# FINALIZATION_RECOVERY_INTERVAL seconds, and finalizes them (see
+# _recover_finalizations). The session's "finalization" field is the source of truth.
+FINALIZE_JOB = "finalize_session"
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.sqlite3")
+FINALIZATION_WORKERS = int(os.getenv("FINALIZATION_WORKERS", "4"))
+FINALIZATION_MAX_ATTEMPTS = int(os.getenv("FINALIZATION_MAX_ATTEMPTS", "5"))
+FINALIZATION_RECOVERY_AGE = float(os.getenv("FINALIZATION_RECOVERY_AGE", "600"))
+FINALIZATION_RECOVERY_INTERVAL = float(os.getenv("FINALIZATION_RECOVERY_INTERVAL", "300"))
+# With a window, the aggregate increments of results finalized within it are merged
+# into one write of the form's aggregates document instead of one per result. They
+# are then no longer atomic with the result: increments held when the process dies
+# are lost (server/rebuild_aggregates.py recomputes them). 0 writes them with the result.
+AGGREGATES_WRITE_BEHIND_SECONDS = float(os.getenv("AGGREGATES_WRITE_BEHIND_SECONDS", "0"))
+
+_queue: Union[JobQueue, None] = None
+_workers: Union[WorkerPool, None] = None
+_aggregate_writes = WriteBehind(db, AGGREGATES_WRITE_BEHIND_SECONDS)
+
+def _job_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        _queue = JobQueue(JOB_DB_PATH, max_attempts=FINALIZATION_MAX_ATTEMPTS)
+    return _queue
+
+async def _start_workers():
+    global _workers
+    _workers = WorkerPool(_job_queue(), {FINALIZE_JOB: _run_finalization, REEXTRACT_JOB: _run_reextraction},
+                          concurrency=FINALIZATION_WORKERS)
+    _workers.start()
+
+async def _stop_workers():
+    if _workers is not None:
+        await _workers.stop()
+
+async def _close_llm_provider():
+    await get_provider().aclose()
+
+def _close_listeners():
+    _listeners.close()
+
+# ----------------------------
+# Warmup
+# ----------------------------
+
+# A new replica opens its Firestore, Auth and LLM connections (TLS handshakes, OAuth
+# tokens, connection pools) before /ready reports it ready, so a patient's first
+# request doesn't pay for them. Set WARMUP=0 to skip it.
+WARMUP = os.getenv("WARMUP", "1") != "0"
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+
+_warmup_seconds = registry.gauge("warmup_seconds", "Time each warmup step took.", ["step"])
+_warmup: Dict[str, Dict] = {}
+_warmed_up = False
+
+async def _warm_firestore():
+    # Reading a missing document is enough to open the channel.
+    await db.collection("warmup").document("ping").get()
+
+def _warm_auth():
+    try:
+        auth.get_user("warmup-ping", app=firebase_app())
+    except auth.UserNotFoundError:
+        pass
+
+async def _warm_up():
+    """
+    Run the warmup steps concurrently, recording how long each took. A failed step
+    is logged and reported by /ready but doesn't keep the replica unready: the
+    connection is then opened by the first request that needs it.
+    """
+    global _warmed_up
+
+    async def timed(name: str, step):
+        started = time.perf_counter()
+        error = None
+        try:
+            await asyncio.wait_for(step, WARMUP_TIMEOUT)
+        except Exception as e:
+            error = repr(e)
+            print(f"Warmup of {name} failed: {e!r}")
+        seconds = time.perf_counter() - started
+        _warmup_seconds.set(seconds, step=name)
+        _warmup[name] = {"seconds": round(seconds, 3), "error": error}
 
-# Initialize Firestore client.
-db = firestore.client()
+    await asyncio.gather(
+        timed("firestore", _warm_firestore()),
+        timed("auth", run_in_threadpool(_warm_auth)),
+        timed("llm", get_provider().warmup()),
+    )
+    _warmed_up = True
 
 # ----------------------------
 # Models
@@ -55,20 +221,86 @@ class SendMessageRequest(BaseModel):
     patient_id: str
     message: str
 
+class EnrollmentRequest(BaseModel):
+    emails: List[str]
+
+class BudgetRequest(BaseModel):
+    tokens: Union[int, None]  # None: back to the default budget
+
 # ----------------------------
 # Endpoints
 # ----------------------------
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"Hello": "World"}
 
+@app.get("/ready")
+async def get_ready(response: Response):
+    """
+    Readiness probe: 503 until the warmup finished, then 200. Reports how long each
+    warmup step took and its error, if any.
+    """
+    ready = _warmed_up or not WARMUP
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready, "warmup": _warmup}
+
+@app.get("/stats")
+async def get_stats():
+    """
+    Process-wide counters, e.g. how many prompt tokens the context budget saved.
+    """
+    return {
+        "context": context_stats.as_dict(),
+        "slot_filling": slot_stats.as_dict(),
+        "finalization": _job_queue().counts(),
+        "greetings": {"hits": _greeting_cache.hits, "misses": _greeting_cache.misses},
+        "llm_scheduler": get_scheduler().stats(),
+        "llm_routing": get_router().stats(),
+        "firestore_writes": write_stats.as_dict(),
+    }
+
+_finalization_jobs = registry.gauge("finalization_jobs", "Finalization jobs by status.", ["status"])
+_cache_entries = registry.gauge("cache_entries", "Entries held by in-process caches.", ["cache"])
+_cache_lookups = registry.counter("cache_lookups_total", "Lookups of in-process caches.", ["cache", "result"])
+_slot_filling = registry.gauge("slot_filling_turns", "Turns tried on the local fast path.", ["result"])
+_prompt_tokens_dropped = registry.counter(
+    "prompt_tokens_dropped_total",
+    "Prompt tokens dropped to fit LLM_PROMPT_TOKEN_BUDGET, measured after the history cap and requirement reduction.")
+
+def _collect_metrics():
+    for status, count in _job_queue().counts().items():
+        _finalization_jobs.set(count, status=status)
+    for name, cache in (("patients", _patient_cache), ("forms", _form_cache), ("greetings", _greeting_cache),
+                        ("enrollments", _enrollment_cache)):
+        _cache_entries.set(len(cache), cache=name)
+        _cache_lookups.set_total(cache.hits, cache=name, result="hit")
+        _cache_lookups.set_total(cache.misses, cache=name, result="miss")
+    slots = slot_stats.as_dict()
+    _slot_filling.set(slots["hits"], result="hit")
+    _slot_filling.set(slots["attempts"] - slots["hits"], result="miss")
+    context = context_stats.as_dict()
+    _prompt_tokens_dropped.set_total(context["budgeted_prompt_tokens"] - context["prompt_tokens"])
+    get_scheduler().collect_metrics()
+
+registry.add_collector(_collect_metrics)
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Counters and latency histograms in the Prometheus text format: HTTP requests per
+    route, backend calls (span_duration_seconds{kind="firestore"|"auth"|"llm"}),
+    LLM tokens, retries and queue depths, finalization jobs and caches.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/items/{item_id}")
-def read_item(item_id: int, q: Union[str, None] = None):
+async def read_item(item_id: int, q: Union[str, None] = None):
     return {"item_id": item_id, "q": q}
 
 @app.get("/get_form/{admin_id}/{form_id}")
-def get_form(admin_id: str, form_id: str):
+async def get_form(admin_id: str, form_id: str, definition_only: bool = False):
     """
     Retrieve a form from Firestore.
     
@@ -77,202 +309,1767 @@ def get_form(admin_id: str, form_id: str):
          └── {admin_id} (document)
              └── forms (subcollection)
                   └── {form_id} (document) with fields such as "title", "inputs", and "users".
+
+    With `definition_only`, only the form definition (FORM_FIELDS) is returned, served
+    from the form cache, without past submissions and enrolled patients.
     """
     try:
-        form_ref = db.collection("admin").document(admin_id).collection("forms").document(form_id)
-        form_doc = form_ref.get()
-        if form_doc.exists:
-            return form_doc.to_dict()
+        if definition_only:
+            form_data = await _get_form_definition(admin_id, form_id)
         else:
-            raise HTTPException(status_code=404, detail="Form not found")
+            form_doc = await _form_ref(admin_id, form_id).get()
+            form_data = form_doc.to_dict() if form_doc.exists else None
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if form_data is None:
+        raise HTTPException(status_code=404, detail="Form not found")
+    return form_data
 
-@app.post("/start_session/{admin_id}/{form_id}")
-def start_session(admin_id: str, form_id: str, start_req: StartSessionRequest):
+# ----------------------------
+# Patient lookups
+# ----------------------------
+
+# Firebase Auth user records (name/email) shared by all endpoints. They almost
+# never change, so a turn shouldn't pay an Auth round-trip for them.
+_patient_cache = TTLCache(
+    maxsize=int(os.getenv("PATIENT_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PATIENT_CACHE_TTL", "600")),
+)
+
+async def _get_patient(patient_id: str) -> Dict[str, str]:
     """
-    Start a new chat session for a given patient using a specified form.
-    
-    Process:
-      1. Retrieve the form from Firestore at admin/{admin_id}/forms/{form_id}.
-      2. Check if the patient's email (retrieved via Firebase Auth) is approved in the form's "users" list.
-      3. Initialize conversation history as an empty list.
-      4. Generate the initial bot question by calling generateLlmResponse with the first input's description.
-      5. Append the bot's response (with role "assistant") to the conversation.
-      6. Save the session in a "sessions" subcollection under the form.
-      7. Return the session id and the initial bot question.
+    Return {"name": ..., "email": ...} for a Firebase Auth uid, served from the cache when possible.
+    Errors from auth.get_user (e.g. unknown uid) are propagated and never cached.
     """
-    patient_id = start_req.patient_id
+    patient = _patient_cache.get(patient_id)
+    if patient is None:
+        # firebase_admin.auth has no async API, so run the lookup off the event loop.
+        with span("auth", "get_user"):
+            user_record = await run_in_threadpool(auth.get_user, patient_id, app=firebase_app())
+        patient = {"name": user_record.display_name, "email": user_record.email}
+        _patient_cache.set(patient_id, patient)
+    return patient
+
+def invalidate_patient(patient_id: str):
+    """
+    Drop a cached patient record, e.g. when their name or email may have changed.
+    """
+    _patient_cache.invalidate(patient_id)
+
+async def _session_patient(session_data: Dict, patient_id: str) -> Dict[str, str]:
+    """
+    Patient name/email for a turn. Sessions store them at start, so only sessions
+    created before that fall back to the (cached) Auth lookup.
+    """
+    if "patient_name" in session_data and "email" in session_data:
+        return {"name": session_data["patient_name"], "email": session_data["email"]}
+    return await _get_patient(patient_id)
+
+# ----------------------------
+# Form definitions
+# ----------------------------
+
+# The parts of a form document needed to run sessions. Reads are projected onto
+# these fields so they don't download the form's stored results, nor its legacy
+# "users" list (see Enrollment).
+FORM_FIELDS = ["title", "inputs", "version"]
+
+# Form definitions keyed by (admin_id, form_id). The admin UI increments the form's
+# "version" on every edit, so after FORM_CACHE_REVALIDATE seconds a cached entry is
+# revalidated by reading only that field, and reloaded only if it changed.
+FORM_CACHE_REVALIDATE = float(os.getenv("FORM_CACHE_REVALIDATE", "15"))
+_form_cache = TTLCache(
+    maxsize=int(os.getenv("FORM_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("FORM_CACHE_TTL", "3600")),
+)
+
+def _form_ref(admin_id: str, form_id: str):
+    return db.collection("admin").document(admin_id).collection("forms").document(form_id)
+
+def _tenant(admin_id: str, form_id: str) -> str:
+    # LLM calls are queued fairly per form (see langchain.scheduler).
+    return f"{admin_id}/{form_id}"
 
-    # Retrieve form document.
-    form_ref = db.collection("admin").document(admin_id).collection("forms").document(form_id)
-    form_doc = form_ref.get()
+async def _get_form_definition(admin_id: str, form_id: str) -> Union[Dict, None]:
+    """
+    Return the form's definition ({"title", "inputs", "version"}), or None if
+    the form doesn't exist.
+    """
+    key = (admin_id, form_id)
+    form_ref = _form_ref(admin_id, form_id)
+    entry = _form_cache.get(key)
+    if entry is not None:
+        if time.monotonic() - entry["checked_at"] < FORM_CACHE_REVALIDATE:
+            return entry["form"]
+        # Forms created before versioning have no version to compare, so reload them.
+        if entry["form"].get("version") is not None:
+            version_doc = await form_ref.get(field_paths=["version"])
+            if version_doc.exists and (version_doc.to_dict() or {}).get("version") == entry["form"]["version"]:
+                entry["checked_at"] = time.monotonic()
+                return entry["form"]
+
+    form_doc = await form_ref.get(field_paths=FORM_FIELDS)
     if not form_doc.exists:
-        raise HTTPException(status_code=404, detail="Form not found")
+        _form_cache.invalidate(key)
+        return None
     form_data = form_doc.to_dict()
-    
-    # Check patient approval via Firebase Auth.
+    form_data.setdefault("version", None)
+    _form_cache.set(key, {"form": form_data, "checked_at": time.monotonic()})
+    return form_data
+
+def invalidate_form(admin_id: str, form_id: str):
+    """
+    Drop a cached form definition, e.g. after the server itself changed the form.
+    """
+    _form_cache.invalidate((admin_id, form_id))
+
+# ----------------------------
+# Enrollment
+# ----------------------------
+
+# Patients enrolled in a form, one document per patient, keyed by the hash of
+# their email:
+#
+#   admin/{admin_id}/forms/{form_id}/enrollments/{enrollment_id}
+#
+# so checking a patient is a single document read, however many are enrolled.
+# Forms edited by the admin UI still list their patients in the form's "users"
+# array; a patient without an enrollment document is looked up there, in a set
+# built once per form version.
+ENROLLMENT_CACHE_TTL = float(os.getenv("ENROLLMENT_CACHE_TTL", "300"))
+_enrollment_cache = TTLCache(
+    maxsize=int(os.getenv("ENROLLMENT_CACHE_SIZE", "100000")),
+    ttl=ENROLLMENT_CACHE_TTL,
+)
+# frozenset of normalized emails keyed by (admin_id, form_id, version).
+_legacy_users_cache = TTLCache(
+    maxsize=int(os.getenv("FORM_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("FORM_CACHE_TTL", "3600")),
+)
+
+_enrollment_lookups = registry.counter(
+    "enrollment_lookups_total", "Patient enrollment checks by where they were answered.", ["source"])
+
+def _normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+def _enrollment_id(email: str) -> str:
+    return hashlib.sha256(_normalize_email(email).encode("utf-8")).hexdigest()
+
+def _enrollments_ref(admin_id: str, form_id: str):
+    return _form_ref(admin_id, form_id).collection("enrollments")
+
+async def _legacy_users(admin_id: str, form_id: str, version) -> frozenset:
+    key = (admin_id, form_id, version)
+    users = _legacy_users_cache.get(key) if version is not None else None
+    if users is None:
+        form_doc = await _form_ref(admin_id, form_id).get(field_paths=["users"])
+        users = frozenset(_normalize_email(email) for email in (form_doc.to_dict() or {}).get("users") or [])
+        if version is not None:
+            _legacy_users_cache.set(key, users)
+    return users
+
+async def _is_enrolled(admin_id: str, form_id: str, form_data: Dict, email: Union[str, None]) -> bool:
+    """
+    Whether the patient with this email may fill in the form. Only enrollments are
+    cached; a refused patient is checked again on their next try.
+    """
+    if not email:
+        return False
+    key = (admin_id, form_id, _normalize_email(email))
+    if _enrollment_cache.get(key):
+        _enrollment_lookups.inc(source="cache")
+        return True
+
+    enrollment_doc = await _enrollments_ref(admin_id, form_id).document(_enrollment_id(email)).get(field_paths=["email"])
+    if enrollment_doc.exists:
+        source = "document"
+    elif key[2] in await _legacy_users(admin_id, form_id, form_data.get("version")):
+        source = "legacy"
+    else:
+        _enrollment_lookups.inc(source="denied")
+        return False
+    _enrollment_lookups.inc(source=source)
+    _enrollment_cache.set(key, True)
+    return True
+
+async def _write_enrollments(admin_id: str, form_id: str, emails: List[str], enroll: bool) -> int:
+    """
+    Create or delete the enrollment documents of `emails`, a batch per
+    MAX_BATCH_WRITES of them. Unenrolling also removes the emails from the form's
+    legacy "users" array. Returns the number of distinct emails.
+    """
+    normalized = sorted({_normalize_email(email) for email in emails if email and email.strip()})
+    form_ref = _form_ref(admin_id, form_id)
+    legacy = []
+    if not enroll:
+        # The array keeps emails as the admin typed them.
+        form_doc = await form_ref.get(field_paths=["users"])
+        wanted = set(normalized)
+        legacy = [email for email in (form_doc.to_dict() or {}).get("users") or []
+                  if _normalize_email(email) in wanted]
+
+    enrollments_ref = _enrollments_ref(admin_id, form_id)
+    now = datetime.datetime.utcnow()
+    # The form document update takes one write of the first batch.
+    chunk_size = MAX_BATCH_WRITES - (1 if legacy else 0)
+    for start in range(0, len(normalized), chunk_size):
+        unit = UnitOfWork(db, "enrollment")
+        for email in normalized[start:start + chunk_size]:
+            enrollment_ref = enrollments_ref.document(_enrollment_id(email))
+            if enroll:
+                unit.set(enrollment_ref, {"email": email, "enrolled_at": now})
+            else:
+                unit.delete(enrollment_ref)
+        if legacy and start == 0:
+            # The version bump makes every instance rebuild its set of legacy users.
+            unit.update(form_ref, {"users": firestore.ArrayRemove(legacy), "version": firestore.Increment(1)})
+        await unit.commit()
+
+    for email in normalized:
+        _enrollment_cache.invalidate((admin_id, form_id, email))
+    if legacy:
+        invalidate_form(admin_id, form_id)
+    return len(normalized)
+
+# ----------------------------
+# Token usage
+# ----------------------------
+
+# Tokens used by each admin and form, per model, with their budgets (see
+# langchain.budget):
+#
+#   admin/{admin_id}/usage/tokens
+#   admin/{admin_id}/forms/{form_id}/usage/tokens
+#
+# Every LLM call adds to both. The counts of calls made within
+# TOKEN_USAGE_WRITE_BEHIND_SECONDS are merged into one write per document; those
+# held when the process dies are lost, but each session keeps its own count.
+TOKEN_USAGE_WRITE_BEHIND_SECONDS = float(os.getenv("TOKEN_USAGE_WRITE_BEHIND_SECONDS", "2"))
+_usage_writes = WriteBehind(db, TOKEN_USAGE_WRITE_BEHIND_SECONDS)
+
+def _usage_ref(scope: tuple):
+    if len(scope) == 1:
+        return db.collection("admin").document(scope[0]).collection("usage").document("tokens")
+    return _form_ref(*scope).collection("usage").document("tokens")
+
+def _model_key(model: str) -> str:
+    # Model names like "gpt-3.5-turbo" aren't valid Firestore field names.
+    return re.sub(r"[^A-Za-z0-9_]", "_", model)
+
+async def _load_token_usage(scope: tuple) -> Dict:
+    usage_doc = await _usage_ref(scope).get(field_paths=["prompt_tokens", "completion_tokens", "budget"])
+    return usage_doc.to_dict() or {}
+
+async def _save_token_usage(scope: tuple, model: str, prompt_tokens: int, completion_tokens: int):
+    counts = {
+        "prompt_tokens": firestore.Increment(prompt_tokens),
+        "completion_tokens": firestore.Increment(completion_tokens),
+        "calls": firestore.Increment(1),
+    }
+    await _usage_writes.merge(_usage_ref(scope), {**counts, "models": {_model_key(model): counts}})
+
+set_ledger(TokenLedger(load=_load_token_usage, save=_save_token_usage))
+
+# ----------------------------
+# Opening questions
+# ----------------------------
+
+# Opening question templates keyed by inputs_hash(inputs). They are also stored in
+# the top-level "greetings" collection, so they survive restarts and are shared by
+# all instances; editing a form's inputs changes the hash, so stale entries are
+# simply never read again.
+_greeting_cache = TTLCache(
+    maxsize=int(os.getenv("GREETING_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("GREETING_CACHE_TTL", "86400")),
+)
+_greeting_inflight: Dict[str, asyncio.Task] = {}
+
+async def _load_greeting(key: str, inputs: List[Dict], usage: Dict, tenant: str) -> str:
+    greeting_ref = db.collection("greetings").document(key)
+    greeting_doc = await greeting_ref.get()
+    if greeting_doc.exists:
+        return greeting_doc.to_dict()["template"]
     try:
-        user_record = auth.get_user(patient_id)
-        patient_name = user_record.display_name
-        patient_email = user_record.email
+        template = await agenerate_greeting(inputs, usage, tenant)
+    except ValueError as e:
+        # The model's reply didn't make a reusable template. Store the static one
+        # instead, so neither this nor another replica asks the model for it again.
+        print(e)
+        template = static_greeting(inputs)
+    await greeting_ref.set({"template": template, "created_at": datetime.datetime.utcnow()})
+    return template
+
+async def _opening_question(inputs: List[Dict], name: str, usage: Dict, tenant: str) -> str:
+    """
+    The first question of a session, from the cached template for the form's inputs.
+    Only the first session of a new form schema waits for the model; its prompt
+    tokens are written into `usage`. `tenant` is the form's LLM scheduling tenant.
+    Raises LLMError if the model is unavailable, except for a used up token budget.
+    """
+    key = inputs_hash(inputs)
+    template = _greeting_cache.get(key)
+    if template is None:
+        # Sessions starting at the same time share one generation.
+        task = _greeting_inflight.get(key)
+        joined = task is not None
+        if task is None:
+            task = asyncio.ensure_future(_load_greeting(key, inputs, usage, tenant))
+            _greeting_inflight[key] = task
+            task.add_done_callback(lambda _: _greeting_inflight.pop(key, None))
+        try:
+            # The generation's own spans belong to the session that started it.
+            with span("llm", "greeting_wait") if joined else nullcontext():
+                template = await asyncio.shield(task)
+        except BudgetExceeded:
+            # Starting costs nothing without the model; the template is generated
+            # by a later session once the budget was raised.
+            return render_greeting(static_greeting(inputs), name)
+        _greeting_cache.set(key, template)
+    return render_greeting(template, name)
+
+# ----------------------------
+# Session helpers
+# ----------------------------
+
+async def _known_patient(patient_id: str) -> Dict[str, str]:
+    try:
+        return await _get_patient(patient_id)
     except Exception as e:
         print(e)
         raise HTTPException(status_code=400, detail="Invalid patient uid provided")
+
+async def _prepare_session(admin_id: str, form_id: str, patient_id: str):
+    """
+    Check that the patient may fill in the form and return (patient, inputs),
+    where patient is {"name": ..., "email": ...}.
+
+    Raises the same HTTP errors as start_session for a missing form, unknown patient,
+    unapproved patient or a form without inputs. A used up token budget doesn't stop
+    a session from starting: only the turns that need the model fail (with 429).
+    """
+    # Retrieve the form definition.
+    form_data = await _get_form_definition(admin_id, form_id)
+    if form_data is None:
+        raise HTTPException(status_code=404, detail="Form not found")
     
-    approved_users = form_data.get("users", [])
-    if patient_email not in approved_users:
-        raise HTTPException(status_code=401, detail="Patient not authorized for this form")
-    
+    # Check patient approval via Firebase Auth.
+    patient = await _known_patient(patient_id)
+    if not await _is_enrolled(admin_id, form_id, form_data, patient["email"]):
+        # The cached record may predate a change of email: check a fresh one once.
+        invalidate_patient(patient_id)
+        patient = await _known_patient(patient_id)
+        if not await _is_enrolled(admin_id, form_id, form_data, patient["email"]):
+            raise HTTPException(status_code=401, detail="Patient not authorized for this form")
+
     # Retrieve input definitions.
     inputs = form_data.get("inputs", [])
     if not inputs:
         raise HTTPException(status_code=400, detail="Form does not have any input fields")
-    
-    # Initialize conversation history as an empty list.
-    conversation: List[Dict[str, str]] = []
-    # Generate the initial question using the first input's description.
-    initial_question, _ = generateLlmResponse(json.dumps(inputs), patient_name, conversation)
-    conversation.append({"role": "assistant", "content": initial_question})
-
-    # Prepare the session document data.
-    session_data = {
+
+    return patient, inputs
+
+def _new_session_data(admin_id: str, form_id: str, patient_id: str, patient, inputs):
+    return {
         "admin_id": admin_id,
         "form_id": form_id,
         "patient_id": patient_id,  # stored for reference if needed
+        "patient_name": patient["name"],  # so later turns don't need an Auth lookup
+        "email": patient["email"],
         "created_at": datetime.datetime.utcnow(),
         "current_field_index": 0,  # indicates which input is currently being processed
         "inputs": inputs,
-        "conversation": conversation
+        "message_count": 0,  # number of documents in the "messages" subcollection
     }
 
+async def _load_session_snapshot(admin_id: str, form_id: str, session_id: str):
+    """
+    Return (form_ref, session_ref, session_doc) for an existing session, or raise 404.
+    """
+    form_ref = _form_ref(admin_id, form_id)
+
+    # Retrieve the session document using the full path.
+    session_ref = form_ref.collection("sessions").document(session_id)
+    session_doc = await session_ref.get()
+    if not session_doc.exists:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return form_ref, session_ref, session_doc
+
+async def _load_session(admin_id: str, form_id: str, session_id: str):
+    """
+    Return (form_ref, session_ref, session_data) for an existing session, or raise 404.
+    """
+    form_ref, session_ref, session_doc = await _load_session_snapshot(admin_id, form_id, session_id)
+    return form_ref, session_ref, session_doc.to_dict()
+
+# ----------------------------
+# Conversation storage
+# ----------------------------
+#
+# Messages are stored one document each, in order, under
+#   admin/{admin_id}/forms/{form_id}/sessions/{session_id}/messages/{seq}
+# with the session document's "message_count" tracking the next seq. A turn only
+# writes its new messages instead of re-uploading the whole history.
+#
+# Sessions created before this keep their history in a "conversation" array on the
+# session document. It is still read as-is, and moved into the subcollection the
+# first time such a session gets a new message.
+
+def _messages_ref(session_ref):
+    return session_ref.collection("messages")
+
+def _message_doc_id(seq: int) -> str:
+    # Zero-padded so document ids sort in conversation order too.
+    return f"{seq:06d}"
+
+def _message_count(session_data: Dict) -> int:
+    if "conversation" in session_data:
+        return len(session_data["conversation"])
+    return session_data.get("message_count", 0)
+
+async def _load_conversation(session_ref, session_data: Dict, last_n: Union[int, None] = None,
+                             since: Union[int, None] = None) -> List[Dict[str, str]]:
+    """
+    Return the session's messages as [{"role": ..., "content": ...}], oldest first.
+    With since, only the messages from that index on are read; with last_n, only
+    the last last_n of those.
+    """
+    since = max(0, since or 0)
+    if "conversation" in session_data:
+        conversation = list(session_data["conversation"])[since:]
+        return conversation[-last_n:] if last_n else conversation
+    if _message_count(session_data) <= since:
+        return []
+
+    query = _messages_ref(session_ref).order_by("seq")
+    if since:
+        query = query.where(filter=FieldFilter("seq", ">=", since))
+    if last_n:
+        query = query.limit_to_last(last_n)
+    docs = await query.get()
+    return [{"role": doc.get("role"), "content": doc.get("content")} for doc in docs]
+
+def _stage_messages(unit: UnitOfWork, session_ref, session_data: Dict, messages: List[Dict[str, str]]) -> Dict:
+    """
+    Stage the writes appending `messages` to the session on `unit`.
+
+    Returns the fields the caller must write to the session document in the same
+    unit (the new message_count, and the removal of a legacy conversation array).
+    """
+    fields = {}
+    legacy = session_data.get("conversation")
+    if legacy is not None:
+        messages = list(legacy) + list(messages)
+        seq = 0
+        fields["conversation"] = firestore.DELETE_FIELD
+    else:
+        seq = session_data.get("message_count", 0)
+
+    now = datetime.datetime.utcnow()
+    for message in messages:
+        unit.set(_messages_ref(session_ref).document(_message_doc_id(seq)), {
+            "seq": seq,
+            "role": message["role"],
+            "content": message["content"],
+            "created_at": now,
+        })
+        seq += 1
+
+    fields["message_count"] = seq
+    return fields
+
+async def _append_messages(session_ref, session_data: Dict, messages: List[Dict[str, str]], updates: Dict,
+                           precondition=None):
+    """
+    Append `messages` to the session and apply `updates` to the session document, atomically.
+
+    With a `precondition` (see _turn_precondition) nothing is written if the session
+    changed since the turn read it, and the request fails with 409.
+    """
+    unit = UnitOfWork(db)
+    fields = _stage_messages(unit, session_ref, session_data, messages)
+    unit.update(session_ref, {**updates, **fields}, option=precondition)
+    try:
+        await unit.commit()
+    except FailedPrecondition:
+        raise HTTPException(status_code=409, detail="The session was updated by another request, reload it and retry")
+    # Keep the caller's copy in step, so it can load the conversation again.
+    session_data.pop("conversation", None)
+    session_data["message_count"] = fields["message_count"]
+
+async def _create_session(session_ref, session_data: Dict, messages: List[Dict[str, str]]):
+    """
+    Create the session document together with its first messages.
+    """
+    unit = UnitOfWork(db)
+    fields = _stage_messages(unit, session_ref, session_data, messages)
+    unit.set(session_ref, {**session_data, **fields})
+    await unit.commit()
+
+def _session_complete(session_data: Dict) -> bool:
+    """
+    Whether the session was completed. A message sent after that is answered with
+    "Session complete" and not saved: finalizing the session again would set it back
+    to "queued" while its job, already done, is never run again.
+    """
+    return bool(session_data.get("finalization") or session_data.get("completed_at"))
+
+async def _finalize_session(admin_id: str, form_id: str, session_id: str, patient_email: str,
+                            session_ref, session_data: Dict, current_index: int,
+                            new_messages, filled: Dict, updates: Dict, precondition=None):
+    """
+    Mark the session as complete and queue its finalization (see _run_finalization).
+
+    `new_messages` are the messages of this turn that still have to be saved, together
+    with `updates` to the session document. The patient's request doesn't wait for
+    the result to be built; its progress is available from /finalization/status.
+    """
+    await _append_messages(session_ref, session_data, new_messages, {
+        **updates,
+        "current_field_index": current_index + 1,
+        "email": patient_email,
+        "filled_fields": filled,
+        "finalization": "queued",
+        "completed_at": datetime.datetime.utcnow(),
+    }, precondition)
+    _job_queue().enqueue(session_id, FINALIZE_JOB, {
+        "admin_id": admin_id,
+        "form_id": form_id,
+        "session_id": session_id,
+    })
+    if _workers is not None:
+        _workers.notify()
+
+def _age_seconds(timestamp) -> float:
+    # Firestore returns timezone-aware timestamps; naive ones are UTC.
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (datetime.datetime.utcnow() - timestamp).total_seconds()
+
+async def _recover_finalizations(min_age: float = FINALIZATION_RECOVERY_AGE) -> int:
+    """
+    Queue the finalization of every session that is still "queued" in Firestore
+    `min_age` seconds after it was completed and that this replica's queue doesn't
+    hold yet. Returns how many were queued.
+
+    Another replica may still be finalizing such a session: only one of them commits
+    the result (see _run_finalization). The query needs the collection group index
+    on sessions.finalization.
+    """
+    query = db.collection_group("sessions").where(filter=FieldFilter("finalization", "==", "queued"))
+    recovered = 0
+    async for session_doc in query.stream():
+        session_data = session_doc.to_dict()
+        completed_at = session_data.get("completed_at")
+        if completed_at is None or _age_seconds(completed_at) < min_age:
+            continue
+        if _job_queue().enqueue(session_doc.id, FINALIZE_JOB, {
+            "admin_id": session_data["admin_id"],
+            "form_id": session_data["form_id"],
+            "session_id": session_doc.id,
+        }):
+            recovered += 1
+    if recovered:
+        print(f"Recovered {recovered} unfinalized sessions")
+        if _workers is not None:
+            _workers.notify()
+    return recovered
+
+async def _recover_finalizations_periodically():
+    while True:
+        try:
+            await _recover_finalizations()
+        except Exception as e:
+            print(f"Recovering unfinalized sessions failed: {e!r}")
+        await asyncio.sleep(FINALIZATION_RECOVERY_INTERVAL)
+
+async def _run_finalization(payload: Dict):
+    """
+    Build a completed session's result and store it as its own document in the
+    form's "results" subcollection. Runs on the finalization workers; raising makes
+    the job retry with backoff.
+
+    The result is assembled from the fields extracted turn by turn ("filled_fields").
+    Only if some are still missing (e.g. the patient said goodbye early) is the
+    conversation parsed by the model, and the extracted fields still take precedence.
+    """
+    admin_id, form_id, session_id = payload["admin_id"], payload["form_id"], payload["session_id"]
+    form_ref, session_ref, session_doc = await _load_session_snapshot(admin_id, form_id, session_id)
+    session_data = session_doc.to_dict()
+    if session_data.get("finalization") == "done":
+        # A retry of a job whose commit went through: its result was already counted.
+        return
+    inputs = session_data.get("inputs", [])
+    filled = session_data.get("filled_fields") or {}
+
+    if is_complete(inputs, filled):
+        result = assemble_result(inputs, filled)
+    else:
+        conversation = await _load_conversation(session_ref, session_data)
+        result = await aparse_final_conversation_to_json(conversation, inputs, tenant=_tenant(admin_id, form_id))
+        result.update({label: value for label, value in filled.items() if label in result})
+    # add some additional data to the result:
+    result["email"] = session_data.get("email")
+    result["form_id"] = form_id
+    result["admin_id"] = admin_id
+    result["session_id"] = session_id
+    result["date"] = datetime.datetime.utcnow().isoformat()
+    result["schema_hash"] = inputs_hash(inputs)
+
+    # One document per session: appends never touch other results, so concurrent
+    # completions can't overwrite each other. The form's aggregates are updated in the
+    # same batch as the session is marked done, so a result is counted exactly once
+    # (unless they are written behind, see AGGREGATES_WRITE_BEHIND_SECONDS).
+    aggregates_ref = form_ref.collection(AGGREGATES_COLLECTION).document(AGGREGATE_DOC)
+    increments = result_increments(result, inputs)
+    unit = UnitOfWork(db)
+    unit.set(form_ref.collection("results").document(session_id), result)
+    if not AGGREGATES_WRITE_BEHIND_SECONDS:
+        unit.set(aggregates_ref, increments, merge=True)
+    # Only if the session is unchanged: when two replicas finalize it at once (see
+    # _recover_finalizations), the other one's retry finds it done.
+    unit.update(session_ref, {
+        "date": result["date"],
+        "finalization": "done",
+    }, option=_turn_precondition(session_doc))
+    await unit.commit()
+    if AGGREGATES_WRITE_BEHIND_SECONDS:
+        await _aggregate_writes.merge(aggregates_ref, increments)
+
+# ----------------------------
+# Re-extraction
+# ----------------------------
+#
+# When a form's inputs change, the results of its finished sessions can be extracted
+# again under the new schema by a background job. Versions are stored next to the
+# live results, one collection per schema:
+#   admin/{admin_id}/forms/{form_id}/result_versions/{schema_hash}/results/{session_id}
+# and the job's progress in
+#   admin/{admin_id}/forms/{form_id}/reextractions/{schema_hash}
+# so an interrupted job resumes after the last session it checkpointed.
+REEXTRACT_JOB = "reextract_form"
+# A page's results are written in one batch with its checkpoint, so at most 499.
+REEXTRACT_PAGE_SIZE = min(499, int(os.getenv("REEXTRACT_PAGE_SIZE", "50")))
+# Sessions extracted at the same time by one job; the LLM calls themselves are
+# admitted at batch priority under the shared rate limits.
+REEXTRACT_CONCURRENCY = int(os.getenv("REEXTRACT_CONCURRENCY", "8"))
+
+_reextracted = registry.counter(
+    "reextraction_sessions_total", "Sessions handled by re-extraction jobs.", ["outcome"])
+
+def _reextract_job_id(admin_id: str, form_id: str, schema_hash: str) -> str:
+    return f"reextract:{admin_id}/{form_id}/{schema_hash}"
+
+def _result_versions_ref(form_ref, schema_hash: str):
+    return form_ref.collection("result_versions").document(schema_hash).collection("results")
+
+def _reextraction_ref(form_ref, schema_hash: str):
+    return form_ref.collection("reextractions").document(schema_hash)
+
+def _content_hash(schema_hash: str, conversation: List[Dict[str, str]]) -> str:
+    canonical = json.dumps(conversation, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{schema_hash}:{canonical}".encode("utf-8")).hexdigest()
+
+def _unchanged_fields(session_data: Dict, inputs: List[Dict]) -> Dict:
+    """
+    The session's turn-by-turn answers ("filled_fields") to inputs whose definition
+    is the same in `inputs` as when the session ran.
+    """
+    filled = session_data.get("filled_fields") or {}
+    previous = {field["label"]: field for field in session_data.get("inputs", [])}
+    return {field["label"]: filled[field["label"]] for field in inputs
+            if field["label"] in filled and previous.get(field["label"]) == field}
+
+async def _reextract_session(admin_id: str, form_id: str, inputs: List[Dict], schema_hash: str,
+                             session_ref, session_data: Dict, unit: UnitOfWork) -> str:
+    """
+    Stage the session's result under `inputs` on `unit`, as a version tagged with
+    the schema hash. Returns "skipped" if a version of the same conversation is
+    already stored, else "extracted".
+    """
+    form_ref = _form_ref(admin_id, form_id)
+    version_ref = _result_versions_ref(form_ref, schema_hash).document(session_ref.id)
+    conversation = await _load_conversation(session_ref, session_data)
+    content_hash = _content_hash(schema_hash, conversation)
+    stored = await version_ref.get(field_paths=["content_hash"])
+    if stored.exists and stored.get("content_hash") == content_hash:
+        return "skipped"
+
+    # Answers to unchanged inputs are kept; the model only runs if some are missing.
+    filled = _unchanged_fields(session_data, inputs)
+    if is_complete(inputs, filled):
+        result = assemble_result(inputs, filled)
+    else:
+        result = await aparse_final_conversation_to_json(conversation, inputs, priority=BATCH,
+                                                         tenant=_tenant(admin_id, form_id))
+        result.update({label: value for label, value in filled.items() if label in result})
+    result.update({
+        "email": session_data.get("email"),
+        "form_id": form_id,
+        "admin_id": admin_id,
+        "session_id": session_ref.id,
+        "date": session_data.get("date"),
+        "schema_hash": schema_hash,
+        "content_hash": content_hash,
+        "extracted_at": datetime.datetime.utcnow().isoformat(),
+    })
+    unit.set(version_ref, result)
+    return "extracted"
+
+async def _run_reextraction(payload: Dict):
+    """
+    Extract the results of all of a form's finished sessions again under the
+    payload's inputs. Runs on the finalization workers; raising makes the job retry
+    with backoff, resuming from its checkpoint.
+
+    Process:
+      1. Read the checkpoint; a finished one is started over, so a re-run re-checks
+         every session (unchanged ones are skipped by their content hash).
+      2. Page through the sessions ordered by creation, REEXTRACT_PAGE_SIZE at a
+         time, and re-extract the complete ones (see _session_complete)
+         REEXTRACT_CONCURRENCY at a time.
+      3. Write the page's results together with the checkpoint (the last session of
+         the page, the counts and the throughput) in one batch.
+    A session whose extraction fails is counted and left for the next run.
+
+    Once the form's or admin's token budget is used up (see langchain.budget), the job
+    stops with the checkpoint "paused" (reason "budget_exceeded") before the page it
+    was on. Budgets are lifetime totals and don't free up by themselves: after the
+    budget was raised, POST /reextract again resumes from there.
+    """
+    admin_id, form_id = payload["admin_id"], payload["form_id"]
+    inputs, schema_hash = payload["inputs"], payload["schema_hash"]
+    form_ref = _form_ref(admin_id, form_id)
+    sessions_ref = form_ref.collection("sessions")
+    checkpoint_ref = _reextraction_ref(form_ref, schema_hash)
+
+    checkpoint_doc = await checkpoint_ref.get()
+    checkpoint = checkpoint_doc.to_dict() if checkpoint_doc.exists else None
+    if checkpoint is not None and checkpoint.get("status") in ("running", "paused"):
+        checkpoint["status"] = "running"
+        checkpoint.pop("reason", None)
+    else:
+        checkpoint = {
+            "status": "running",
+            "schema_hash": schema_hash,
+            "cursor": None,
+            "processed": 0,
+            "extracted": 0,
+            "skipped": 0,
+            "failed": 0,
+            "elapsed_seconds": 0.0,
+            "started_at": datetime.datetime.utcnow().isoformat(),
+        }
+
+    last_doc = None
+    if checkpoint["cursor"]:
+        last_doc = await sessions_ref.document(checkpoint["cursor"]).get()
+        if not last_doc.exists:
+            raise RuntimeError(f"Checkpointed session {checkpoint['cursor']} no longer exists")
+
+    limit = asyncio.Semaphore(REEXTRACT_CONCURRENCY)
+
+    async def reextract(doc, unit: UnitOfWork) -> str:
+        async with limit:
+            try:
+                return await _reextract_session(admin_id, form_id, inputs, schema_hash,
+                                                doc.reference, doc.to_dict(), unit)
+            except BudgetExceeded:
+                return "budget_exceeded"
+            except LLMError as e:
+                print(f"Re-extraction of session {doc.id} failed: {e}")
+                return "failed"
+
+    while True:
+        started = time.perf_counter()
+        page = sessions_ref.order_by("created_at").limit(REEXTRACT_PAGE_SIZE)
+        if last_doc is not None:
+            page = page.start_after(last_doc)
+        docs = await page.get()
+        # Whatever their finalization status: a message sent after completion used to
+        # set it back to "queued" for good.
+        finished = [doc for doc in docs if _session_complete(doc.to_dict())]
+        unit = UnitOfWork(db)
+        outcomes = await asyncio.gather(*(reextract(doc, unit) for doc in finished))
+        if "budget_exceeded" in outcomes:
+            # Keep what was extracted, but leave the cursor before this page: when the
+            # job is resumed, those sessions are skipped as unchanged.
+            checkpoint["status"] = "paused"
+            checkpoint["reason"] = "budget_exceeded"
+            checkpoint["updated_at"] = datetime.datetime.utcnow().isoformat()
+            unit.set(checkpoint_ref, checkpoint)
+            await unit.commit()
+            print(f"Re-extraction of {admin_id}/{form_id} ({schema_hash[:12]}) paused: token budget used up")
+            return
+        for outcome in outcomes:
+            checkpoint[outcome] += 1
+            _reextracted.inc(outcome=outcome)
+        checkpoint["processed"] += len(finished)
+        checkpoint["elapsed_seconds"] += time.perf_counter() - started
+        elapsed = checkpoint["elapsed_seconds"]
+        checkpoint["sessions_per_second"] = checkpoint["processed"] / elapsed if elapsed else None
+        checkpoint["updated_at"] = datetime.datetime.utcnow().isoformat()
+        if docs:
+            last_doc = docs[-1]
+            checkpoint["cursor"] = last_doc.id
+        if len(docs) < REEXTRACT_PAGE_SIZE:
+            checkpoint["status"] = "done"
+        unit.set(checkpoint_ref, checkpoint)
+        await unit.commit()
+        if checkpoint["status"] == "done":
+            break
+
+    print(f"Re-extracted {admin_id}/{form_id} ({schema_hash[:12]}): {checkpoint['processed']} sessions, "
+          f"{checkpoint['extracted']} extracted, {checkpoint['skipped']} unchanged, "
+          f"{checkpoint['failed']} failed, {checkpoint['sessions_per_second'] or 0:.1f} sessions/s")
+
+# ----------------------------
+# Prompt context
+# ----------------------------
+
+# How many recent messages a turn reads for the prompt. Older ones would be trimmed
+# by the prompt token budget anyway (see langchain.context), so they aren't loaded.
+PROMPT_HISTORY_MESSAGES = int(os.getenv("PROMPT_HISTORY_MESSAGES", "40"))
+
+async def _load_turn_conversation(session_ref, session_data: Dict):
+    """
+    Load the messages a turn needs for its prompt.
+    """
+    return await _load_conversation(session_ref, session_data, last_n=PROMPT_HISTORY_MESSAGES)
+
+def _prompt_requirements(session_data: Dict):
+    """
+    Return (data_requirements, collected) for a turn: only the inputs still missing an
+    answer are described, and the answers so far are summarized instead.
+    """
+    inputs = session_data.get("inputs", [])
+    filled_fields = session_data.get("filled_fields")
+    return compile_form(inputs).requirements(filled_fields), collected_summary(filled_fields)
+
+def _usage_updates(usage: Dict) -> Dict:
+    """
+    Session document updates accumulating a turn's token usage, in total and for
+    the model that answered it.
+    """
+    updates = {
+        "prompt_tokens": firestore.Increment(usage.get("prompt_tokens", 0)),
+        "completion_tokens": firestore.Increment(usage.get("completion_tokens", 0)),
+    }
+    if usage.get("model"):
+        tokens = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        updates[f"model_tokens.{_model_key(usage['model'])}"] = firestore.Increment(tokens)
+    return updates
+
+# ----------------------------
+# Local fast path
+# ----------------------------
+
+def _last_question(conversation: List[Dict[str, str]]) -> str:
+    for message in reversed(conversation):
+        if message["role"] == "assistant":
+            return message["content"]
+    return ""
+
+async def _local_turn(admin_id: str, form_id: str, session_id: str, session_ref,
+                      session_data: Dict, inputs, conversation,
+                      user_message: Dict[str, str], patient: Dict[str, str],
+                      precondition=None, idempotency_key: Union[str, None] = None):
+    """
+    Try to handle a turn without the model (see langchain.slot_filling).
+
+    Returns (response, updates). If the answer to the field being asked was clear,
+    the turn is saved here (under `precondition`, recording `idempotency_key`) and
+    response is what the endpoint returns. Otherwise response is None, and updates
+    are the session fields the model turn must save along with its messages.
+    """
+    filled = dict(session_data.get("filled_fields") or {})
+    field = asked_field(pending_inputs(inputs, filled), session_data.get("awaiting_field"),
+                        _last_question(conversation))
+    if field is None:
+        slot_stats.record(None, False, "unknown_field")
+        return None, {"awaiting_field": None}
+
+    label = field["label"]
+    refusals = session_data.get("refusals", {})
+    value, reason = fill_slot(field, user_message["content"], refusals.get(label, 0))
+    slot_stats.record(field.get("data", {}).get("type"), value is not None, reason)
+    if value is None:
+        updates = {"awaiting_field": None}
+        if reason == "refusal":
+            updates["refusals"] = {**refusals, label: refusals.get(label, 0) + 1}
+        return None, updates
+
+    filled[label] = value
+    current_index = session_data.get("current_field_index", 0)
+    remaining = pending_inputs(inputs, filled)
+    if not remaining:
+        response = {"message": "Session complete"}
+        await _finalize_session(admin_id, form_id, session_id, patient["email"],
+                                session_ref, session_data, current_index,
+                                [user_message], filled, _turn_record(idempotency_key, response), precondition)
+        return response, {}
+
+    question = slot_question(remaining[0], patient["name"])
+    response = {"bot_question": question}
+    await _append_messages(session_ref, session_data,
+                           [user_message, {"role": "assistant", "content": question}],
+                           {"current_field_index": current_index + 1, "filled_fields": filled,
+                            "awaiting_field": remaining[0]["label"],
+                            **_turn_record(idempotency_key, response)},
+                           precondition)
+    return response, {}
+
+def _llm_unavailable(e: LLMError) -> HTTPException:
+    """
+    The response for a turn the model couldn't answer. Nothing is saved, so the
+    client can simply send the message again: 503 when the backend is overloaded or
+    timed out, 502 when it returned an error, 429 when the form's or admin's token
+    budget is used up.
+    """
+    print("LLM call failed:", e)
+    if isinstance(e, BudgetExceeded):
+        owner = "account" if len(e.scope) == 1 else "form"
+        return HTTPException(status_code=429, detail=f"This {owner}'s token budget is used up")
+    status_code = 503 if e.status_code in (None, 429, 503) else 502
+    return HTTPException(status_code=status_code, detail="The assistant is unavailable, please try again")
+
+def _sse(data: dict, event: Union[str, None] = None) -> str:
+    """
+    Format one Server-Sent Events frame. Data is JSON encoded so newlines in
+    chunks can't break the framing.
+    """
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+# ----------------------------
+# Idempotent turns
+# ----------------------------
+#
+# Clients may send an Idempotency-Key header with each message, fresh per message
+# and reused when retrying it. A retry then gets the original response instead of
+# appending the message again and paying for another completion:
+#   - responses are kept in-process for IDEMPOTENCY_TTL seconds, and the last one
+#     is also stored on the session document ("last_turn"), so a retry reaching
+#     another server process or arriving after a restart is answered too;
+#   - a retry arriving while the original is still running waits for it instead of
+#     starting another turn (so does an identical message without a key).
+# Independently, every turn only saves if the session document is unchanged since
+# the turn read it; a concurrent turn on the same session gets 409.
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+_turn_responses = TTLCache(maxsize=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000")), ttl=IDEMPOTENCY_TTL)
+_turns_inflight: Dict[tuple, asyncio.Future] = {}
+
+def _turn_record(idempotency_key: Union[str, None], response: Dict) -> Dict:
+    """
+    Session document updates recording a turn's response under its idempotency key.
+    """
+    if not idempotency_key:
+        return {}
+    return {"last_turn": {"idempotency_key": idempotency_key, "response": response}}
+
+def _replayed_turn(session_data: Dict, idempotency_key: Union[str, None]) -> Union[Dict, None]:
+    """
+    The stored response if this key's turn was already saved.
+    """
+    last_turn = session_data.get("last_turn") or {}
+    if idempotency_key and last_turn.get("idempotency_key") == idempotency_key:
+        return last_turn["response"]
+    return None
+
+def _turn_precondition(session_doc):
+    # Saving the turn fails if the session was written since it was read.
+    return db.write_option(last_update_time=session_doc.update_time)
+
+def _inflight_key(session_id: str, idempotency_key: Union[str, None], message: str) -> tuple:
+    if idempotency_key:
+        return (session_id, "key", idempotency_key)
+    return (session_id, "message", hashlib.sha256(message.encode("utf-8")).hexdigest())
+
+async def _joined_turn(session_id: str, idempotency_key: Union[str, None], message: str) -> Union[Dict, None]:
+    """
+    The response of this turn if it was answered recently, or once it finishes if it
+    is running; None if it has to be run.
+    """
+    if idempotency_key:
+        cached = _turn_responses.get((session_id, idempotency_key))
+        if cached is not None:
+            return cached
+    running = _turns_inflight.get(_inflight_key(session_id, idempotency_key, message))
+    if running is None:
+        return None
+    return await asyncio.shield(running)
+
+def _track_turn(session_id: str, idempotency_key: Union[str, None], message: str, turn: asyncio.Future):
+    """
+    Register `turn` (resolving to the turn's response) as running, so duplicates
+    join it, and cache its response once it succeeds.
+    """
+    key = _inflight_key(session_id, idempotency_key, message)
+    _turns_inflight[key] = turn
+
+    def finished(turn: asyncio.Future):
+        _turns_inflight.pop(key, None)
+        if turn.cancelled() or turn.exception() is not None:
+            return
+        if idempotency_key:
+            _turn_responses.set((session_id, idempotency_key), turn.result())
+
+    turn.add_done_callback(finished)
+
+async def _single_flight_turn(session_id: str, idempotency_key: Union[str, None], message: str, run) -> Dict:
+    """
+    Run the turn `run()` unless it was answered recently or is already running.
+    The turn keeps running if the client disconnects, so its retry finds it.
+    """
+    joined = await _joined_turn(session_id, idempotency_key, message)
+    if joined is not None:
+        return joined
+    task = asyncio.ensure_future(run())
+    _track_turn(session_id, idempotency_key, message, task)
+    return await asyncio.shield(task)
+
+# ----------------------------
+# Session endpoints
+# ----------------------------
+
+@app.post("/start_session/{admin_id}/{form_id}")
+async def start_session(admin_id: str, form_id: str, start_req: StartSessionRequest):
+    """
+    Start a new chat session for a given patient using a specified form.
+    
+    Process:
+      1. Retrieve the form from Firestore at admin/{admin_id}/forms/{form_id}.
+      2. Check that the patient's email (retrieved via Firebase Auth) is enrolled in the form
+         (see _is_enrolled).
+      3. Build the initial bot question from the opening question cached for the form's
+         inputs (generated by the LLM only the first time, else a static question), with
+         the patient's name filled in.
+      4. Save the session in a "sessions" subcollection under the form, with the bot's
+         response (role "assistant") as the first document of its "messages" subcollection.
+      5. Return the session id and the initial bot question.
+    """
+    patient_id = start_req.patient_id
+    patient, inputs = await _prepare_session(admin_id, form_id, patient_id)
+    
+    usage: Dict = {}
+    try:
+        initial_question = await _opening_question(inputs, patient["name"], usage, _tenant(admin_id, form_id))
+    except LLMError as e:
+        raise _llm_unavailable(e)
+
     # Save the session document in a "sessions" subcollection under the form.
-    session_ref = db.collection("admin").document(admin_id)\
-                    .collection("forms").document(form_id)\
-                    .collection("sessions").document()
-    session_ref.set(session_data)
+    session_ref = _form_ref(admin_id, form_id).collection("sessions").document()
     session_id = session_ref.id
-
-    # Optionally, store the session_id in the document.
-    session_ref.update({"session_id": session_id})
+    session_data = _new_session_data(admin_id, form_id, patient_id, patient, inputs)
+    session_data["session_id"] = session_id
+    session_data["prompt_tokens"] = usage.get("prompt_tokens", 0)
+    session_data["completion_tokens"] = usage.get("completion_tokens", 0)
+    await _create_session(session_ref, session_data, [{"role": "assistant", "content": initial_question}])
 
     return {"session_id": session_id, "bot_question": initial_question}
 
 @app.post("/send_message/{admin_id}/{form_id}")
-def send_message(admin_id: str, form_id: str, send_req: SendMessageRequest):
+async def send_message(admin_id: str, form_id: str, send_req: SendMessageRequest,
+                       idempotency_key: Union[str, None] = Header(default=None)):
     """
     Process a patient's message for an existing session.
     
     Process:
       1. Retrieve the session document from admin/{admin_id}/forms/{form_id}/sessions/{session_id} (session_id from body).
-      2. Append the patient's message (with role "user") to the conversation history.
-      3. If there is another input field pending, generate the next bot question using generateLlmResponse.
+      2. Load the conversation history and append the patient's message (with role "user").
+      3. If there is another input field pending, generate the next bot question using agenerateLlmResponse.
          - The LLM function is called with the new input field's description and the updated conversation history.
-      4. Append the bot's response (with role "assistant") to the conversation.
-      5. Update the session document accordingly.
+      4. Save the patient's message and the bot's response (with role "assistant") as new messages.
+      5. Update the session document accordingly, unless it changed since step 1 (409).
       6. Return the new bot question or a completion message.
+
+    Retrying with the same Idempotency-Key header returns the original response
+    (see "Idempotent turns").
     """
+    return await _single_flight_turn(send_req.session_id, idempotency_key, send_req.message,
+                                     lambda: _send_message(admin_id, form_id, send_req, idempotency_key))
+
+async def _send_message(admin_id: str, form_id: str, send_req: SendMessageRequest,
+                        idempotency_key: Union[str, None]) -> Dict:
     session_id = send_req.session_id
     patient_id = send_req.patient_id
     message = send_req.message
 
-    form_ref =  db.collection("admin").document(admin_id)\
-                    .collection("forms").document(form_id)
-
-    # Retrieve the session document using the full path.
-    session_ref = form_ref.collection("sessions").document(session_id)
-    session_doc = session_ref.get()
-    if not session_doc.exists:
-        raise HTTPException(status_code=404, detail="Session not found")
+    form_ref, session_ref, session_doc = await _load_session_snapshot(admin_id, form_id, session_id)
     session_data = session_doc.to_dict()
+    replayed = _replayed_turn(session_data, idempotency_key)
+    if replayed is not None:
+        return replayed
+    # A complete session takes no more messages (see _session_complete).
+    if _session_complete(session_data):
+        return {"message": "Session complete"}
+    precondition = _turn_precondition(session_doc)
 
     current_index = session_data.get("current_field_index", 0)
     inputs = session_data.get("inputs", [])
-    conversation: List[Dict[str, str]] = session_data.get("conversation", [])
+    conversation = await _load_turn_conversation(session_ref, session_data)
 
-    # Check if the session is already complete.
-    # if current_index >= len(inputs):
-    #     raise HTTPException(status_code=400, detail="Session already complete")
+    # Simple answers (a choice, a number) are filled in and followed up locally.
+    user_message = {"role": "user", "content": message}
+    patient = await _session_patient(session_data, patient_id)
+    response, local_updates = await _local_turn(admin_id, form_id, session_id, session_ref,
+                                                session_data, inputs, conversation,
+                                                user_message, patient, precondition, idempotency_key)
+    if response is not None:
+        return response
 
     # Append the patient's message to the conversation history.
-    conversation.append({"role": "user", "content": message})
+    conversation.append(user_message)
 
     # If there is another input field pending, generate the next question.
     new_index = current_index + 1
-    patient_name = auth.get_user(patient_id).display_name
-    next_question, done = generateLlmResponse(json.dumps(inputs), patient_name, conversation)
+    data_requirements, collected = _prompt_requirements(session_data)
+    usage: Dict = {}
+    extracted: Dict = {}
+    try:
+        next_question, done = await agenerateLlmResponse(data_requirements, patient["name"], conversation,
+                                                         collected=collected, usage=usage, fields=extracted,
+                                                         tenant=_tenant(admin_id, form_id))
+    except LLMError as e:
+        # Don't save anything: the patient's message is resent with the retry.
+        raise _llm_unavailable(e)
+    # Record the answers the model extracted from this message; once every input
+    # has one, the session is complete whether or not the model said so.
+    filled = merge_fields(inputs, session_data.get("filled_fields"), extracted)
+    done = done or is_complete(inputs, filled)
     if not done:
-        conversation.append({"role": "assistant", "content": next_question})
-        # Update the session: advance the current field index and save the updated conversation.
-        session_ref.update({
-            "current_field_index": new_index,
-            "conversation": conversation
-        })
-        return {"bot_question": next_question}
+        # Save both messages and advance the current field index.
+        response = {"bot_question": next_question}
+        await _append_messages(session_ref, session_data,
+                               [user_message, {"role": "assistant", "content": next_question}],
+                               {"current_field_index": new_index, "filled_fields": filled,
+                                **local_updates, **_usage_updates(usage),
+                                **_turn_record(idempotency_key, response)},
+                               precondition)
+        return response
     else:
         # No more input fields; mark the session as complete.
-        session_ref.update({
-            "current_field_index": current_index + 1,
-            "conversation": conversation
-        })
+        response = {"message": "Session complete"}
+        await _finalize_session(admin_id, form_id, session_id, patient["email"],
+                                session_ref, session_data, current_index, [user_message],
+                                filled, {**local_updates, **_usage_updates(usage),
+                                         **_turn_record(idempotency_key, response)},
+                                precondition)
+        return response
 
-        user_email = auth.get_user(patient_id).email
-        session_ref.update({"email": user_email})
+# ----------------------------
+# Streaming (Server-Sent Events) variants
+# ----------------------------
 
-        form_data = form_ref.get().to_dict()
+@app.post("/stream/start_session/{admin_id}/{form_id}")
+async def stream_start_session(admin_id: str, form_id: str, start_req: StartSessionRequest):
+    """
+    Same as start_session, but streams the initial bot question as Server-Sent Events.
 
-        result = parse_final_conversation_to_json(conversation, inputs)
-        # add some additional data to the result:
-        result["email"] = auth.get_user(patient_id).email
-        result["form_id"] = form_id
-        result["admin_id"] = admin_id
-        result["session_id"] = session_id
-        result["date"] = datetime.datetime.utcnow().isoformat()
-        results = form_data.get("results", [])
-        results.append(result)
+    The session is saved before the stream starts, so a failure to save it is an
+    error response rather than a stream that stops after announcing the session.
 
-        session_ref.update({
-            "email": result["email"],
-            "date": result["date"],
-        })
-        form_ref.update({"results": results})
+    Events:
+      - "session": {"session_id": ...}, sent first so the client can reply straight away.
+      - (default): {"delta": "..."} with the question. It comes from the opening question
+        cache, so it is sent whole rather than generated chunk by chunk.
+      - "done": {"session_id": ..., "bot_question": ...}.
+    """
+    patient_id = start_req.patient_id
+    patient, inputs = await _prepare_session(admin_id, form_id, patient_id)
 
-        return {"message": "Session complete"}
+    usage: Dict = {}
+    try:
+        initial_question = await _opening_question(inputs, patient["name"], usage, _tenant(admin_id, form_id))
+    except LLMError as e:
+        raise _llm_unavailable(e)
+
+    session_ref = _form_ref(admin_id, form_id).collection("sessions").document()
+    session_id = session_ref.id
+    session_data = _new_session_data(admin_id, form_id, patient_id, patient, inputs)
+    session_data["session_id"] = session_id
+    session_data["prompt_tokens"] = usage.get("prompt_tokens", 0)
+    session_data["completion_tokens"] = usage.get("completion_tokens", 0)
+    await _create_session(session_ref, session_data, [{"role": "assistant", "content": initial_question}])
+
+    async def events():
+        yield _sse({"session_id": session_id}, event="session")
+        yield _sse({"delta": initial_question})
+        yield _sse({"session_id": session_id, "bot_question": initial_question}, event="done")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def _response_events(response: Dict) -> StreamingResponse:
+    """
+    A turn's response as a complete event stream: the whole reply as one chunk.
+    """
+    async def events():
+        if "bot_question" in response:
+            yield _sse({"delta": response["bot_question"]})
+        yield _sse(response, event="done")
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def _fail_turn(turn: asyncio.Future, error: BaseException):
+    if turn.done():
+        return
+    if not isinstance(error, HTTPException):
+        error = HTTPException(status_code=503, detail="The message could not be processed, please try again")
+    turn.set_exception(error)
 
-def get_result_json(conversation, fields):
+@app.post("/stream/send_message/{admin_id}/{form_id}")
+async def stream_send_message(admin_id: str, form_id: str, send_req: SendMessageRequest,
+                              idempotency_key: Union[str, None] = Header(default=None)):
     """
-    Parse the final conversation into a JSON object using the provided field descriptions.
+    Same as send_message, but streams the bot's reply as Server-Sent Events.
+
+    Events:
+      - (default): {"delta": "..."} for each generated chunk.
+      - "finalizing": {} as soon as the finalize phrase shows up in the reply.
+      - "done": {"bot_question": ...} or {"message": "Session complete"} once the
+        reply (or the final result) has been saved.
+      - "error": {"detail": ...} if the model failed, or the session was updated by
+        another request meanwhile; nothing is saved, so the client can send the
+        message again.
+
+    Idempotency-Key works as for send_message; a retry is sent the original
+    response whole.
     """
-    return parse_final_conversation_to_json(conversation, fields)
+    session_id = send_req.session_id
+    joined = await _joined_turn(session_id, idempotency_key, send_req.message)
+    if joined is not None:
+        return _response_events(joined)
+    # Resolved with the response once it is saved, for duplicates to join.
+    turn = asyncio.get_running_loop().create_future()
+    _track_turn(session_id, idempotency_key, send_req.message, turn)
+    try:
+        return await _stream_send_message(admin_id, form_id, send_req, idempotency_key, turn)
+    except BaseException as e:
+        _fail_turn(turn, e)
+        raise
+
+async def _stream_send_message(admin_id: str, form_id: str, send_req: SendMessageRequest,
+                               idempotency_key: Union[str, None], turn: asyncio.Future):
+    session_id = send_req.session_id
+    patient_id = send_req.patient_id
+
+    form_ref, session_ref, session_doc = await _load_session_snapshot(admin_id, form_id, session_id)
+    session_data = session_doc.to_dict()
+    replayed = _replayed_turn(session_data, idempotency_key)
+    if replayed is not None:
+        turn.set_result(replayed)
+        return _response_events(replayed)
+    if _session_complete(session_data):
+        response = {"message": "Session complete"}
+        turn.set_result(response)
+        return _response_events(response)
+    precondition = _turn_precondition(session_doc)
+
+    current_index = session_data.get("current_field_index", 0)
+    inputs = session_data.get("inputs", [])
+    conversation = await _load_turn_conversation(session_ref, session_data)
+    user_message = {"role": "user", "content": send_req.message}
+    patient = await _session_patient(session_data, patient_id)
+
+    response, local_updates = await _local_turn(admin_id, form_id, session_id, session_ref,
+                                                session_data, inputs, conversation,
+                                                user_message, patient, precondition, idempotency_key)
+    if response is not None:
+        # Answered locally: send the whole reply as one chunk.
+        turn.set_result(response)
+        return _response_events(response)
+
+    conversation.append(user_message)
+    data_requirements, collected = _prompt_requirements(session_data)
+
+    async def events():
+        chunks = []
+        done = False
+        usage: Dict = {}
+        extracted: Dict = {}
+        try:
+            try:
+                async for chunk in astreamLlmResponse(data_requirements, patient["name"], conversation,
+                                                      collected=collected, usage=usage, fields=extracted,
+                                                      tenant=_tenant(admin_id, form_id)):
+                    chunks.append(chunk)
+                    yield _sse({"delta": chunk})
+                    if not done and FINALIZE_PHRASE in "".join(chunks):
+                        done = True
+                        yield _sse({}, event="finalizing")
+            except LLMError as e:
+                error = _llm_unavailable(e)
+                _fail_turn(turn, error)
+                yield _sse({"detail": error.detail}, event="error")
+                return
+            next_question = "".join(chunks).rstrip()
+            filled = merge_fields(inputs, session_data.get("filled_fields"), extracted)
+            # The goodbye shortcut finishes the session without the phrase, and so does
+            # having an answer for every input.
+            if not done and (next_question == GOODBYE_MESSAGE or is_complete(inputs, filled)):
+                done = True
+                yield _sse({}, event="finalizing")
+
+            try:
+                if not done:
+                    response = {"bot_question": next_question}
+                    await _append_messages(session_ref, session_data,
+                                           [user_message, {"role": "assistant", "content": next_question}],
+                                           {"current_field_index": current_index + 1, "filled_fields": filled,
+                                            **local_updates, **_usage_updates(usage),
+                                            **_turn_record(idempotency_key, response)},
+                                           precondition)
+                else:
+                    response = {"message": "Session complete"}
+                    await _finalize_session(admin_id, form_id, session_id, patient["email"],
+                                            session_ref, session_data, current_index, [user_message],
+                                            filled, {**local_updates, **_usage_updates(usage),
+                                                     **_turn_record(idempotency_key, response)},
+                                            precondition)
+            except HTTPException as e:
+                _fail_turn(turn, e)
+                yield _sse({"detail": e.detail}, event="error")
+                return
+            turn.set_result(response)
+            yield _sse(response, event="done")
+        finally:
+            # The client went away before the turn was saved.
+            _fail_turn(turn, asyncio.CancelledError())
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def _etag(session_doc, *params) -> str:
+    """
+    An ETag for a response built from the session document: every write to a
+    session (new messages included) changes the document's update time.
+    """
+    key = json.dumps([str(session_doc.update_time), *params])
+    return '"' + hashlib.sha1(key.encode("utf-8")).hexdigest()[:20] + '"'
+
+def _not_modified(if_none_match: Union[str, None], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
 
 @app.get("/receive_message/{admin_id}/{form_id}/{session_id}")
-def get_messages(admin_id: str, form_id: str, session_id: str):
+async def get_messages(admin_id: str, form_id: str, session_id: str, response: Response,
+                       last: Union[int, None] = None, since: Union[int, None] = None,
+                       if_none_match: Union[str, None] = Header(default=None)):
     """
     Retrieve the conversation history for a given session.
     The session is located at:
       admin/{admin_id}/forms/{form_id}/sessions/{session_id}
+
+    Returns the session document with its "conversation" filled in from the messages
+    subcollection, and "next_index", the number of messages so far. Pass `since` (a
+    previous next_index) to only get the messages added after it, or `last` to only
+    load the most recent messages.
+
+    Responses carry an ETag; send it back in If-None-Match to get a 304 without the
+    messages being read if the session hasn't changed.
     """
-    session_ref = db.collection("admin").document(admin_id)\
-                    .collection("forms").document(form_id)\
-                    .collection("sessions").document(session_id)
-    session_doc = session_ref.get()
-    if not session_doc.exists:
-        raise HTTPException(status_code=404, detail="Session not found")
-    return session_doc.to_dict()
+    _, session_ref, session_doc = await _load_session_snapshot(admin_id, form_id, session_id)
+    etag = _etag(session_doc, "session", last, since)
+    if _not_modified(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    session_data = session_doc.to_dict()
+    next_index = _message_count(session_data)
+    session_data["conversation"] = await _load_conversation(session_ref, session_data, last_n=last, since=since)
+    session_data["next_index"] = next_index
+    response.headers["ETag"] = etag
+    return session_data
 
 @app.get("/conversation/{admin_id}/{form_id}/{session_id}")
-def get_conversation(admin_id: str, form_id: str, session_id: str):
+async def get_conversation(admin_id: str, form_id: str, session_id: str, response: Response,
+                           last: Union[int, None] = None, since: Union[int, None] = None,
+                           if_none_match: Union[str, None] = Header(default=None)):
     """
     Retrieve the entire conversation history for a given session.
-    Only returns the conversation field from the session document.
+    Only returns the conversation, not the rest of the session document.
+    Pass `last` to only load the most recent messages, or `since` (a previous
+    "next_index") to only load the ones added after it. Supports ETag/If-None-Match
+    like /receive_message.
     """
-    session_ref = db.collection("admin").document(admin_id)\
-                    .collection("forms").document(form_id)\
-                    .collection("sessions").document(session_id)
-    session_doc = session_ref.get()
-    if not session_doc.exists:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
+    _, session_ref, session_doc = await _load_session_snapshot(admin_id, form_id, session_id)
+    etag = _etag(session_doc, "conversation", last, since)
+    if _not_modified(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
     session_data = session_doc.to_dict()
-    conversation = session_data.get("conversation", [])
-    return {"conversation": conversation}
+    conversation = await _load_conversation(session_ref, session_data, last_n=last, since=since)
+    response.headers["ETag"] = etag
+    return {"conversation": conversation, "next_index": _message_count(session_data)}
+
+# Longest a /watch request waits for new messages before answering with none.
+WATCH_TIMEOUT_SECONDS = float(os.getenv("WATCH_TIMEOUT_SECONDS", "25"))
+# How long a session's listener is kept once nobody watches it.
+WATCH_LINGER_SECONDS = float(os.getenv("WATCH_LINGER_SECONDS", "30"))
+
+# One Firestore snapshot listener per watched session, shared by all its watchers.
+# Listeners need the synchronous client; it is only created once a session is watched.
+_listeners = ListenerHub(lambda path: firestore.client(firebase_app()).document(path),
+                         linger_seconds=WATCH_LINGER_SECONDS)
+
+@app.get("/watch/{admin_id}/{form_id}/{session_id}")
+async def watch_conversation(admin_id: str, form_id: str, session_id: str, since: int = 0,
+                             timeout: float = WATCH_TIMEOUT_SECONDS):
+    """
+    Long-poll a session for new messages: answers as soon as it has more than `since`
+    messages, or after `timeout` seconds (at most WATCH_TIMEOUT_SECONDS) with none.
+    Call it again with the returned "next_index" to keep following the session.
+
+    Process:
+      1. Wait on the session document through a snapshot listener shared by everyone
+         watching the session, so watchers don't each re-read it. If the listener
+         had no snapshot yet when the time is up (a new listener, or timeout=0),
+         read the document directly instead.
+      2. Read only the messages from index `since` on.
+    A listener that fails answers 503.
+    """
+    timeout = max(0.0, min(timeout, WATCH_TIMEOUT_SECONDS))
+    path = f"admin/{admin_id}/forms/{form_id}/sessions/{session_id}"
+    session_ref = _form_ref(admin_id, form_id).collection("sessions").document(session_id)
+    try:
+        session_data = await _listeners.wait(
+            path, lambda data: data is None or _message_count(data) > since, timeout)
+    except asyncio.TimeoutError:
+        session_doc = await session_ref.get()
+        session_data = session_doc.to_dict() if session_doc.exists else None
+    except Exception as e:
+        print(f"Listener on {path} failed: {e!r}")
+        raise HTTPException(status_code=503, detail="Session updates are unavailable, retry later")
+    if session_data is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    if _message_count(session_data) <= since:
+        return {"conversation": [], "next_index": since, "finalization": session_data.get("finalization")}
+    conversation = await _load_conversation(session_ref, session_data, since=since)
+    return {
+        "conversation": conversation,
+        "next_index": _message_count(session_data),
+        "finalization": session_data.get("finalization"),
+    }
+
+RESULTS_PAGE_SIZE = 50
+RESULTS_MAX_PAGE_SIZE = 500
+
+@app.get("/results/{admin_id}/{form_id}")
+async def get_results(admin_id: str, form_id: str, limit: int = RESULTS_PAGE_SIZE, cursor: Union[str, None] = None,
+                      schema_hash: Union[str, None] = None):
+    """
+    Retrieve one page of a form's results, oldest first.
+    The results are located at:
+      admin/{admin_id}/forms/{form_id}/results/{session_id}
+    or, with `schema_hash`, the versions re-extracted under that schema at:
+      admin/{admin_id}/forms/{form_id}/result_versions/{schema_hash}/results/{session_id}
+
+    Pass the returned "next_cursor" as `cursor` to get the following page; it is
+    None once there are no more results.
+    """
+    limit = max(1, min(limit, RESULTS_MAX_PAGE_SIZE))
+    form_ref = _form_ref(admin_id, form_id)
+    if schema_hash:
+        results_ref = _result_versions_ref(form_ref, schema_hash)
+    else:
+        results_ref = form_ref.collection("results")
+    query = results_ref.order_by("date").limit(limit)
+    if cursor:
+        cursor_doc = await results_ref.document(cursor).get()
+        if not cursor_doc.exists:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.start_after(cursor_doc)
+
+    docs = [doc async for doc in query.stream()]
+    next_cursor = docs[-1].id if len(docs) == limit else None
+    return {"results": [doc.to_dict() for doc in docs], "next_cursor": next_cursor}
+
+@app.get("/aggregates/{admin_id}/{form_id}")
+async def get_aggregates(admin_id: str, form_id: str):
+    """
+    Summary statistics over all of a form's results, without reading them:
+    completion and refusal counts, counts per choice, mean/variance/min/max of
+    numbers, and per-day completions and means.
+
+    Process:
+      1. Read the form's inputs (cached) to know each field's type.
+      2. Read the aggregate document admin/{admin_id}/forms/{form_id}/aggregates/summary,
+         maintained as results are stored (see lib.aggregates and
+         server/rebuild_aggregates.py), and derive means and variances from it.
+    """
+    form_data = await _get_form_definition(admin_id, form_id)
+    if form_data is None:
+        raise HTTPException(status_code=404, detail="Form not found")
+    aggregate_doc = await _form_ref(admin_id, form_id).collection(AGGREGATES_COLLECTION).document(AGGREGATE_DOC).get()
+    return summarize(aggregate_doc.to_dict(), form_data.get("inputs", []))
+
+# Results read from Firestore per round-trip of an export.
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))
+
+@app.get("/export/{admin_id}/{form_id}")
+async def export_results(admin_id: str, form_id: str, format: str = "ndjson",
+                         start: Union[str, None] = None, end: Union[str, None] = None,
+                         cursor: Union[str, None] = None):
+    """
+    Stream all of a form's results, oldest first, as NDJSON, CSV or Parquet.
+
+    Columns are session_id, email, date, one per input (numbers typed as numbers,
+    empty when unanswered or refused) and "refused", the labels the patient refused.
+
+    Process:
+      1. Read the form's inputs to type the columns.
+      2. Page through admin/{admin_id}/forms/{form_id}/results ordered by date,
+         EXPORT_PAGE_SIZE documents at a time, optionally limited to
+         start <= date < end (ISO dates or datetimes).
+      3. Encode and send each page before reading the next, so memory use doesn't
+         grow with the number of results (Parquet: one row group per page).
+
+    To resume an interrupted export, pass the session_id of the last row received
+    as `cursor`.
+    """
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(FORMATS)}")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export is not available on this server")
+    for bound in (start, end):
+        if bound is not None:
+            try:
+                datetime.datetime.fromisoformat(bound)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid date: {bound}")
+
+    form_data = await _get_form_definition(admin_id, form_id)
+    if form_data is None:
+        raise HTTPException(status_code=404, detail="Form not found")
+    inputs = form_data.get("inputs", [])
+
+    results_ref = _form_ref(admin_id, form_id).collection("results")
+    query = results_ref.order_by("date")
+    if start:
+        query = query.where(filter=FieldFilter("date", ">=", start))
+    if end:
+        query = query.where(filter=FieldFilter("date", "<", end))
+    last_doc = None
+    if cursor:
+        last_doc = await results_ref.document(cursor).get()
+        if not last_doc.exists:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    out = encoder(format, export_columns(inputs))
+
+    async def chunks():
+        nonlocal last_doc
+        header = out.header()
+        if header:
+            yield header
+        while True:
+            page = query.limit(EXPORT_PAGE_SIZE)
+            if last_doc is not None:
+                page = page.start_after(last_doc)
+            docs = await page.get()
+            # Results migrated from the old array may lack their session_id.
+            data = out.encode(to_row({"session_id": doc.id, **doc.to_dict()}, inputs) for doc in docs)
+            if data:
+                yield data
+            if len(docs) < EXPORT_PAGE_SIZE:
+                break
+            last_doc = docs[-1]
+        footer = out.finish()
+        if footer:
+            yield footer
+
+    filename = f"{form_id}.{format}"
+    return StreamingResponse(chunks(), media_type=CONTENT_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/finalization/status/{session_id}")
+async def get_finalization_status(session_id: str):
+    """
+    Status of a completed session's finalization job: "queued", "running", "done",
+    or "dead" once it ran out of retries (see last_error). Only the replica that
+    holds the job knows it; the others answer 404 (the session's "finalization"
+    field, e.g. from /watch, is known everywhere).
+    """
+    job = _job_queue().get(session_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No finalization job for this session")
+    return {
+        "session_id": session_id,
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "last_error": job["last_error"],
+    }
+
+@app.get("/finalization/dead_letters")
+async def get_finalization_dead_letters(limit: int = 100):
+    """
+    Finalization jobs of this replica that failed every attempt, most recent first.
+    """
+    return {"jobs": _job_queue().dead_letters(limit)}
+
+@app.post("/finalization/retry/{session_id}")
+async def retry_finalization(session_id: str):
+    """
+    Requeue a dead-lettered finalization job.
+    """
+    if not _job_queue().retry(session_id):
+        raise HTTPException(status_code=404, detail="No dead-lettered job for this session")
+    if _workers is not None:
+        _workers.notify()
+    return {"session_id": session_id, "status": "queued"}
+
+@app.post("/reextract/{admin_id}/{form_id}")
+async def start_reextraction(admin_id: str, form_id: str):
+    """
+    Queue a re-extraction of all of a form's finished sessions under its current
+    inputs (see _run_reextraction). Queuing it again while it runs has no effect;
+    once it finished, it runs again and only re-extracts sessions whose conversation
+    changed since. A job paused on a used up token budget resumes where it stopped.
+
+    Process:
+      1. Read the form's current inputs and hash them; the hash names the version.
+         They are read from Firestore, not the form cache: this is typically called
+         right after the form was edited.
+      2. Enqueue the job, keyed by form and schema hash.
+    Progress is available from /reextract/status.
+    """
+    invalidate_form(admin_id, form_id)
+    form_data = await _get_form_definition(admin_id, form_id)
+    if form_data is None:
+        raise HTTPException(status_code=404, detail="Form not found")
+    inputs = form_data.get("inputs", [])
+    schema_hash = inputs_hash(inputs)
+    job_id = _reextract_job_id(admin_id, form_id, schema_hash)
+    _job_queue().enqueue(job_id, REEXTRACT_JOB, {
+        "admin_id": admin_id,
+        "form_id": form_id,
+        "inputs": inputs,
+        "schema_hash": schema_hash,
+    }, rerun=True)
+    if _workers is not None:
+        _workers.notify()
+    return {"job_id": job_id, "schema_hash": schema_hash, "status": _job_queue().get(job_id)["status"]}
+
+@app.get("/reextract/status/{admin_id}/{form_id}")
+async def get_reextraction_status(admin_id: str, form_id: str, schema_hash: Union[str, None] = None):
+    """
+    Progress of a form's re-extraction for `schema_hash` (default: its current
+    inputs): the job's status, and from its checkpoint the sessions processed,
+    extracted, skipped as unchanged and failed, and the throughput in sessions/s.
+    The status is "paused" when the job stopped on a used up token budget, with the
+    reason "budget_exceeded".
+    """
+    if schema_hash is None:
+        invalidate_form(admin_id, form_id)
+        form_data = await _get_form_definition(admin_id, form_id)
+        if form_data is None:
+            raise HTTPException(status_code=404, detail="Form not found")
+        schema_hash = inputs_hash(form_data.get("inputs", []))
+    job = _job_queue().get(_reextract_job_id(admin_id, form_id, schema_hash))
+    if job is None:
+        raise HTTPException(status_code=404, detail="No re-extraction for this schema")
+    checkpoint_doc = await _reextraction_ref(_form_ref(admin_id, form_id), schema_hash).get()
+    progress = checkpoint_doc.to_dict()
+    status, reason = job["status"], None
+    if status == "done" and progress and progress.get("status") == "paused":
+        status, reason = "paused", progress.get("reason")
+    return {
+        "schema_hash": schema_hash,
+        "status": status,
+        "reason": reason,
+        "attempts": job["attempts"],
+        "last_error": job["last_error"],
+        "progress": progress,
+    }
+
+# ----------------------------
+# Enrollment endpoints
+# ----------------------------
+
+@app.post("/enroll/{admin_id}/{form_id}")
+async def enroll_patients(admin_id: str, form_id: str, enroll_req: EnrollmentRequest):
+    """
+    Enroll patients in a form by email, in bulk.
+
+    Process:
+      1. Check that the form exists.
+      2. Write an enrollment document per email (see Enrollment), committed in
+         batches of up to MAX_BATCH_WRITES. Enrolling a patient twice has no effect.
+      3. Return the number of distinct emails enrolled.
+    """
+    if await _get_form_definition(admin_id, form_id) is None:
+        raise HTTPException(status_code=404, detail="Form not found")
+    enrolled = await _write_enrollments(admin_id, form_id, enroll_req.emails, enroll=True)
+    return {"enrolled": enrolled}
+
+@app.post("/unenroll/{admin_id}/{form_id}")
+async def unenroll_patients(admin_id: str, form_id: str, enroll_req: EnrollmentRequest):
+    """
+    Withdraw patients from a form by email, in bulk. Sessions they already started
+    are kept, but they can't start new ones.
+
+    Process:
+      1. Check that the form exists.
+      2. Delete their enrollment documents, and remove them from the form's legacy
+         "users" array if they are listed there.
+      3. Return the number of distinct emails unenrolled.
+    Other instances may still admit a withdrawn patient for up to ENROLLMENT_CACHE_TTL
+    seconds.
+    """
+    if await _get_form_definition(admin_id, form_id) is None:
+        raise HTTPException(status_code=404, detail="Form not found")
+    unenrolled = await _write_enrollments(admin_id, form_id, enroll_req.emails, enroll=False)
+    return {"unenrolled": unenrolled}
+
+# ----------------------------
+# Token usage endpoints
+# ----------------------------
+
+async def _usage_report(scope: tuple) -> Dict:
+    usage_doc = await _usage_ref(scope).get()
+    usage = usage_doc.to_dict() or {}
+    usage.setdefault("prompt_tokens", 0)
+    usage.setdefault("completion_tokens", 0)
+    usage["budget"] = get_ledger().budget(scope, usage.get("budget"))
+    return usage
+
+@app.get("/usage/{admin_id}/{form_id}")
+async def get_token_usage(admin_id: str, form_id: str):
+    """
+    Tokens used by the form and by its admin: prompt and completion totals, the
+    number of calls, the same per model, and the budget (0 if unlimited). The calls
+    of the last TOKEN_USAGE_WRITE_BEHIND_SECONDS may not be counted yet.
+    """
+    await _usage_writes.flush()
+    form_usage, admin_usage = await asyncio.gather(_usage_report((admin_id, form_id)), _usage_report((admin_id,)))
+    return {"form": form_usage, "admin": admin_usage}
+
+async def _set_budget(scope: tuple, tokens: Union[int, None]) -> Dict:
+    if tokens is not None and tokens < 0:
+        raise HTTPException(status_code=400, detail="A budget can't be negative")
+    await _usage_ref(scope).set({"budget": firestore.DELETE_FIELD if tokens is None else tokens}, merge=True)
+    get_ledger().forget(scope)
+    return {"budget": get_ledger().budget(scope, tokens)}
+
+@app.post("/budget/{admin_id}")
+async def set_admin_budget(admin_id: str, budget_req: BudgetRequest):
+    """
+    Set the tokens all of an admin's forms may use together (0: unlimited, null: the
+    LLM_ADMIN_TOKEN_BUDGET default). Other instances apply it within LLM_BUDGET_REFRESH
+    seconds. The budget applies to the admin's lifetime usage; it has no period and
+    usage is never reset.
+    """
+    return await _set_budget((admin_id,), budget_req.tokens)
+
+@app.post("/budget/{admin_id}/{form_id}")
+async def set_form_budget(admin_id: str, form_id: str, budget_req: BudgetRequest):
+    """
+    Set the tokens a form may use (0: unlimited, null: the LLM_FORM_TOKEN_BUDGET
+    default). Other instances apply it within LLM_BUDGET_REFRESH seconds. Like the
+    admin's, it applies to the form's lifetime usage, which is never reset.
+    """
+    if await _get_form_definition(admin_id, form_id) is None:
+        raise HTTPException(status_code=404, detail="Form not found")
+    return await _set_budget((admin_id, form_id), budget_req.tokens)
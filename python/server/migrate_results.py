@@ -0,0 +1,56 @@
+"""
+One-off migration: move the "results" array stored on form documents into the
+per-session results subcollection used by the API:
+
+  admin/{admin_id}/forms/{form_id}/results/{session_id}
+
+Usage (from the python/ directory, with FIREBASE_KEY_PATH set as for the API):
+  python -m server.migrate_results [admin_id [form_id]]
+
+Running it again is safe: results are keyed by session_id, and the array is
+only removed from a form once all of its entries were written.
+"""
+import sys
+import uuid
+
+from firebase_admin import firestore
+
+from lib.firebase import firebase_app
+
+# Firestore batches are limited to 500 writes.
+BATCH_SIZE = 500
+
+
+def migrate_form(db, form_ref) -> int:
+    form_data = form_ref.get().to_dict() or {}
+    results = form_data.get("results")
+    if not results:
+        return 0
+
+    for start in range(0, len(results), BATCH_SIZE):
+        batch = db.batch()
+        for result in results[start:start + BATCH_SIZE]:
+            # Very old results may lack a session_id; keep them under a fresh id.
+            doc_id = result.get("session_id") or uuid.uuid4().hex
+            batch.set(form_ref.collection("results").document(doc_id), result)
+        batch.commit()
+
+    form_ref.update({"results": firestore.DELETE_FIELD})
+    return len(results)
+
+
+def main(argv):
+    db = firestore.client(firebase_app())
+
+    admin_ids = argv[:1] or [doc.id for doc in db.collection("admin").list_documents()]
+    for admin_id in admin_ids:
+        forms = db.collection("admin").document(admin_id).collection("forms")
+        form_refs = [forms.document(argv[1])] if len(argv) > 1 else list(forms.list_documents())
+        for form_ref in form_refs:
+            moved = migrate_form(db, form_ref)
+            if moved:
+                print(f"{admin_id}/{form_ref.id}: moved {moved} results")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
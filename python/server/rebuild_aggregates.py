@@ -0,0 +1,53 @@
+"""
+Recompute the per-form aggregate documents served by /aggregates from the raw
+results:
+
+  admin/{admin_id}/forms/{form_id}/aggregates/summary
+
+The API keeps them up to date as results are stored; run this for results stored
+before that, or after results were edited or deleted by hand.
+
+Usage (from the python/ directory, with FIREBASE_KEY_PATH set as for the API):
+  python -m server.rebuild_aggregates [admin_id [form_id]]
+
+Results stored while it runs may be missed; run it again once the form is quiet.
+"""
+import sys
+
+from firebase_admin import firestore
+
+from lib.aggregates import AGGREGATE_DOC, AGGREGATES_COLLECTION, rebuild
+from lib.firebase import firebase_app
+
+
+def rebuild_form(form_ref) -> int:
+    form_data = form_ref.get().to_dict() or {}
+    inputs = form_data.get("inputs", [])
+
+    count = 0
+
+    def results():
+        nonlocal count
+        for doc in form_ref.collection("results").stream():
+            count += 1
+            yield doc.to_dict()
+
+    aggregates = rebuild(results(), inputs)
+    form_ref.collection(AGGREGATES_COLLECTION).document(AGGREGATE_DOC).set(aggregates)
+    return count
+
+
+def main(argv):
+    db = firestore.client(firebase_app())
+
+    admin_ids = argv[:1] or [doc.id for doc in db.collection("admin").list_documents()]
+    for admin_id in admin_ids:
+        forms = db.collection("admin").document(admin_id).collection("forms")
+        form_refs = [forms.document(argv[1])] if len(argv) > 1 else list(forms.list_documents())
+        for form_ref in form_refs:
+            counted = rebuild_form(form_ref)
+            print(f"{admin_id}/{form_ref.id}: aggregated {counted} results")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import asyncio
+
+import httpx
+import pytest
+
+# Tests import the modules the way the server does, from the python/ directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("WARMUP", "0")
+
+from bench.fakes import FakeAuth, FakeFirestore, Latency, StubProvider  # noqa: E402
+from bench.run import ADMIN_ID, DEFAULT_FIXTURE, FORM_ID, load_api, seed  # noqa: E402
+from langchain.llm import set_provider  # noqa: E402
+
+
+class ApiHarness:
+    """
+    server/api.py wired to the bench fakes, with a seeded form and patients.
+    """
+
+    def __init__(self):
+        with open(DEFAULT_FIXTURE) as f:
+            self.fixture = json.load(f)
+        self.db = FakeFirestore(Latency("0"))
+        self.auth = FakeAuth(Latency("0"))
+        self.api = load_api(self.db, self.auth)
+        set_provider(StubProvider(Latency("0")))
+        self.patients = seed(self.db, self.auth, self.fixture["form"], 30)
+        self.admin_id, self.form_id = ADMIN_ID, FORM_ID
+
+    def form_ref(self, form_id: str = None):
+        forms = self.db.collection("admin").document(self.admin_id).collection("forms")
+        return forms.document(form_id or self.form_id)
+
+    def add_form(self, form_id: str):
+        """
+        Another form like the seeded one, open to the same patients.
+        """
+        form = self.db.read(self.form_ref()).to_dict()
+        self.db.write(self.form_ref(form_id), form)
+
+    def session(self, session_id: str, form_id: str = None):
+        return self.db.read(self.form_ref(form_id).collection("sessions").document(session_id)).to_dict()
+
+    async def complete_session(self, client, patient_id: str, form_id: str = None) -> str:
+        """
+        Go through the fixture's first conversation and wait for its finalization.
+        """
+        base = f"{self.admin_id}/{form_id or self.form_id}"
+        started = (await client.post(f"/start_session/{base}", json={"patient_id": patient_id})).json()
+        session_id = started["session_id"]
+        for message in self.fixture["conversations"][0]["messages"]:
+            reply = (await client.post(f"/send_message/{base}", json={
+                "session_id": session_id, "patient_id": patient_id, "message": message})).json()
+            if reply.get("message") == "Session complete":
+                break
+        assert reply == {"message": "Session complete"}
+        for _ in range(500):
+            job = self.api._job_queue().get(session_id)
+            if job["status"] == "done":
+                return session_id
+            await asyncio.sleep(0.01)
+        raise AssertionError("the session was not finalized")
+
+    def run(self, scenario, timeout: float = 30.0):
+        """
+        Run `scenario(client)` against the app, with its workers started.
+        """
+        async def main():
+            async with self.api.app.router.lifespan_context(self.api.app):
+                transport = httpx.ASGITransport(app=self.api.app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                    return await asyncio.wait_for(scenario(client), timeout)
+        return asyncio.run(main())
+
+
+@pytest.fixture(scope="session")
+def harness():
+    return ApiHarness()
@@ -0,0 +1,39 @@
+from langchain.extraction import REFUSED
+from lib.aggregates import rebuild, summarize
+
+INPUTS = [
+    {"label": "Mood", "data": {"type": "choice", "values": ["Poor", "Good"]}},
+    {"label": "Sleep", "data": {"type": "number"}},
+]
+
+
+def test_summary_of_rebuilt_results():
+    results = [
+        {"date": "2025-01-01T08:00:00", "Mood": "Good", "Sleep": "6"},
+        {"date": "2025-01-01T20:00:00", "Mood": "Good", "Sleep": "8"},
+        {"date": "2025-01-02T08:00:00", "Mood": "Poor", "Sleep": REFUSED},
+    ]
+    summary = summarize(rebuild(results, INPUTS), INPUTS)
+    assert summary["completed"] == 3
+    assert summary["with_refusals"] == 1
+    assert summary["fields"]["Mood"]["counts"] == {"Poor": 1, "Good": 2}
+    sleep = summary["fields"]["Sleep"]
+    assert (sleep["count"], sleep["mean"], sleep["variance"], sleep["min"], sleep["max"]) == (2, 7.0, 1.0, 6, 8)
+    assert sleep["refused"] == 1
+    assert [(day["date"], day["means"].get("Sleep")) for day in summary["daily"]] == \
+        [("2025-01-01", 7.0), ("2025-01-02", None)]
+
+
+def test_aggregates_cover_finalized_sessions(harness):
+    form_id = "aggregates-form"
+    harness.add_form(form_id)
+
+    async def scenario(client):
+        for patient_id in harness.patients[4:6]:
+            await harness.complete_session(client, patient_id, form_id)
+        summary = (await client.get(f"/aggregates/{harness.admin_id}/{form_id}")).json()
+        assert summary["completed"] == 2
+        assert summary["fields"]["Mood"]["counts"]["Good"] == 2
+        assert summary["fields"]["Sleep Duration"]["mean"] == 7
+
+    harness.run(scenario)
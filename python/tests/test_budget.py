@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from langchain.budget import BudgetExceeded, TokenLedger
+from langchain.scheduler import BATCH, FINALIZATION, INTERACTIVE
+
+TENANT = "admin/form"
+
+
+def test_used_up_budget_refuses_all_but_finalizations():
+    ledger = TokenLedger(admin_budget=0, form_budget=100)
+
+    async def main():
+        await ledger.check(TENANT, INTERACTIVE)
+        await ledger.record(TENANT, "model", 80, 30)
+        for priority in (INTERACTIVE, BATCH):
+            with pytest.raises(BudgetExceeded) as raised:
+                await ledger.check(TENANT, priority)
+            assert raised.value.scope == ("admin", "form")
+            assert raised.value.status_code == 429
+        await ledger.check(TENANT, FINALIZATION)
+        # Other forms of the admin are unaffected.
+        await ledger.check("admin/other", INTERACTIVE)
+
+    asyncio.run(main())
+    assert ledger.share(TENANT) == pytest.approx(1.1)
+
+
+def test_stored_usage_and_budget_are_loaded():
+    stored = {("admin",): {"prompt_tokens": 40, "completion_tokens": 10, "budget": 50}}
+    saved = []
+
+    async def load(scope):
+        return stored.get(scope, {})
+
+    async def save(scope, model, prompt_tokens, completion_tokens):
+        saved.append((scope, model, prompt_tokens, completion_tokens))
+
+    ledger = TokenLedger(admin_budget=1000, load=load, save=save)
+
+    async def main():
+        with pytest.raises(BudgetExceeded) as raised:
+            await ledger.check(TENANT, INTERACTIVE)
+        assert raised.value.scope == ("admin",)
+        await ledger.record(TENANT, "model", 3, 2)
+
+    asyncio.run(main())
+    assert saved == [(("admin",), "model", 3, 2), (("admin", "form"), "model", 3, 2)]
+
+
+def test_used_up_budget_answers_429_only_when_the_model_is_needed(harness):
+    patient_id = harness.patients[8]
+    form_id = "budget-form"
+    harness.add_form(form_id)
+    tenant = f"{harness.admin_id}/{form_id}"
+
+    async def scenario(client):
+        base = f"{harness.admin_id}/{form_id}"
+        assert (await client.post(f"/budget/{base}", json={"tokens": 10})).json() == {"budget": 10}
+        await harness.api.get_ledger().record(tenant, "model", 10, 5)
+
+        # Starting a session doesn't need the model.
+        started = await client.post(f"/start_session/{base}", json={"patient_id": patient_id})
+        assert started.status_code == 200
+        session_id = started.json()["session_id"]
+        body = {"session_id": session_id, "patient_id": patient_id}
+
+        # An unclear answer needs the model, a clear one doesn't.
+        reply = await client.post(f"/send_message/{base}", json={**body, "message": "not too bad I guess"})
+        assert reply.status_code == 429
+        reply = await client.post(f"/send_message/{base}", json={**body, "message": "Good"})
+        assert reply.status_code == 200
+
+        assert (await client.post(f"/budget/{base}", json={"tokens": None})).status_code == 200
+
+    harness.run(scenario)
+
+
+def test_reextraction_pauses_on_a_used_up_budget_and_resumes(harness):
+    patient_id = harness.patients[9]
+    form_id = "reextract-budget-form"
+    harness.add_form(form_id)
+    base = f"{harness.admin_id}/{form_id}"
+
+    async def reextract(client) -> dict:
+        await client.post(f"/reextract/{base}")
+        for _ in range(500):
+            status = (await client.get(f"/reextract/status/{base}")).json()
+            if status["status"] in ("done", "dead", "paused"):
+                return status
+            await asyncio.sleep(0.01)
+        raise AssertionError("the re-extraction did not finish")
+
+    async def scenario(client):
+        await harness.complete_session(client, patient_id, form_id)
+        # A new input: the session has to be extracted by the model again.
+        form = harness.db.read(harness.form_ref(form_id)).to_dict()
+        form["inputs"].append({"label": "Energy", "description": "How much energy does the patient have?",
+                               "data": {"type": "string"}})
+        harness.db.write(harness.form_ref(form_id), form)
+
+        await client.post(f"/budget/{base}", json={"tokens": 1})
+        await harness.api.get_ledger().record(f"{harness.admin_id}/{form_id}", "model", 1, 0)
+        status = await reextract(client)
+        assert (status["status"], status["reason"]) == ("paused", "budget_exceeded")
+        assert status["attempts"] == 1
+        assert status["progress"]["processed"] == 0
+
+        await client.post(f"/budget/{base}", json={"tokens": None})
+        status = await reextract(client)
+        assert (status["status"], status["reason"]) == ("done", None)
+        assert status["progress"]["extracted"] == 1
+
+    harness.run(scenario)
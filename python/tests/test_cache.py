@@ -0,0 +1,79 @@
+from lib.cache import TTLCache
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_entries_expire_after_their_ttl():
+    clock = Clock()
+    cache = TTLCache(maxsize=10, ttl=10, timer=clock)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=20)
+    clock.now = 9.9
+    assert cache.get("a") == 1
+    clock.now = 10
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert len(cache) == 1
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = TTLCache(maxsize=2, ttl=60, timer=Clock())
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "a" in cache and "c" in cache and "b" not in cache
+
+
+def test_expired_entries_are_evicted_before_live_ones():
+    clock = Clock()
+    cache = TTLCache(maxsize=2, ttl=60, timer=clock)
+    cache.set("a", 1)
+    cache.set("short", 2, ttl=1)
+    cache.get("short")  # the most recently used, but expired by the next set
+    clock.now = 5
+    cache.set("c", 3)
+    assert len(cache) == 2
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_invalidate_and_clear():
+    cache = TTLCache(maxsize=10, ttl=60, timer=Clock())
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert "a" not in cache and "b" in cache
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_a_stale_patient_record_is_refreshed_before_refusing(harness):
+    patient_id = harness.patients[24]
+    form_id = "renamed-patient-form"
+    form = harness.db.read(harness.form_ref()).to_dict()
+    harness.db.write(harness.form_ref(form_id), {**form, "users": []})
+    base = f"{harness.admin_id}/{form_id}"
+
+    async def scenario(client):
+        # The patient's record is cached with the email they were enrolled under...
+        await client.post(f"/enroll/{base}", json={"emails": ["patient-24@example.com"]})
+        response = await client.post(f"/start_session/{base}", json={"patient_id": patient_id})
+        assert response.status_code == 200
+        # ...then they change it in Firebase Auth and are enrolled under the new one.
+        harness.auth.add_user(patient_id, "Renamed Patient", "renamed-24@example.com")
+        await client.post(f"/unenroll/{base}", json={"emails": ["patient-24@example.com"]})
+        await client.post(f"/enroll/{base}", json={"emails": ["renamed-24@example.com"]})
+        response = await client.post(f"/start_session/{base}", json={"patient_id": patient_id})
+        assert response.status_code == 200
+        assert harness.session(response.json()["session_id"], form_id)["email"] == "renamed-24@example.com"
+
+    harness.run(scenario)
@@ -0,0 +1,33 @@
+from langchain.context import ContextStats, count_tokens, fit_messages
+
+
+def _history(n):
+    return [{"role": "user" if i % 2 else "assistant", "content": f"message number {i} " * 20} for i in range(n)]
+
+
+def test_fit_messages_keeps_everything_under_budget():
+    history = _history(4)
+    messages, usage = fit_messages("system", history, budget=100_000)
+    assert messages[1:] == history
+    assert usage["dropped_messages"] == 0
+    assert usage["prompt_tokens"] == usage["budgeted_prompt_tokens"]
+
+
+def test_fit_messages_drops_oldest_and_keeps_latest():
+    history = _history(10)
+    messages, usage = fit_messages("system", history, budget=200)
+    assert messages[-1] == history[-1]
+    assert usage["dropped_messages"] > 0
+    assert "omitted" in messages[1]["content"]
+    assert usage["prompt_tokens"] < usage["budgeted_prompt_tokens"]
+    # the baseline is what fit_messages was handed, nothing earlier
+    handed = sum(4 + count_tokens(m["content"]) for m in history) + 3 + 4 + count_tokens("system")
+    assert usage["budgeted_prompt_tokens"] == handed
+
+
+def test_context_stats_counts_trimmed_turns():
+    stats = ContextStats()
+    stats.record(100, 100, 0)
+    stats.record(80, 150, 3)
+    assert stats.as_dict() == {"turns": 2, "prompt_tokens": 180, "budgeted_prompt_tokens": 250,
+                               "trimmed_turns": 1, "dropped_messages": 3}
@@ -0,0 +1,65 @@
+def _start(client, harness, form_id, patient_id):
+    return client.post(f"/start_session/{harness.admin_id}/{form_id}", json={"patient_id": patient_id})
+
+
+def _enrollment(harness, form_id, email):
+    enrollments = harness.form_ref(form_id).collection("enrollments")
+    return harness.db.read(enrollments.document(harness.api._enrollment_id(email))).to_dict()
+
+
+def test_enroll_and_unenroll_patients_by_email(harness):
+    form = harness.db.read(harness.form_ref()).to_dict()
+    harness.db.write(harness.form_ref("enrollment-docs"), {**form, "users": []})
+    patient_id = harness.patients[17]
+    email = harness.auth.get_user(patient_id).email
+    base = f"{harness.admin_id}/enrollment-docs"
+
+    async def scenario(client):
+        assert (await _start(client, harness, "enrollment-docs", patient_id)).status_code == 401
+
+        response = await client.post(f"/enroll/{base}", json={"emails": [email, email.upper(), " ", ""]})
+        assert response.json() == {"enrolled": 1}
+        assert _enrollment(harness, "enrollment-docs", email)["email"] == email
+        assert (await _start(client, harness, "enrollment-docs", patient_id)).status_code == 200
+
+        response = await client.post(f"/unenroll/{base}", json={"emails": [" " + email.upper()]})
+        assert response.json() == {"unenrolled": 1}
+        assert _enrollment(harness, "enrollment-docs", email) is None
+        assert (await _start(client, harness, "enrollment-docs", patient_id)).status_code == 401
+
+    harness.run(scenario)
+
+
+def test_unenroll_removes_legacy_users_and_bumps_the_version(harness, monkeypatch):
+    # Two writes per batch: the form update shares the first batch with one deletion.
+    monkeypatch.setattr(harness.api, "MAX_BATCH_WRITES", 2)
+    form = harness.db.read(harness.form_ref()).to_dict()
+    patient_ids = harness.patients[18:21]
+    emails = [harness.auth.get_user(uid).email for uid in patient_ids]
+    harness.db.write(harness.form_ref("enrollment-legacy"),
+                     {**form, "users": [emails[0].upper(), emails[1], "someone@example.com"], "version": 3})
+    base = f"{harness.admin_id}/enrollment-legacy"
+
+    async def scenario(client):
+        assert (await _start(client, harness, "enrollment-legacy", patient_ids[0])).status_code == 200
+        await client.post(f"/enroll/{base}", json={"emails": [emails[2]]})
+
+        response = await client.post(f"/unenroll/{base}", json={"emails": emails})
+        assert response.json() == {"unenrolled": 3}
+        stored = harness.db.read(harness.form_ref("enrollment-legacy")).to_dict()
+        assert stored["users"] == ["someone@example.com"]
+        assert stored["version"] == 4
+        for patient_id in patient_ids:
+            assert (await _start(client, harness, "enrollment-legacy", patient_id)).status_code == 401
+
+    harness.run(scenario)
+
+
+def test_enrollment_of_a_missing_form_is_refused(harness):
+    async def scenario(client):
+        for action in ("enroll", "unenroll"):
+            response = await client.post(f"/{action}/{harness.admin_id}/no-such-form",
+                                         json={"emails": ["a@example.com"]})
+            assert response.status_code == 404
+
+    harness.run(scenario)
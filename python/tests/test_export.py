@@ -0,0 +1,102 @@
+import io
+import csv
+import json
+
+import pytest
+
+from langchain.extraction import REFUSED
+from lib.export import CsvEncoder, export_columns, to_row
+
+INPUTS = [
+    {"label": "Mood", "description": "Mood today", "data": {"type": "choice", "values": ["Poor", "Good"]}},
+    {"label": "Sleep", "description": "Hours slept", "data": {"type": "number"}},
+]
+
+FORM_ID = "export-form"
+
+
+def test_rows_are_typed_from_the_inputs():
+    row = to_row({"session_id": "s", "email": "a@example.com", "date": "2025-01-01",
+                  "Mood": "Good", "Sleep": "7"}, INPUTS)
+    assert row == {"session_id": "s", "email": "a@example.com", "date": "2025-01-01",
+                   "Mood": "Good", "Sleep": 7.0, "refused": []}
+    row = to_row({"session_id": "s", "Mood": REFUSED.lower(), "Sleep": "lots"}, INPUTS)
+    assert (row["Mood"], row["Sleep"], row["refused"], row["email"]) == (None, None, ["Mood"], None)
+
+
+def test_csv_cells():
+    out = CsvEncoder(export_columns(INPUTS))
+    text = (out.header() + out.encode([to_row({"session_id": "s", "Mood": REFUSED, "Sleep": 7.5}, INPUTS),
+                                        to_row({"session_id": "t", "Sleep": 8}, INPUTS)])).decode()
+    assert list(csv.reader(io.StringIO(text))) == [
+        ["session_id", "email", "date", "Mood", "Sleep", "refused"],
+        ["s", "", "", "", "7.5", "Mood"],
+        ["t", "", "", "", "8", ""],
+    ]
+
+
+@pytest.fixture(scope="module")
+def export_form(harness):
+    form = harness.db.read(harness.form_ref()).to_dict()
+    harness.db.write(harness.form_ref(FORM_ID), {**form, "inputs": INPUTS})
+    results = harness.form_ref(FORM_ID).collection("results")
+    for day in range(1, 6):
+        harness.db.write(results.document(f"session-{day}"), {
+            "email": f"patient-{day}@example.com", "date": f"2025-01-0{day}",
+            "Mood": "Good" if day % 2 else REFUSED, "Sleep": day + 4})
+    return f"/export/{harness.admin_id}/{FORM_ID}"
+
+
+def _ndjson(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_export_pages_through_all_results(harness, export_form, monkeypatch):
+    # Pages smaller than the results, ending on a page boundary and not.
+    monkeypatch.setattr(harness.api, "EXPORT_PAGE_SIZE", 2)
+
+    async def scenario(client):
+        rows = _ndjson(await client.get(export_form))
+        assert [row["session_id"] for row in rows] == [f"session-{day}" for day in range(1, 6)]
+        assert rows[1]["refused"] == ["Mood"] and rows[1]["Sleep"] == 6.0
+
+        rows = _ndjson(await client.get(export_form, params={"start": "2025-01-02", "end": "2025-01-04"}))
+        assert [row["session_id"] for row in rows] == ["session-2", "session-3"]
+
+        rows = _ndjson(await client.get(export_form, params={"cursor": "session-3"}))
+        assert [row["session_id"] for row in rows] == ["session-4", "session-5"]
+
+        response = await client.get(export_form, params={"format": "csv", "end": "2025-01-05"})
+        assert response.headers["content-type"].startswith("text/csv")
+        assert len(list(csv.reader(io.StringIO(response.text)))) == 5
+
+    harness.run(scenario)
+
+
+def test_parquet_export(harness, export_form, monkeypatch):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(harness.api, "EXPORT_PAGE_SIZE", 2)
+
+    async def scenario(client):
+        return (await client.get(export_form, params={"format": "parquet"})).content
+
+    parquet = pyarrow_parquet.ParquetFile(io.BytesIO(harness.run(scenario)))
+    # One row group per page.
+    assert parquet.num_row_groups == 3
+    table = parquet.read()
+    assert table.num_rows == 5
+    assert table.column("Sleep").to_pylist() == [5.0, 6.0, 7.0, 8.0, 9.0]
+    assert table.column("refused").to_pylist()[1] == ["Mood"]
+
+
+def test_export_refuses_bad_requests(harness, export_form, monkeypatch):
+    monkeypatch.setattr(harness.api, "parquet_available", lambda: False)
+
+    async def scenario(client):
+        assert (await client.get(export_form, params={"format": "parquet"})).status_code == 501
+        assert (await client.get(export_form, params={"format": "xml"})).status_code == 400
+        assert (await client.get(export_form, params={"start": "yesterday"})).status_code == 400
+        assert (await client.get(export_form, params={"cursor": "no-such-session"})).status_code == 400
+        assert (await client.get(f"/export/{harness.admin_id}/no-such-form")).status_code == 404
+
+    harness.run(scenario)
@@ -0,0 +1,29 @@
+import math
+
+from langchain.extraction import REFUSED, merge_fields
+
+INPUTS = [
+    {"label": "Mood", "description": "Mood today", "data": {"type": "choice", "values": ["Poor", "Fair", "Good"]}},
+    {"label": "Sleep", "description": "Hours slept (0-12)", "data": {"type": "number"}},
+    {"label": "Notes", "description": "Anything else", "data": {"type": "string"}},
+]
+
+
+def test_merge_fields_rejects_values_outside_the_field():
+    assert merge_fields(INPUTS, {}, {"Sleep": "nan"}) == {}
+    assert merge_fields(INPUTS, {}, {"Sleep": float("nan")}) == {}
+    assert merge_fields(INPUTS, {}, {"Sleep": "40"}) == {}
+    assert merge_fields(INPUTS, {}, {"Sleep": 40}) == {}
+    assert merge_fields(INPUTS, {}, {"Mood": "Excellent"}) == {}
+    assert merge_fields(INPUTS, {}, {"Unknown": "Good"}) == {}
+
+
+def test_merge_fields_reads_values_like_the_final_parse():
+    merged = merge_fields(INPUTS, {}, {"Sleep": "7 hours", "Mood": "Good.", "Notes": " tired "})
+    assert merged == {"Sleep": 7, "Mood": "Good", "Notes": "tired"}
+    assert not any(isinstance(v, float) and math.isnan(v) for v in merged.values())
+
+
+def test_merge_fields_keeps_earlier_answers_and_refusals():
+    merged = merge_fields(INPUTS, {"Mood": "Fair"}, {"Sleep": "refused.", "Notes": ""})
+    assert merged == {"Mood": "Fair", "Sleep": REFUSED}
@@ -0,0 +1,67 @@
+import pytest
+
+from langchain.extraction import REFUSED, repair_json
+from langchain.form_schema import FormValidator, compile_form, inputs_hash
+
+INPUTS = [
+    {"label": "Mood", "description": "Mood today", "data": {"type": "choice", "values": ["Poor", "Fair", "Good"]}},
+    {"label": "Sleep", "description": "Hours slept (0-12)", "data": {"type": "number"}},
+    {"label": "Notes", "description": "Anything else", "data": {"type": "string"}},
+]
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ('{"Mood": "Good", "Sleep": 7}', {"Mood": "Good", "Sleep": 7}),
+    ('Here you go:\n```json\n{"Mood": "Good", "Sleep": 7}\n```\nLet me know!', {"Mood": "Good", "Sleep": 7}),
+    ("{'Mood': 'Fair', 'Notes': None}", {"Mood": "Fair", "Notes": None}),
+    ('{"Mood": "Good", "Sleep": 7,}', {"Mood": "Good", "Sleep": 7}),
+    ('{Mood: "Good", Sleep: 7}', {"Mood": "Good", "Sleep": 7}),
+    ('{"Mood": "Good", "Okay": True, "Bad": False}', {"Mood": "Good", "Okay": True, "Bad": False}),
+    ('{"Mood": "Good", "Sleep": 7, "Notes": "slept bad', {"Mood": "Good", "Sleep": 7, "Notes": "slept bad"}),
+    ('{"Mood": "Good", "Sleep": 7, "No', {"Mood": "Good", "Sleep": 7}),
+    ('{"Mood": {"value": "Good"}', {"Mood": {"value": "Good"}}),
+])
+def test_repair_json_recovers_the_object(reply, expected):
+    assert repair_json(reply) == expected
+
+
+@pytest.mark.parametrize("reply", ["", "I could not find any answers.", "[1, 2, 3]", "{{{"])
+def test_repair_json_gives_up_without_an_object(reply):
+    assert repair_json(reply) is None
+
+
+def test_validate_fixes_or_drops_values():
+    result, fixed = FormValidator(INPUTS).validate({"Mood": "good!", "Sleep": "about 7", "Extra": 1})
+    assert result == {"Mood": "Good", "Sleep": 7, "Notes": ""}
+    # A missing answer is left empty, which isn't a fix.
+    assert fixed == ["Mood", "Sleep"]
+
+
+def test_validate_keeps_valid_values_and_normalizes_refusals():
+    parsed = {"Mood": "Fair", "Sleep": 6.5, "Notes": "refused"}
+    result, fixed = FormValidator(INPUTS).validate(parsed)
+    assert result == {"Mood": "Fair", "Sleep": 6.5, "Notes": REFUSED}
+    assert fixed == ["Notes"]
+
+
+def test_validate_drops_values_out_of_range_or_not_a_value():
+    result, fixed = FormValidator(INPUTS).validate({"Mood": "Excellent", "Sleep": 40, "Notes": True})
+    assert result == {"Mood": "", "Sleep": "", "Notes": ""}
+    assert fixed == ["Mood", "Sleep", "Notes"]
+
+
+def test_compile_form_is_cached_per_schema():
+    compiled = compile_form(INPUTS)
+    assert compile_form([dict(field) for field in INPUTS]) is compiled
+    assert compiled.schema_hash == inputs_hash(INPUTS)
+
+    edited = [dict(INPUTS[0], description="Mood this morning")] + INPUTS[1:]
+    assert compile_form(edited) is not compiled
+    assert compile_form(edited).schema_hash != compiled.schema_hash
+
+
+def test_requirements_list_the_pending_inputs():
+    compiled = compile_form(INPUTS)
+    pending = compiled.requirements({"Mood": "Good", "Unknown": 1})
+    assert '"Mood"' not in pending and '"Sleep"' in pending and '"Notes"' in pending
+    assert compiled.requirements({"Mood": "Fair"}) is pending
@@ -0,0 +1,13 @@
+def test_get_form_returns_the_whole_document_unless_asked_for_the_definition(harness):
+    async def scenario(client):
+        base = f"{harness.admin_id}/{harness.form_id}"
+        form = (await client.get(f"/get_form/{base}")).json()
+        assert "users" in form and "inputs" in form
+
+        definition = (await client.get(f"/get_form/{base}", params={"definition_only": True})).json()
+        assert set(definition) <= {"title", "inputs", "version"}
+        assert definition["inputs"] == form["inputs"]
+
+        assert (await client.get(f"/get_form/{harness.admin_id}/no-such-form")).status_code == 404
+
+    harness.run(scenario)
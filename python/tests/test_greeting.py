@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from langchain import greeting
+from langchain.form_schema import inputs_hash
+from langchain.greeting import NAME_PLACEHOLDER, agenerate_greeting, render_greeting, static_greeting
+from langchain.llm import get_provider
+
+INPUTS = [{"label": "Mood", "description": "How have you been feeling?", "data": {"type": "text"}}]
+
+
+def _generate(monkeypatch, reply: str) -> str:
+    async def fake_response(*args, **kwargs):
+        return reply, False
+
+    monkeypatch.setattr(greeting, "agenerateLlmResponse", fake_response)
+    return asyncio.run(agenerate_greeting(INPUTS))
+
+
+def test_template_addressing_the_patient_once_is_kept(monkeypatch):
+    template = _generate(monkeypatch, f"Hi {NAME_PLACEHOLDER}! How have you been feeling? ")
+    assert render_greeting(template, "Ann Smith") == "Hi Ann! How have you been feeling?"
+
+
+@pytest.mark.parametrize("reply", [
+    "Hi there! How have you been feeling?",
+    f"Hi {NAME_PLACEHOLDER}, {NAME_PLACEHOLDER}! How have you been feeling?",
+    f"Hi {NAME_PLACEHOLDER}! How is your {{condition}}?",
+    "",
+])
+def test_unusable_template_is_rejected(monkeypatch, reply):
+    with pytest.raises(ValueError):
+        _generate(monkeypatch, reply)
+
+
+def test_static_greeting_asks_for_the_first_input():
+    assert render_greeting(static_greeting(INPUTS), "Ann") == "Hi Ann! 👋 How have you been feeling?"
+    assert render_greeting(static_greeting(INPUTS), None) == "Hi! 👋 How have you been feeling?"
+
+
+def test_fallback_template_is_stored_and_generated_once(harness, capsys):
+    form_id = "greeting-form"
+    harness.add_form(form_id)
+    form = harness.db.read(harness.form_ref(form_id)).to_dict()
+    form["inputs"][0]["description"] = "How is your mood today?"
+    harness.db.write(harness.form_ref(form_id), form)
+    base = f"{harness.admin_id}/{form_id}"
+    provider = get_provider()
+
+    async def start(client, patient_id):
+        reply = await client.post(f"/start_session/{base}", json={"patient_id": patient_id})
+        return reply.json()["bot_question"]
+
+    async def scenario(client):
+        calls = provider.calls
+        # The stub's reply doesn't address the patient by the placeholder.
+        questions = await asyncio.gather(*(start(client, patient_id) for patient_id in harness.patients[11:16]))
+        assert provider.calls == calls + 1
+        assert all(question.endswith("How is your mood today? Options: " + ", ".join(
+            form["inputs"][0]["data"]["values"])) for question in questions)
+        stored = harness.db.read(harness.db.collection("greetings").document(inputs_hash(form["inputs"])))
+        assert stored.to_dict()["template"] == static_greeting(form["inputs"])
+
+        # Another replica (or a restart) reads it instead of asking the model.
+        harness.api._greeting_cache.clear()
+        await start(client, harness.patients[16])
+        assert provider.calls == calls + 1
+
+    harness.run(scenario)
+    assert capsys.readouterr().out.count("Opening question") == 1
@@ -0,0 +1,100 @@
+import asyncio
+
+
+def _base(harness):
+    return f"{harness.admin_id}/{harness.form_id}"
+
+
+async def _start(client, harness, patient_id) -> str:
+    response = await client.post(f"/start_session/{_base(harness)}", json={"patient_id": patient_id})
+    return response.json()["session_id"]
+
+
+def test_retry_with_the_same_key_returns_the_original_response(harness):
+    patient_id = harness.patients[21]
+
+    async def scenario(client):
+        session_id = await _start(client, harness, patient_id)
+        body = {"session_id": session_id, "patient_id": patient_id, "message": "Good"}
+        headers = {"Idempotency-Key": "turn-1"}
+        first = (await client.post(f"/send_message/{_base(harness)}", json=body, headers=headers)).json()
+        count = harness.session(session_id)["message_count"]
+
+        retry = (await client.post(f"/send_message/{_base(harness)}", json=body, headers=headers)).json()
+        assert retry == first
+        # Another process (or a restart) only has the response stored on the session.
+        harness.api._turn_responses.clear()
+        retry = (await client.post(f"/send_message/{_base(harness)}", json=body, headers=headers)).json()
+        assert retry == first
+        assert harness.session(session_id)["message_count"] == count
+
+        # A new key is a new message.
+        await client.post(f"/send_message/{_base(harness)}", json=body, headers={"Idempotency-Key": "turn-2"})
+        assert harness.session(session_id)["message_count"] == count + 2
+
+    harness.run(scenario)
+
+
+def test_duplicates_of_a_running_turn_join_it(harness, monkeypatch):
+    patient_id = harness.patients[22]
+
+    async def scenario(client):
+        session_id = await _start(client, harness, patient_id)
+        load = harness.api._load_session_snapshot
+        loads = []
+        release = asyncio.Event()
+
+        async def held_load(*args):
+            loads.append(args)
+            await release.wait()
+            return await load(*args)
+
+        body = {"session_id": session_id, "patient_id": patient_id, "message": "Good"}
+        monkeypatch.setattr(harness.api, "_load_session_snapshot", held_load)
+        url = f"/send_message/{_base(harness)}"
+        first = asyncio.ensure_future(client.post(url, json=body, headers={"Idempotency-Key": "k"}))
+        keyed = asyncio.ensure_future(client.post(url, json=body, headers={"Idempotency-Key": "k"}))
+        for _ in range(100):
+            if loads:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        release.set()
+        responses = await asyncio.gather(first, keyed)
+        monkeypatch.undo()
+
+        assert len(loads) == 1
+        assert responses[0].json() == responses[1].json()
+        assert not harness.api._turns_inflight
+
+    harness.run(scenario)
+
+
+def test_concurrent_turns_on_a_session_conflict(harness, monkeypatch):
+    patient_id = harness.patients[23]
+
+    async def scenario(client):
+        session_id = await _start(client, harness, patient_id)
+        load = harness.api._load_session_snapshot
+        loaded = []
+        both_loaded = asyncio.Event()
+
+        async def load_together(*args):
+            snapshot = await load(*args)
+            loaded.append(snapshot)
+            if len(loaded) == 2:
+                both_loaded.set()
+            await both_loaded.wait()
+            return snapshot
+
+        monkeypatch.setattr(harness.api, "_load_session_snapshot", load_together)
+        url = f"/send_message/{_base(harness)}"
+        responses = await asyncio.gather(*[
+            client.post(url, json={"session_id": session_id, "patient_id": patient_id, "message": message})
+            for message in ("Good", "Fair")])
+        monkeypatch.undo()
+
+        assert sorted(response.status_code for response in responses) == [200, 409]
+        assert harness.session(session_id)["message_count"] == 3
+
+    harness.run(scenario)
@@ -0,0 +1,105 @@
+import asyncio
+
+from lib.jobs import DEAD, DONE, QUEUED, RUNNING, JobQueue, WorkerPool
+
+
+def _queue(tmp_path, **kwargs) -> JobQueue:
+    return JobQueue(str(tmp_path / "jobs.sqlite3"), **kwargs)
+
+
+def test_enqueue_is_idempotent_per_job_id(tmp_path):
+    queue = _queue(tmp_path)
+    assert queue.enqueue("s1", "kind", {"n": 1})
+    assert not queue.enqueue("s1", "kind", {"n": 2})
+    assert queue.get("s1")["payload"] == {"n": 1}
+
+    job = queue.claim()
+    # Not while the job exists, even with rerun.
+    assert not queue.enqueue("s1", "kind", {"n": 3}, rerun=True)
+    queue.complete(job["id"])
+    assert queue.enqueue("s1", "kind", {"n": 3}, rerun=True)
+    assert queue.get("s1")["payload"] == {"n": 3}
+    assert queue.get("s1")["status"] == QUEUED
+
+
+def test_failed_jobs_are_retried_then_dead_lettered(tmp_path):
+    queue = _queue(tmp_path, max_attempts=2, backoff_base=0)
+    queue.enqueue("s1", "kind", {})
+
+    job = queue.claim()
+    assert (job["status"], job["attempts"]) == (RUNNING, 1)
+    assert queue.claim() is None
+    assert queue.fail("s1", "boom") == QUEUED
+
+    job = queue.claim()
+    assert job["attempts"] == 2
+    assert queue.fail("s1", "boom again") == DEAD
+    assert queue.claim() is None
+    assert [job["last_error"] for job in queue.dead_letters()] == ["boom again"]
+
+    assert queue.retry("s1")
+    assert not queue.retry("s1")
+    assert queue.claim()["attempts"] == 1
+
+
+def test_retries_back_off(tmp_path):
+    queue = _queue(tmp_path, backoff_base=60)
+    queue.enqueue("s1", "kind", {})
+    queue.claim()
+    queue.fail("s1", "boom")
+    assert queue.claim() is None
+    assert queue.get("s1")["status"] == QUEUED
+
+
+def test_running_jobs_are_queued_again_on_restart(tmp_path):
+    queue = _queue(tmp_path)
+    queue.enqueue("s1", "kind", {})
+    queue.claim()
+    queue.close()
+
+    queue = _queue(tmp_path)
+    assert queue.get("s1")["status"] == QUEUED
+    assert queue.claim()["id"] == "s1"
+
+
+def test_worker_pool_runs_handlers_and_records_failures(tmp_path):
+    queue = _queue(tmp_path, max_attempts=1)
+    handled = []
+
+    async def handle(payload):
+        if payload.get("fail"):
+            raise RuntimeError("boom")
+        handled.append(payload["n"])
+
+    async def main():
+        pool = WorkerPool(queue, {"kind": handle}, concurrency=2, poll_interval=0.01)
+        pool.start()
+        queue.enqueue("ok", "kind", {"n": 1})
+        queue.enqueue("bad", "kind", {"fail": True})
+        queue.enqueue("unknown", "other", {})
+        pool.notify()
+        for _ in range(200):
+            if not queue.counts().get(QUEUED) and not queue.counts().get(RUNNING):
+                break
+            await asyncio.sleep(0.01)
+        await pool.stop()
+
+    asyncio.run(main())
+    assert handled == [1]
+    assert queue.get("ok")["status"] == DONE
+    assert queue.get("bad")["status"] == DEAD
+    assert "boom" in queue.get("bad")["last_error"]
+    assert queue.get("unknown")["status"] == DEAD
+
+
+def test_worker_pool_stops_when_woken_up_at_the_same_time(tmp_path):
+    queue = _queue(tmp_path)
+
+    async def main():
+        pool = WorkerPool(queue, {}, concurrency=4, poll_interval=60)
+        pool.start()
+        await asyncio.sleep(0)
+        pool.notify()
+        await asyncio.wait_for(pool.stop(), 5)
+
+    asyncio.run(main())
@@ -0,0 +1,174 @@
+import json
+import time
+import asyncio
+from typing import Dict, List
+
+import httpx
+import pytest
+
+from bench.fakes import Latency, StubProvider
+from langchain import budget, llm
+from langchain.genericLLMFunction import generateLlmResponse, parse_final_conversation_to_json
+from langchain.llm import LLMProvider, OpenAICompatibleProvider
+
+
+def test_provider_without_stream_cannot_be_instantiated():
+    class CompleteOnly(LLMProvider):
+        async def complete(self, messages: List[Dict[str, str]], model: str, temperature: float,
+                           max_tokens: int, deadline=None) -> Dict:
+            return {}
+
+    with pytest.raises(TypeError):
+        CompleteOnly()
+
+
+def test_openai_compatible_provider_implements_the_interface():
+    OpenAICompatibleProvider(base_url="http://localhost:1", api_key="test")
+
+
+def test_sync_wrappers_return_the_reply_and_the_parsed_dict(monkeypatch):
+    monkeypatch.setattr(llm, "_provider", StubProvider(Latency("0")))
+    monkeypatch.setattr(budget, "_ledger", budget.TokenLedger())
+    fields = [{"label": "Mood", "description": "How is the patient feeling?", "data": {"type": "string"}}]
+
+    reply, done = generateLlmResponse("Mood: how the patient feels", "Ann", [])
+    assert isinstance(reply, str) and isinstance(done, bool)
+    result = parse_final_conversation_to_json([{"role": "user", "content": "Fine"}], fields)
+    assert isinstance(result, dict) and set(result) == {"Mood"}
+
+
+def _provider(handler, **options) -> OpenAICompatibleProvider:
+    options = {"backoff_base": 0.01, "backoff_max": 0.01, **options}
+    return OpenAICompatibleProvider(base_url="http://llm.test/v1", api_key="test",
+                                    transport=httpx.MockTransport(handler), **options)
+
+
+def _completion(text: str) -> Dict:
+    return {"choices": [{"message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1}}
+
+
+MESSAGES = [{"role": "user", "content": "Hi"}]
+
+
+def test_complete_retries_429_after_the_retry_after_delay():
+    calls = []
+
+    def handler(request):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "0.2"})
+        return httpx.Response(200, json=_completion("Hello"))
+
+    async def main():
+        provider = _provider(handler)
+        try:
+            return await provider.complete(MESSAGES, "m", temperature=0, max_tokens=5)
+        finally:
+            await provider.aclose()
+
+    completion = asyncio.run(main())
+    assert completion["choices"][0]["message"]["content"] == "Hello"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.2
+
+
+def test_complete_gives_up_on_errors_that_are_not_retried():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(400, text="bad request")
+
+    async def main():
+        provider = _provider(handler)
+        try:
+            await provider.complete(MESSAGES, "m", temperature=0, max_tokens=5)
+        finally:
+            await provider.aclose()
+
+    with pytest.raises(llm.LLMError) as e:
+        asyncio.run(main())
+    assert e.value.status_code == 400 and len(calls) == 1
+
+
+def test_complete_stops_retrying_at_the_deadline():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503, headers={"Retry-After": "5"})
+
+    async def main():
+        provider = _provider(handler, max_retries=10)
+        try:
+            await provider.complete(MESSAGES, "m", temperature=0, max_tokens=5, deadline=time.monotonic() + 1)
+        finally:
+            await provider.aclose()
+
+    started = time.monotonic()
+    with pytest.raises(llm.LLMError) as e:
+        asyncio.run(main())
+    # The server asked for a retry after the deadline, so the call fails at once.
+    assert e.value.status_code == 503 and len(calls) == 1
+    assert time.monotonic() - started < 1
+
+
+def test_complete_fails_when_an_attempt_outlives_the_deadline():
+    async def handler(request):
+        await asyncio.sleep(5)
+        return httpx.Response(200, json=_completion("late"))
+
+    async def main():
+        provider = _provider(handler)
+        try:
+            await provider.complete(MESSAGES, "m", temperature=0, max_tokens=5, deadline=time.monotonic() + 0.2)
+        finally:
+            await provider.aclose()
+
+    with pytest.raises(llm.LLMError, match="deadline"):
+        asyncio.run(main())
+
+
+def _sse(*texts: str) -> bytes:
+    lines = [f"data: {json.dumps({'choices': [{'delta': {'content': text}}]})}\n\n" for text in texts]
+    return ("".join(lines) + "data: [DONE]\n\n").encode()
+
+
+def test_stream_retries_before_the_first_chunk():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) < 3:
+            return httpx.Response(502 if len(calls) == 1 else 429)
+        return httpx.Response(200, content=_sse("Hel", "lo"), headers={"content-type": "text/event-stream"})
+
+    async def main():
+        provider = _provider(handler)
+        try:
+            return [chunk async for chunk in provider.stream(MESSAGES, "m", temperature=0, max_tokens=5)]
+        finally:
+            await provider.aclose()
+
+    assert asyncio.run(main()) == ["Hel", "lo"]
+    assert len(calls) == 3
+    assert json.loads(calls[-1].content)["stream"] is True
+
+
+def test_a_new_event_loop_closes_the_old_client():
+    provider = _provider(lambda request: httpx.Response(200, json=_completion("Hi")))
+
+    async def call():
+        await provider.complete(MESSAGES, "m", temperature=0, max_tokens=5)
+        return provider.client
+
+    loop = asyncio.new_event_loop()
+    try:
+        first = loop.run_until_complete(call())
+        second = asyncio.run(call())
+        # The old client is closed on its own loop the next time that loop runs.
+        loop.run_until_complete(asyncio.sleep(0))
+        assert first is not second and first.is_closed and not second.is_closed
+    finally:
+        loop.close()
@@ -0,0 +1,23 @@
+from lib.metrics import Registry
+
+
+def test_counter_exports_totals_counted_elsewhere():
+    registry = Registry()
+    lookups = registry.counter("lookups_total", "Lookups.", ["result"])
+    lookups.set_total(3, result="hit")
+    lookups.set_total(5, result="hit")
+    rendered = registry.render()
+    assert "# TYPE lookups_total counter" in rendered
+    assert 'lookups_total{result="hit"} 5' in rendered
+
+
+def test_cache_lookups_are_a_counter(harness):
+    async def scenario(client):
+        await client.post(f"/start_session/{harness.admin_id}/{harness.form_id}",
+                          json={"patient_id": harness.patients[3]})
+        rendered = (await client.get("/metrics")).text
+        assert "# TYPE cache_lookups_total counter" in rendered
+        assert 'cache_lookups_total{cache="forms",result="hit"}' in rendered or \
+            'cache_lookups_total{cache="forms",result="miss"}' in rendered
+
+    harness.run(scenario)
@@ -0,0 +1,58 @@
+import asyncio
+
+from bench.fakes import Latency, StubProvider
+from langchain import budget, llm, routing
+from langchain.genericLLMFunction import agenerateLlmResponse, aparse_final_conversation_to_json
+from langchain.routing import CHAT, EXTRACTION, LLM_MAX_TOKENS, LLM_PARSE_MAX_TOKENS, ModelRouter
+
+FIELDS = [{"label": "Mood", "description": "How is the patient feeling?", "data": {"type": "string"}}]
+
+
+def _router() -> ModelRouter:
+    return ModelRouter(model="large", small_model="small", small_chat_prompt_tokens=100,
+                       small_context_tokens=1000, downgrade_share=0.8)
+
+
+def test_short_chat_turns_go_to_the_small_model():
+    route = _router().route(CHAT, 50)
+    assert (route.model, route.reason, route.max_tokens) == ("small", "short_context", LLM_MAX_TOKENS)
+
+
+def test_long_chat_turns_go_to_the_large_model():
+    route = _router().route(CHAT, 500)
+    assert (route.model, route.reason) == ("large", "long_context")
+
+
+def test_extraction_goes_to_the_small_model_with_room_for_the_answers():
+    route = _router().route(EXTRACTION, 300, answer_tokens=600)
+    assert (route.model, route.reason, route.max_tokens) == ("small", "extraction", min(600, LLM_PARSE_MAX_TOKENS))
+    assert _router().route(EXTRACTION, 300, answer_tokens=10).max_tokens == LLM_MAX_TOKENS
+
+
+def test_prompts_beyond_the_small_context_go_to_the_large_model():
+    route = _router().route(EXTRACTION, 900, answer_tokens=600)
+    assert (route.model, route.reason) == ("large", "long_context")
+
+
+def test_tenants_near_their_budget_are_downgraded():
+    router = _router()
+    assert router.route(CHAT, 500, budget_share=0.9).reason == "budget"
+    assert router.route(CHAT, 500, budget_share=0.5).reason == "long_context"
+    assert router.stats() == {CHAT: {"small budget": 1, "large long_context": 1}}
+
+
+def test_calls_reach_the_routed_model(monkeypatch):
+    provider = StubProvider(Latency("0"))
+    monkeypatch.setattr(llm, "_provider", provider)
+    monkeypatch.setattr(routing, "_router", ModelRouter(model="large", small_model="small"))
+    monkeypatch.setattr(budget, "_ledger", budget.TokenLedger())
+
+    async def main():
+        usage = {}
+        await agenerateLlmResponse("Mood: how the patient feels", "Ann", [], usage=usage)
+        await aparse_final_conversation_to_json([{"role": "user", "content": "Fine"}], FIELDS)
+        return usage
+
+    usage = asyncio.run(main())
+    assert usage["model"] == "small"
+    assert provider.models == {"small": 2}
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from langchain.llm import LLMError
+from langchain.scheduler import BATCH, FINALIZATION, INTERACTIVE, PRIORITY_RESERVE, LLMScheduler, TokenBucket
+
+
+async def _admission_order(scheduler: LLMScheduler, calls) -> list:
+    """
+    Queue `calls` ((name, priority, tenant), in that order) behind a call holding the
+    only slot, then release it and return the order they were admitted in.
+    """
+    order = []
+    release = asyncio.Event()
+
+    async def blocker():
+        async with scheduler.slot(INTERACTIVE):
+            await release.wait()
+
+    async def call(name, priority, tenant):
+        async with scheduler.slot(priority, tenant):
+            order.append(name)
+
+    first = asyncio.ensure_future(blocker())
+    await asyncio.sleep(0)
+    tasks = []
+    for name, priority, tenant in calls:
+        tasks.append(asyncio.ensure_future(call(name, priority, tenant)))
+        await asyncio.sleep(0)
+    assert scheduler.stats()["queued"][calls[0][1]] >= 1
+    release.set()
+    await asyncio.gather(first, *tasks)
+    return order
+
+
+def test_higher_priorities_are_admitted_first():
+    calls = [("batch", BATCH, ""), ("finalization", FINALIZATION, ""), ("interactive", INTERACTIVE, "")]
+    order = asyncio.run(_admission_order(LLMScheduler(max_concurrency=1), calls))
+    assert order == ["interactive", "finalization", "batch"]
+
+
+def test_tenants_of_a_priority_take_turns():
+    calls = [("a1", FINALIZATION, "a"), ("a2", FINALIZATION, "a"), ("a3", FINALIZATION, "a"),
+             ("b1", FINALIZATION, "b"), ("c1", FINALIZATION, "c")]
+    order = asyncio.run(_admission_order(LLMScheduler(max_concurrency=1), calls))
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_bucket_keeps_the_reserve_for_higher_priorities():
+    bucket = TokenBucket(per_minute=600, burst_seconds=10)
+    assert bucket.capacity == 100
+    bucket.take(75)
+    assert bucket.wait_time(10, PRIORITY_RESERVE[INTERACTIVE]) == 0
+    assert bucket.wait_time(10, PRIORITY_RESERVE[FINALIZATION]) == 0
+    assert bucket.wait_time(10, PRIORITY_RESERVE[BATCH]) > 0
+    # Larger than the bucket: a full bucket will do.
+    assert bucket.wait_time(1000) == pytest.approx(7.5, abs=0.1)
+
+
+def test_batch_calls_wait_while_interactive_ones_use_the_reserve():
+    async def main():
+        scheduler = LLMScheduler(tpm=600, max_concurrency=10)
+        async with scheduler.slot(INTERACTIVE, tokens=75):
+            pass
+        batch = asyncio.ensure_future(scheduler.slot(BATCH, tokens=10).__aenter__())
+        await asyncio.sleep(0.01)
+        assert not batch.done()
+        async with scheduler.slot(INTERACTIVE, tokens=10):
+            admitted = True
+        batch.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await batch
+        return admitted, scheduler.stats()
+
+    admitted, stats = asyncio.run(main())
+    assert admitted
+    assert stats == {"queued": {INTERACTIVE: 0, FINALIZATION: 0, BATCH: 0}, "in_flight": 0}
+
+
+def test_full_queue_refuses_calls():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1, max_queued=1)
+        release = asyncio.Event()
+
+        async def blocker():
+            async with scheduler.slot(INTERACTIVE):
+                await release.wait()
+
+        async def call():
+            async with scheduler.slot(BATCH):
+                pass
+
+        first = asyncio.ensure_future(blocker())
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(call())
+        await asyncio.sleep(0)
+        with pytest.raises(LLMError) as e:
+            await call()
+        release.set()
+        await asyncio.gather(first, queued)
+        return e.value.status_code
+
+    assert asyncio.run(main()) == 429
+
+
+def test_settling_returns_unused_tokens():
+    async def main():
+        scheduler = LLMScheduler(tpm=600)
+        async with scheduler.slot(INTERACTIVE, tokens=80) as admission:
+            admission.settle(20)
+        return scheduler.tokens.level
+
+    assert asyncio.run(main()) == pytest.approx(80, abs=1)
@@ -0,0 +1,206 @@
+import json
+import asyncio
+
+import pytest
+
+from langchain.form_schema import inputs_hash
+
+
+def test_message_after_completion_changes_nothing(harness):
+    patient_id = harness.patients[0]
+
+    async def scenario(client):
+        session_id = await harness.complete_session(client, patient_id)
+        before = harness.session(session_id)
+        assert before["finalization"] == "done"
+
+        base = f"{harness.admin_id}/{harness.form_id}"
+        body = {"session_id": session_id, "patient_id": patient_id, "message": "One more thing!"}
+        reply = await client.post(f"/send_message/{base}", json=body)
+        assert reply.status_code == 200
+        assert reply.json() == {"message": "Session complete"}
+        async with client.stream("POST", f"/stream/send_message/{base}", json=body) as response:
+            assert response.status_code == 200
+            text = "".join([chunk async for chunk in response.aiter_text()])
+        assert "event: done" in text and "Session complete" in text
+
+        after = harness.session(session_id)
+        assert after["finalization"] == "done"
+        assert after["message_count"] == before["message_count"]
+        watched = (await client.get(f"/watch/{base}/{session_id}", params={"since": 0, "timeout": 1})).json()
+        assert watched["finalization"] == "done"
+
+    harness.run(scenario)
+
+
+def test_reextraction_includes_sessions_left_queued(harness):
+    patient_id = harness.patients[1]
+    form_id = "reextract-form"
+    harness.add_form(form_id)
+
+    async def scenario(client):
+        base = f"{harness.admin_id}/{form_id}"
+        started = (await client.post(f"/start_session/{base}", json={"patient_id": patient_id})).json()
+        session_id = started["session_id"]
+        for message in harness.fixture["conversations"][0]["messages"]:
+            await client.post(f"/send_message/{base}", json={
+                "session_id": session_id, "patient_id": patient_id, "message": message})
+        # A session of before the fix: complete, but its status knocked back to "queued".
+        session_ref = harness.form_ref(form_id).collection("sessions").document(session_id)
+        harness.db.write(session_ref, {"finalization": "queued", "completed_at": None}, merge=True)
+
+        job = (await client.post(f"/reextract/{base}")).json()
+        for _ in range(500):
+            status = (await client.get(f"/reextract/status/{base}")).json()
+            if status["status"] == "done":
+                break
+            await asyncio.sleep(0.01)
+        assert status["status"] == "done"
+        assert status["progress"]["processed"] == 1
+        assert status["progress"]["extracted"] == 1
+        assert job["schema_hash"] == status["schema_hash"]
+
+    harness.run(scenario)
+
+
+def test_watch_without_a_snapshot_yet_reads_the_session(harness):
+    patient_id = harness.patients[2]
+
+    async def scenario(client):
+        base = f"{harness.admin_id}/{harness.form_id}"
+        session_id = (await client.post(f"/start_session/{base}", json={"patient_id": patient_id})).json()["session_id"]
+        # A new listener has no snapshot within timeout=0.
+        reply = await client.get(f"/watch/{base}/{session_id}", params={"since": 1, "timeout": 0})
+        assert reply.status_code == 200
+        assert reply.json() == {"conversation": [], "next_index": 1, "finalization": None}
+
+        reply = await client.get(f"/watch/{base}/new-session-{patient_id}", params={"timeout": 0})
+        assert reply.status_code == 404
+
+        harness.api._listeners.close()
+        reply = await client.get(f"/watch/{base}/{session_id}", params={"since": 0, "timeout": 0})
+        assert reply.status_code == 200
+        assert [message["role"] for message in reply.json()["conversation"]] == ["assistant"]
+        assert reply.json()["next_index"] == 1
+
+    harness.run(scenario)
+
+
+def test_sessions_left_queued_are_recovered(harness, monkeypatch):
+    patient_id = harness.patients[6]
+    form_id = "recovery-form"
+    harness.add_form(form_id)
+
+    async def scenario(client):
+        queue = harness.api._job_queue()
+        # The replica dies between marking the session "queued" and enqueueing it.
+        with monkeypatch.context() as patch:
+            patch.setattr(queue, "enqueue", lambda *args, **kwargs: False)
+            base = f"{harness.admin_id}/{form_id}"
+            session_id = (await client.post(f"/start_session/{base}", json={"patient_id": patient_id})).json()["session_id"]
+            for message in harness.fixture["conversations"][0]["messages"]:
+                await client.post(f"/send_message/{base}", json={
+                    "session_id": session_id, "patient_id": patient_id, "message": message})
+        assert harness.session(session_id, form_id)["finalization"] == "queued"
+        assert queue.get(session_id) is None
+
+        # Too recent: its own replica may still be finalizing it.
+        assert await harness.api._recover_finalizations() == 0
+        assert await harness.api._recover_finalizations(min_age=0) == 1
+        assert await harness.api._recover_finalizations(min_age=0) == 0
+        for _ in range(500):
+            if harness.session(session_id, form_id)["finalization"] == "done":
+                break
+            await asyncio.sleep(0.01)
+        assert harness.session(session_id, form_id)["finalization"] == "done"
+        assert harness.db.read(harness.form_ref(form_id).collection("results").document(session_id)).exists
+
+    harness.run(scenario)
+
+
+def test_concurrent_finalizations_store_one_result(harness, monkeypatch):
+    patient_id = harness.patients[7]
+    form_id = "double-finalization-form"
+    harness.add_form(form_id)
+
+    async def scenario(client):
+        queue = harness.api._job_queue()
+        with monkeypatch.context() as patch:
+            patch.setattr(queue, "enqueue", lambda *args, **kwargs: False)
+            base = f"{harness.admin_id}/{form_id}"
+            session_id = (await client.post(f"/start_session/{base}", json={"patient_id": patient_id})).json()["session_id"]
+            for message in harness.fixture["conversations"][0]["messages"]:
+                await client.post(f"/send_message/{base}", json={
+                    "session_id": session_id, "patient_id": patient_id, "message": message})
+
+        # Two replicas read the queued session before either stored its result.
+        load = harness.api._load_session_snapshot
+        loaded = []
+        both_loaded = asyncio.Event()
+
+        async def load_together(*args):
+            snapshot = await load(*args)
+            loaded.append(snapshot)
+            if len(loaded) == 2:
+                both_loaded.set()
+            await both_loaded.wait()
+            return snapshot
+
+        payload = {"admin_id": harness.admin_id, "form_id": form_id, "session_id": session_id}
+        with monkeypatch.context() as patch:
+            patch.setattr(harness.api, "_load_session_snapshot", load_together)
+            outcomes = await asyncio.gather(harness.api._run_finalization(payload),
+                                            harness.api._run_finalization(payload), return_exceptions=True)
+        assert sum(outcome is None for outcome in outcomes) == 1
+        # The failed one's retry finds the session done.
+        await harness.api._run_finalization(payload)
+        summary = (await client.get(f"/aggregates/{harness.admin_id}/{form_id}")).json()
+        assert summary["completed"] == 1
+
+    harness.run(scenario)
+
+
+def test_reextraction_reads_the_form_just_edited(harness):
+    form_id = "edited-form"
+    harness.add_form(form_id)
+    base = f"{harness.admin_id}/{form_id}"
+
+    async def scenario(client):
+        # The form is in the form cache.
+        assert (await client.get(f"/get_form/{base}", params={"definition_only": True})).status_code == 200
+        form = harness.db.read(harness.form_ref(form_id)).to_dict()
+        form["inputs"] = form["inputs"][:2]
+        harness.db.write(harness.form_ref(form_id), form)
+
+        started = (await client.post(f"/reextract/{base}")).json()
+        assert started["schema_hash"] == inputs_hash(form["inputs"])
+        status = (await client.get(f"/reextract/status/{base}")).json()
+        assert status["schema_hash"] == started["schema_hash"]
+
+    harness.run(scenario)
+
+
+def test_streamed_start_saves_the_session_before_announcing_it(harness, monkeypatch):
+    patient_id = harness.patients[10]
+    base = f"{harness.admin_id}/{harness.form_id}"
+
+    async def scenario(client):
+        async with client.stream("POST", f"/stream/start_session/{base}", json={"patient_id": patient_id}) as response:
+            assert response.status_code == 200
+            text = "".join([chunk async for chunk in response.aiter_text()])
+        assert text.index("event: session") < text.index("event: done")
+        session_id = json.loads(text.split("event: session\ndata: ")[1].split("\n")[0])["session_id"]
+        assert harness.session(session_id)["patient_id"] == patient_id
+
+        async def fail(*args):
+            raise RuntimeError("Firestore is down")
+
+        with monkeypatch.context() as patch:
+            patch.setattr(harness.api, "_create_session", fail)
+            # The request fails as a whole; no session id was sent.
+            with pytest.raises(RuntimeError):
+                async with client.stream("POST", f"/stream/start_session/{base}",
+                                         json={"patient_id": patient_id}) as response:
+                    await response.aread()
+
+    harness.run(scenario)
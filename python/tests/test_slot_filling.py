@@ -0,0 +1,85 @@
+import pytest
+
+from langchain.extraction import REFUSED
+from langchain.slot_filling import fill_slot, is_refusal, match_choice, parse_number
+
+MOODS = ["Terrible", "Poor", "Fair", "Good", "Great", "Excellent"]
+SLEEP = {"label": "Sleep", "description": "Hours slept last night (0-12)", "data": {"type": "number"}}
+MOOD = {"label": "Mood", "description": "Mood today", "data": {"type": "choice", "values": MOODS}}
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("7", 7),
+    ("7.5", 7.5),
+    ("7,5", 7.5),
+    ("about 7 hours", 7),
+    ("7h 30m", 7.5),
+    ("6-8", 7),
+    ("6 to 8 hours", 7),
+    ("seven", 7),
+    ("seven and a half", 7.5),
+    ("twelve", 12),
+    ("zero", 0),
+])
+def test_parse_number_reads_the_answer(message, expected):
+    assert parse_number(message, SLEEP["description"]) == expected
+
+
+@pytest.mark.parametrize("message", ["-2", "40", "13", "-0.5"])
+def test_parse_number_rejects_values_outside_the_range(message):
+    assert parse_number(message, SLEEP["description"]) is None
+
+
+def test_parse_number_keeps_the_sign():
+    assert parse_number("-2") == -2
+    assert parse_number("-1.5") == -1.5
+
+
+def test_parse_number_open_ended_range():
+    assert parse_number("14", "Hours (0-12+)") == 14
+    assert parse_number("-1", "Hours (0-12+)") is None
+
+
+@pytest.mark.parametrize("message", ["", "7 or 8 or 9", "5 then 7", "seven or eight hours and I woke up twice", "nan"])
+def test_parse_number_needs_exactly_one_number(message):
+    assert parse_number(message, SLEEP["description"]) is None
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("Good", "Good"),
+    ("great!", "Great"),
+    ("feeling good today", "Good"),
+    ("gret", "Great"),
+    ("exellent", "Excellent"),
+])
+def test_match_choice_picks_the_value(message, expected):
+    assert match_choice(MOODS, message) == expected
+
+
+@pytest.mark.parametrize("message", [
+    "fair enough",
+    "good question",
+    "not good",
+    "good or great",
+    "fare",
+    "I guess so",
+])
+def test_match_choice_rejects_near_misses(message):
+    assert match_choice(MOODS, message) is None
+
+
+@pytest.mark.parametrize("message", ["I'd rather not say", "skip", "no comment", "I don't want to answer"])
+def test_refusals(message):
+    assert is_refusal(message)
+
+
+def test_refusal_is_recorded_the_second_time():
+    assert fill_slot(SLEEP, "I'd rather not say") == (None, "refusal")
+    assert fill_slot(SLEEP, "I'd rather not say", refusals=1) == (REFUSED, "")
+
+
+def test_fill_slot():
+    assert fill_slot(SLEEP, "about 7 hours") == (7, "")
+    assert fill_slot(SLEEP, "-2") == (None, "not_confident")
+    assert fill_slot(MOOD, "fair enough") == (None, "not_confident")
+    assert fill_slot(MOOD, "well it was a long and complicated day honestly") == (None, "long_message")
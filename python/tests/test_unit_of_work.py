@@ -0,0 +1,164 @@
+import asyncio
+
+import pytest
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1 import transforms
+
+from bench.fakes import FakeFirestore
+from lib.unit_of_work import MAX_BATCH_WRITES, UnitOfWork, WriteBehind, merge_fields
+
+
+def test_merge_fields_combines_nested_maps_and_transforms():
+    older = {"counts": {"Good": transforms.Increment(1)}, "low": transforms.Minimum(5),
+             "high": transforms.Maximum(5), "title": "old"}
+    newer = {"counts": {"Good": transforms.Increment(2), "Fair": transforms.Increment(1)},
+             "low": transforms.Minimum(3), "high": transforms.Maximum(4), "title": "new"}
+    merged = merge_fields(older, newer)
+    assert merged["counts"]["Good"].value == 3
+    assert merged["counts"]["Fair"].value == 1
+    assert merged["low"].value == 3 and merged["high"].value == 5
+    assert merged["title"] == "new"
+    # The inputs are left alone.
+    assert older["counts"]["Good"].value == 1
+
+
+def test_unit_coalesces_writes_to_one_document():
+    async def main():
+        db = FakeFirestore()
+        doc = db.collection("stats").document("a")
+        other = db.collection("stats").document("b")
+        unit = UnitOfWork(db)
+        unit.set(doc, {"n": transforms.Increment(1)}, merge=True)
+        unit.set(doc, {"n": transforms.Increment(2), "m": 1}, merge=True)
+        unit.set(other, {"x": 1})
+        unit.delete(other)
+        assert len(unit) == 2
+        await unit.commit()
+        return db, doc, other
+
+    db, doc, other = asyncio.run(main())
+    assert db.read(doc).to_dict() == {"n": 3, "m": 1}
+    assert db.read(other).to_dict() is None
+    assert db.round_trips == 1
+
+
+def test_unit_keeps_writes_that_cannot_be_merged_apart():
+    db = FakeFirestore()
+    doc = db.collection("stats").document("a")
+    unit = UnitOfWork(db)
+    unit.update(doc, {"a": {"b": 1}})
+    unit.update(doc, {"a.c": 2})  # overlaps "a": not a plain key merge
+    unit.update(doc, {"d": 3}, option=db.write_option(last_update_time=None))
+    # A precondition is checked as written, even before a full set.
+    unit.set(doc, {"e": 4})
+    assert len(unit) == 4
+
+
+def test_unit_replaces_writes_with_a_later_full_set():
+    db = FakeFirestore()
+    doc = db.collection("stats").document("a")
+    unit = UnitOfWork(db)
+    unit.update(doc, {"a": 1})
+    unit.update(doc, {"b": 2})
+    assert len(unit) == 1
+    unit.set(doc, {"e": 4})
+    assert len(unit) == 1
+    asyncio.run(unit.commit())
+    assert db.read(doc).to_dict() == {"e": 4}
+
+
+def test_unit_commits_nothing_if_a_precondition_fails():
+    async def main():
+        db = FakeFirestore()
+        doc = db.collection("sessions").document("s")
+        other = db.collection("sessions").document("t")
+        db.write(doc, {"turn": 1})
+        stale = db.read(doc).update_time
+        db.write(doc, {"turn": 2})
+        unit = UnitOfWork(db)
+        unit.set(other, {"x": 1})
+        unit.update(doc, {"turn": 3}, option=db.write_option(last_update_time=stale))
+        with pytest.raises(FailedPrecondition):
+            await unit.commit()
+        return db, doc, other
+
+    db, doc, other = asyncio.run(main())
+    assert db.read(doc).to_dict() == {"turn": 2}
+    assert db.read(other).to_dict() is None
+
+
+def test_unit_refuses_more_writes_than_a_batch_holds():
+    db = FakeFirestore()
+    unit = UnitOfWork(db)
+    for i in range(MAX_BATCH_WRITES + 1):
+        unit.set(db.collection("docs").document(str(i)), {"i": i})
+    with pytest.raises(ValueError):
+        asyncio.run(unit.commit())
+
+
+def test_write_behind_holds_merges_until_closed():
+    async def main():
+        db = FakeFirestore()
+        doc = db.collection("aggregates").document("form")
+        writes = WriteBehind(db, window_seconds=60)
+        for _ in range(5):
+            await writes.merge(doc, {"completed": transforms.Increment(1)})
+        held = (len(writes), db.read(doc).to_dict())
+        await writes.close()
+        return db, doc, held
+
+    db, doc, held = asyncio.run(main())
+    assert held == (1, None)
+    assert db.read(doc).to_dict() == {"completed": 5}
+    assert db.round_trips == 1
+
+
+def test_write_behind_flushes_after_its_window():
+    async def main():
+        db = FakeFirestore()
+        doc = db.collection("aggregates").document("form")
+        writes = WriteBehind(db, window_seconds=0.01)
+        await writes.merge(doc, {"completed": transforms.Increment(1)})
+        await asyncio.sleep(0.1)
+        return db.read(doc).to_dict(), len(writes)
+
+    assert asyncio.run(main()) == ({"completed": 1}, 0)
+
+
+def test_write_behind_keeps_writes_whose_flush_failed(monkeypatch):
+    async def main():
+        db = FakeFirestore()
+        doc = db.collection("aggregates").document("form")
+        writes = WriteBehind(db, window_seconds=60)
+        await writes.merge(doc, {"completed": transforms.Increment(2)})
+
+        batch = db.batch
+
+        def failing_batch():
+            failing = batch()
+
+            async def commit():
+                raise RuntimeError("unavailable")
+
+            failing.commit = commit
+            return failing
+
+        monkeypatch.setattr(db, "batch", failing_batch)
+        await writes.flush()
+        monkeypatch.setattr(db, "batch", batch)
+        await writes.merge(doc, {"completed": transforms.Increment(1)})
+        await writes.close()
+        return db.read(doc).to_dict()
+
+    assert asyncio.run(main()) == {"completed": 3}
+
+
+def test_write_behind_without_a_window_writes_at_once():
+    async def main():
+        db = FakeFirestore()
+        doc = db.collection("aggregates").document("form")
+        writes = WriteBehind(db, window_seconds=0)
+        await writes.merge(doc, {"completed": transforms.Increment(1)})
+        return db.read(doc).to_dict(), len(writes)
+
+    assert asyncio.run(main()) == ({"completed": 1}, 0)